@@ -0,0 +1,339 @@
+# Iain Robertson
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import datetime
+import platform
+import resource
+import tracemalloc
+import multiprocessing
+
+from run import Stock, Type, BuyOrSell, Trade, TradeBatch, SimulatedClock, RetentionPolicy, SharedTradeRing, toEpoch, fromEpoch
+
+# price distributions generateTrades can draw trade prices from
+DISTRIBUTIONS = ["uniform", "normal", "lognormal", "walk"]
+
+# generateStocks creates stocks with seeded random dividends, a fifth of them Preferred
+# arg symbols : the number of stocks
+# arg seed : the seed for the random numbers
+# returns a list of Stock objects
+def generateStocks (symbols, seed = 1):
+	rng = random.Random (seed)
+	stocks = []
+	for i in range (symbols):
+		if i % 5 == 4:
+			stocks.append (Stock ("S%d" % i, Type.Preferred, rng.randint (1, 30), rng.randint (1, 5), 100))
+		else:
+			stocks.append (Stock ("S%d" % i, Type.Common, rng.randint (0, 30), None, rng.choice ([60, 100, 250])))
+	return stocks
+
+# generateTrades generates seeded random trades a chunk at a time, so any number of trades can be generated
+# without holding them all
+# arg stocks : the stocks to trade, chosen with popularity falling off with position in the list
+# arg count : the number of trades
+# arg seed : the seed for the random numbers
+# arg distribution : the distribution of prices, one of DISTRIBUTIONS. walk moves each stock's price a small
+#                    random step from its last trade
+# arg start : the date and time of the first trade
+# arg rate : the number of trades per second
+# arg skew : the most seconds a trade's timestamp is moved from its place in time order, so trades arrive out of order
+# arg chunkSize : the number of trades in each chunk
+# yields a TradeBatch per chunk
+def generateTrades (stocks, count, seed = 1, distribution = "lognormal", start = datetime.datetime (2020, 1, 2, 8),
+		rate = 1000.0, skew = 0.0, chunkSize = 65536):
+	rng = random.Random (seed)
+	epoch = toEpoch (start)
+	# cumulative weights for popularity falling off as 1 / (position + 1)
+	weights = []
+	total = 0.0
+	for i in range (len (stocks)):
+		total += 1.0 / (i + 1)
+		weights.append (total)
+	prices = [rng.uniform (10, 200) for stock in stocks] # each stock's middle price
+	last = list (prices)
+	position = 0
+	while position < count:
+		size = min (chunkSize, count - position)
+		chosen = rng.choices (range (len (stocks)), cum_weights = weights, k = size)
+		timestamps = [epoch + (position + i) / rate for i in range (size)]
+		if skew > 0:
+			timestamps = [timestamp + rng.uniform (-skew, skew) for timestamp in timestamps]
+		quantities = [float (rng.randint (1, 1000)) for i in range (size)]
+		sides = [rng.choice ([BuyOrSell.Buy, BuyOrSell.Sell]) for i in range (size)]
+		if distribution == "uniform":
+			tradePrices = [round (rng.uniform (0.5, 1.5) * prices [i], 2) for i in chosen]
+		elif distribution == "normal":
+			tradePrices = [round (max (0.01, rng.gauss (prices [i], prices [i] * 0.1)), 2) for i in chosen]
+		elif distribution == "lognormal":
+			tradePrices = [round (prices [i] * rng.lognormvariate (0, 0.1), 2) for i in chosen]
+		elif distribution == "walk":
+			tradePrices = []
+			for i in chosen:
+				last [i] = max (0.01, round (last [i] + rng.choice ([-0.01, 0.0, 0.01]), 2))
+				tradePrices.append (last [i])
+		else:
+			raise ValueError ("unknown price distribution %s" % distribution)
+		yield TradeBatch ([stocks [i] for i in chosen], timestamps, quantities, sides, tradePrices)
+		position += size
+
+# Timer class to collect the latencies of calls and summarise them
+class Timer:
+	# Timer constructor
+	# arg name : the name of the thing timed
+	def __init__ (self, name):
+		self._name = name
+		self._latencies = [] # seconds per call, for calls timed one at a time
+		self._operations = 0
+		self._seconds = 0.0
+
+	# time calls a function with each set of arguments, timing each call
+	# arg function : the function to call
+	# arg arguments : an iterable of argument tuples
+	# arg setup : a function to call with the same arguments before each call, outside the time taken
+	def time (self, function, arguments, setup = None):
+		clock = time.perf_counter
+		latencies = self._latencies
+		for args in arguments:
+			if setup is not None:
+				setup (*args)
+			start = clock ()
+			function (*args)
+			latencies.append (clock () - start)
+		self._operations = len (latencies)
+		self._seconds = math.fsum (latencies)
+
+	# timeBulk adds the time taken for a number of operations done in one go
+	# arg operations : the number of operations
+	# arg seconds : the time they took
+	def timeBulk (self, operations, seconds):
+		self._operations += operations
+		self._seconds += seconds
+
+	# result summarises the timings
+	# returns a dictionary of name, operations, seconds, throughput in operations per second, 50th and 99th
+	# percentile latency in microseconds if calls were timed one at a time, and the peak resident memory in
+	# megabytes of the whole process so far, which only ever grows so includes everything timed before
+	def result (self):
+		result = { "name" : self._name, "operations" : self._operations, "seconds" : self._seconds,
+			"throughput" : self._operations / self._seconds if self._seconds > 0 else None }
+		if self._latencies:
+			latencies = sorted (self._latencies)
+			result ["p50Micros"] = percentile (latencies, 50) * 1e6
+			result ["p99Micros"] = percentile (latencies, 99) * 1e6
+		result ["processPeakRssMegabytes"] = peakRss ()
+		if tracemalloc.is_tracing ():
+			result ["peakTracedMegabytes"] = tracemalloc.get_traced_memory () [1] / 1e6
+			tracemalloc.reset_peak ()
+		return result
+
+# percentile returns a percentile of sorted values, the nearest value at or above it
+# arg values : a sorted list of values
+# arg p : the percentile, 0 to 100
+def percentile (values, p):
+	return values [max (0, int (math.ceil (p / 100.0 * len (values))) - 1)]
+
+# returns the peak resident memory of this process since it started in megabytes
+def peakRss ():
+	return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# benchmarkShardedIndex times Trade.shardedGBCEAllShareIndex for a number of worker processes
+# arg t : the Trade to calculate the index for
+# arg processes : a list of numbers of worker processes, 0 to calculate in this process as a baseline
+# arg repeat : the number of times to time each, the fastest is kept
+# returns a list of (processes, seconds) tuples
+def benchmarkShardedIndex (t, processes, repeat = 3):
+	results = []
+	for count in processes:
+		best = None
+		for i in range (repeat):
+			start = time.perf_counter ()
+			t.shardedGBCEAllShareIndex (count)
+			elapsed = time.perf_counter () - start
+			if best is None or elapsed < best:
+				best = elapsed
+		results.append ((count, best))
+	return results
+
+# benchmarkSharedRing times a Trade recording generated trades one at a time into a shared trade ring, while reader
+# processes calculate Volume Weighted Stock Prices and the All Share Index from the ring as fast as they can
+# arg args : the parsed command line arguments
+# returns a list of result dictionaries as given by Timer.result
+def benchmarkSharedRing (args):
+	stocks = generateStocks (args.symbols, args.seed)
+	start = datetime.datetime (2020, 1, 2, 8)
+	ring = SharedTradeRing (capacity = args.ring_capacity, stocks = max (4096, args.symbols))
+	context = multiprocessing.get_context ("fork")
+	finished = context.Event ()
+	counts = context.Queue ()
+	# readers calculate at the time of the last trade, so their windows fill up as the trades are written
+	end = start + datetime.timedelta (seconds = args.trades / args.rate)
+	def read (seed):
+		rng = random.Random (seed)
+		shared = SharedTradeRing (ring.name ())
+		reader = Trade (shared = shared, clock = SimulatedClock (end))
+		prices = indexes = 0
+		priceSeconds = indexSeconds = 0.0
+		while not finished.is_set ():
+			chosen = [stocks [rng.randrange (len (stocks))] for i in range (100)]
+			begin = time.perf_counter ()
+			for stock in chosen:
+				reader.volumeWeightedStockPrice (stock)
+			middle = time.perf_counter ()
+			reader.GBCEAllShareIndex ()
+			indexSeconds += time.perf_counter () - middle
+			priceSeconds += middle - begin
+			prices += len (chosen)
+			indexes += 1
+		counts.put ((prices, priceSeconds, indexes, indexSeconds))
+		shared.close ()
+	readers = [context.Process (target = read, args = (args.seed + i,)) for i in range (args.shared_readers)]
+	results = []
+	try:
+		for process in readers:
+			process.start ()
+		t = Trade (shared = ring, clock = SimulatedClock (start))
+		timer = Timer ("recordTrade shared ring %d readers" % args.shared_readers)
+		for batch in generateTrades (stocks, args.trades, args.seed, args.distribution, start, args.rate, args.skew, args.chunk_size):
+			trades = list (zip (batch.stocks (), batch.quantities (), batch.sides (), batch.prices (), map (fromEpoch, batch.timestamps ())))
+			begin = time.perf_counter ()
+			for trade in trades:
+				t.recordTrade (*trade)
+			timer.timeBulk (len (trades), time.perf_counter () - begin)
+		results.append (timer.result ())
+		finished.set ()
+		prices = Timer ("shared ring volumeWeightedStockPrice %d readers" % args.shared_readers)
+		indexes = Timer ("shared ring GBCEAllShareIndex %d readers" % args.shared_readers)
+		for process in readers:
+			priceCount, priceSeconds, indexCount, indexSeconds = counts.get (timeout = 60)
+			prices.timeBulk (priceCount, priceSeconds)
+			indexes.timeBulk (indexCount, indexSeconds)
+		results.extend ([prices.result (), indexes.result ()])
+	finally:
+		finished.set ()
+		for process in readers:
+			process.join (10)
+			if process.is_alive ():
+				process.terminate ()
+				process.join ()
+		ring.close ()
+		ring.unlink ()
+	return results
+
+# benchmark records generated trades into a Trade and times its methods
+# arg args : the parsed command line arguments
+# returns a list of result dictionaries as given by Timer.result
+def benchmark (args):
+	rng = random.Random (args.seed)
+	stocks = generateStocks (args.symbols, args.seed)
+	retention = None
+	if args.horizon is not None:
+		retention = RetentionPolicy (horizon = datetime.timedelta (seconds = args.horizon))
+	clock = SimulatedClock ()
+	t = Trade (streaming = args.streaming, columnar = args.columnar, clock = clock, retention = retention)
+	trades = generateTrades (stocks, args.trades, args.seed, args.distribution, rate = args.rate, skew = args.skew,
+		chunkSize = args.chunk_size)
+	results = []
+
+	# the first chunk is recorded a trade at a time, the rest in bulk
+	first = next (trades)
+	samples = min (args.samples, len (first))
+	timer = Timer ("recordTrade")
+	timer.time (t.recordTrade, zip (first.stocks () [:samples], first.quantities () [:samples], first.sides () [:samples],
+		first.prices () [:samples], map (fromEpoch, first.timestamps () [:samples])))
+	results.append (timer.result ())
+	timer = Timer ("recordTrades")
+	start = time.perf_counter ()
+	t.recordTrades (first.slice (samples, len (first)))
+	timer.timeBulk (len (first) - samples, time.perf_counter () - start)
+	for batch in trades:
+		start = time.perf_counter ()
+		t.recordTrades (batch)
+		timer.timeBulk (len (batch), time.perf_counter () - start)
+	results.append (timer.result ())
+
+	chosen = [stocks [rng.randrange (len (stocks))] for i in range (args.samples)]
+	timer = Timer ("volumeWeightedStockPrice")
+	timer.time (t.volumeWeightedStockPrice, [(stock,) for stock in chosen])
+	results.append (timer.result ())
+	if args.window is not None:
+		window = datetime.timedelta (seconds = args.window)
+		timer = Timer ("volumeWeightedStockPrice window %gs" % args.window)
+		timer.time (t.volumeWeightedStockPrice, [(stock, window) for stock in chosen])
+		results.append (timer.result ())
+
+	timer = Timer ("exportTrades all")
+	timer.time (t.exportTrades, [(fromEpoch (0), clock.now () + datetime.timedelta (seconds=1))])
+	results.append (timer.result ())
+	timer = Timer ("packSnapshot")
+	timer.time (t.packSnapshot, [()])
+	results.append (timer.result ())
+	timer = Timer ("snapshot")
+	timer.time (t.snapshot, [() for i in range (max (1, args.samples // 1000))])
+	results.append (timer.result ())
+
+	# each All Share Index calculation follows a trade, so it has a stock to update, the trade is not timed
+	now = clock.now ()
+	timer = Timer ("GBCEAllShareIndex")
+	def trade (stock):
+		t.recordTrade (stock, 100, BuyOrSell.Buy, 50.0, now)
+	timer.time (lambda stock: t.GBCEAllShareIndex (), [(stock,) for stock in chosen], setup = trade)
+	results.append (timer.result ())
+
+	prices = [round (rng.uniform (1, 200), 2) for i in range (args.samples)]
+	timer = Timer ("dividendYield")
+	timer.time (t.dividendYield, zip (chosen, prices))
+	results.append (timer.result ())
+	timer = Timer ("PERatio")
+	timer.time (t.PERatio, zip (chosen, prices))
+	results.append (timer.result ())
+
+	if args.shared_readers > 0:
+		results.extend (benchmarkSharedRing (args))
+	for processes, seconds in benchmarkShardedIndex (t, args.processes, repeat = 1):
+		timer = Timer ("shardedGBCEAllShareIndex %d processes" % processes)
+		timer.timeBulk (1, seconds)
+		results.append (timer.result ())
+	return results
+
+# main method
+# run benchmarks
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser (description = "Benchmark Trade with seeded synthetic trades")
+	parser.add_argument ("--trades", type = int, default = 1000000, help = "number of trades to generate")
+	parser.add_argument ("--symbols", type = int, default = 100, help = "number of stocks")
+	parser.add_argument ("--seed", type = int, default = 1, help = "seed for the random numbers")
+	parser.add_argument ("--distribution", choices = DISTRIBUTIONS, default = "lognormal", help = "distribution of prices")
+	parser.add_argument ("--rate", type = float, default = 1000.0, help = "trades per second of trade time")
+	parser.add_argument ("--skew", type = float, default = 0.0, help = "most seconds a timestamp is out of order by")
+	parser.add_argument ("--chunk-size", type = int, default = 65536, help = "trades generated and recorded at a time")
+	parser.add_argument ("--samples", type = int, default = 10000, help = "calls timed one at a time for each method")
+	parser.add_argument ("--window", type = float, default = None, help = "also time prices over a window of this many seconds")
+	parser.add_argument ("--columnar", action = "store_true", help = "keep trades in columns")
+	parser.add_argument ("--streaming", action = "store_true", help = "keep running five minute window totals")
+	parser.add_argument ("--horizon", type = float, default = None, help = "seconds of trade records to retain")
+	parser.add_argument ("--processes", type = int, nargs = "*", default = [], help = "numbers of worker processes for the sharded index, 0 for in process")
+	parser.add_argument ("--shared-readers", type = int, default = 0, help = "also time recording into a shared ring with this many reader processes")
+	parser.add_argument ("--ring-capacity", type = int, default = 1048576, help = "trades kept in the shared ring")
+	parser.add_argument ("--tracemalloc", action = "store_true", help = "trace peak Python memory for each method, slows everything down")
+	parser.add_argument ("--output", default = None, help = "file to write JSON results to, defaults to standard output")
+	args = parser.parse_args ()
+	if args.tracemalloc:
+		tracemalloc.start ()
+	report = {
+		"python" : platform.python_version (),
+		"platform" : platform.platform (),
+		"cpus" : os.cpu_count (),
+		"started" : datetime.datetime.now ().isoformat (),
+		"config" : vars (args),
+		"results" : benchmark (args) }
+	if args.output is None:
+		json.dump (report, sys.stdout, indent = 1)
+		print ()
+	else:
+		with open (args.output, "w") as f:
+			json.dump (report, f, indent = 1)
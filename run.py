@@ -1,7 +1,72 @@
 # Iain Robertson
 
+import os
 import sys
+import time
+import csv
+import math
+import collections
+import mmap
+import struct
+import array
+import operator
+import itertools
+import bisect
+import heapq
+import gc
 import datetime
+import tempfile
+import threading
+import contextlib
+import asyncio
+import multiprocessing
+import multiprocessing.shared_memory
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # optional, only needed to export trades as NumPy arrays
+
+# start of the epoch, used to convert timestamps to seconds for columnar storage
+EPOCH = datetime.datetime (1970, 1, 1)
+
+# toEpoch converts a naive date and time to seconds since the epoch
+# arg timestamp : the date and time to convert
+def toEpoch (timestamp):
+	return (timestamp - EPOCH).total_seconds ()
+
+# fromEpoch converts seconds since the epoch to a naive date and time
+# arg seconds : the seconds since the epoch to convert
+def fromEpoch (seconds):
+	return EPOCH + datetime.timedelta (seconds=seconds)
+
+# lock used when trades are only recorded from one thread, does nothing
+NO_LOCK = contextlib.nullcontext ()
+
+# pausedCollection pauses the cyclic garbage collector while many objects which cannot form reference cycles are
+# created in one go, as each collection run while they are created would otherwise scan every trade already recorded.
+# The collector is left disabled if it was disabled before.
+@contextlib.contextmanager
+def pausedCollection ():
+	enabled = gc.isenabled ()
+	gc.disable ()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable ()
+
+# layout of a trade in a fixed width binary trade file : symbol padded with nulls to 8 bytes,
+# timestamp as seconds since the epoch, quantity, buy or sell indicator and price, little endian
+TRADE_RECORD = struct.Struct ("<8sddbd")
+
+# layout of a binary snapshot, as written by Trade.packSnapshot : a header of magic, time of the snapshot as seconds
+# since the epoch, GBCE All Share Index and number of stocks, then for each stock its symbol padded with nulls to
+# 8 bytes, Volume Weighted Stock Price, Volume Weighted Stock Price and volume of buys then of sells, number of
+# trades, and highest and lowest price, NaN if there are none, little endian
+SNAPSHOT_MAGIC = b"GBCESNAP"
+SNAPSHOT_HEADER = struct.Struct ("<8sddQ")
+SNAPSHOT_STOCK = struct.Struct ("<8sdddddQdd")
 
 # Type class to act as enum for stock type
 class Type:
@@ -13,6 +78,15 @@ class BuyOrSell:
 	Buy = 0
 	Sell = 1
 	
+# ErrorCode class to act as enum for the cause of failure of each result of a batch calculation
+class ErrorCode:
+	NoError = 0
+	Arithmetic = 1 # ArithmeticError, such as division by zero or overflow
+	Type = 2 # TypeError, from a null or non-numeric value
+	UnknownStockType = 3
+	NegativeValue = 4
+	Other = 5
+
 # NegativeValueError custom exception to be raised when negative values occur
 class NegativeValueError (Exception):
 	# NegativeValueError constructor
@@ -27,6 +101,78 @@ class UnknownStockTypeError (Exception):
 	def __init__ (self):
 		super (Exception, self).__init__ ("Unknown Stock Type Error")
 		
+# UnknownSymbolError custom exception to be raised when a trade is for a symbol with no Stock
+class UnknownSymbolError (Exception):
+	# UnknownSymbolError constructor
+	# initialize base class exception with error message
+	# arg symbol : the unknown symbol
+	def __init__ (self, symbol):
+		super (Exception, self).__init__ ("Unknown Symbol Error %s" % symbol)
+
+# JournalError custom exception to be raised when a trade journal cannot be used
+class JournalError (Exception):
+	# JournalError constructor
+	# initialize base class exception with error message
+	# arg reason : why the journal cannot be used
+	def __init__ (self, reason):
+		super (Exception, self).__init__ ("Journal Error %s" % reason)
+
+# SharedRingError custom exception to be raised when a shared trade ring cannot be used
+class SharedRingError (Exception):
+	# SharedRingError constructor
+	# initialize base class exception with error message
+	# arg reason : why the ring cannot be used
+	def __init__ (self, reason):
+		super (Exception, self).__init__ ("Shared Ring Error %s" % reason)
+
+# ReferenceFileError custom exception to be raised when a stock reference file cannot be read
+class ReferenceFileError (Exception):
+	# ReferenceFileError constructor
+	# initialize base class exception with error message
+	# arg path : the path of the file
+	# arg line : the number of the line that cannot be read, from 1
+	# arg reason : why the line cannot be read
+	def __init__ (self, path, line, reason):
+		super (Exception, self).__init__ ("Reference File Error %s line %d %s" % (path, line, reason))
+		self.path = path
+		self.line = line
+
+# TradeFileError custom exception to be raised when a trade file cannot be read
+class TradeFileError (Exception):
+	# TradeFileError constructor
+	# initialize base class exception with error message
+	# arg path : the path of the file
+	# arg line : the number of the line that cannot be read, from 1
+	# arg reason : why the line cannot be read
+	def __init__ (self, path, line, reason):
+		super (Exception, self).__init__ ("Trade File Error %s line %d %s" % (path, line, reason))
+		self.path = path
+		self.line = line
+
+# InvalidStockError custom exception to be raised when a stock is rejected by a StockRegistry
+class InvalidStockError (Exception):
+	# InvalidStockError constructor
+	# initialize base class exception with error message
+	# arg symbol : the symbol of the stock
+	# arg code : the ErrorCode of the failure found in the stock's data
+	def __init__ (self, symbol, code):
+		super (Exception, self).__init__ ("Invalid Stock Error %s %d" % (symbol, code))
+		self.symbol = symbol
+		self.code = code
+
+# errorCode returns the ErrorCode for an exception raised by a calculation
+# arg e : the exception raised
+def errorCode (e):
+	if isinstance (e, ArithmeticError):
+		return ErrorCode.Arithmetic
+	if isinstance (e, TypeError):
+		return ErrorCode.Type
+	if isinstance (e, UnknownStockTypeError):
+		return ErrorCode.UnknownStockType
+	if isinstance (e, NegativeValueError):
+		return ErrorCode.NegativeValue
+	return ErrorCode.Other
+
 # Stock class to act as data object for individual stock data
 class Stock:
 	# Stock constructor, initializes class members
@@ -62,8 +208,144 @@ class Stock:
 	def parValue (self):
 		return self._parValue 
 		
+# dividendTerm calculates the term divided by price to give the dividend yield for a stock,
+# last dividend for Common stock or fixed dividend times par value for Preferred stock
+# arg stock : the Stock object whose dividend term is to be calculated
+# returns the term as a float, or None for failure, and the ErrorCode of any failure
+def dividendTerm (stock):
+	try:
+		if stock.type () == Type.Common:
+			return 0.0 + stock.lastDividend (), ErrorCode.NoError
+		elif stock.type () == Type.Preferred:
+			return 0.0 + stock.fixedDividend () * stock.parValue (), ErrorCode.NoError
+		# should be either Common or Preferred
+		raise UnknownStockTypeError ()
+	except Exception as e:
+		return None, errorCode (e)
+
+# earningsTerm calculates the term price is divided by to give the P/E Ratio for a stock, the last dividend
+# arg stock : the Stock object whose earnings term is to be calculated
+# returns the term as a float, or None for failure, and the ErrorCode of any failure
+def earningsTerm (stock):
+	try:
+		return 0.0 + stock.lastDividend (), ErrorCode.NoError
+	except Exception as e:
+		return None, errorCode (e)
+
+# StockRegistry class to hold validated stocks, each with a compact integer id, and the terms their dividend
+# yield and P/E Ratio are calculated from, worked out once when the stock is registered
+class StockRegistry:
+	# StockRegistry constructor
+	# initialize with no stocks
+	def __init__ (self):
+		self._stocks = [] # stocks in order of registration, a stock's position is its id
+		self._ids = { } # maps symbol to id
+		self._terms = { } # maps Stock to (dividend term, earnings term)
+		self._dividendTerms = array.array ("d") # dividend term by id
+		self._earningsTerms = array.array ("d") # earnings term by id
+
+	# returns the number of stocks registered
+	def __len__ (self):
+		return len (self._stocks)
+
+	# register validates a stock and adds it to the registry
+	# arg stock : the Stock to register
+	# raises InvalidStockError if the stock's dividend yield or P/E Ratio cannot be calculated for any price, or
+	# another stock with the same symbol is registered
+	# returns the stock's id
+	def register (self, stock):
+		id = self._ids.get (stock.symbol ())
+		if id is not None:
+			if self._stocks [id] is stock:
+				return id
+			raise InvalidStockError (stock.symbol (), ErrorCode.Other)
+		dividend, code = dividendTerm (stock)
+		if code == ErrorCode.NoError:
+			earnings, code = earningsTerm (stock)
+		if code == ErrorCode.NoError and (dividend < 0 or earnings < 0):
+			code = ErrorCode.NegativeValue
+		if code != ErrorCode.NoError:
+			raise InvalidStockError (stock.symbol (), code)
+		id = len (self._stocks)
+		self._stocks.append (stock)
+		self._ids [stock.symbol ()] = id
+		self._terms [stock] = (dividend, earnings)
+		self._dividendTerms.append (dividend)
+		self._earningsTerms.append (earnings)
+		return id
+
+	# load registers the stocks in a CSV reference file
+	# each row holds symbol, type as Common or Preferred, last dividend, fixed dividend and par value, empty for none
+	# the whole file is read before any stock is registered, so a file that cannot be read registers none
+	# arg path : the path of the file
+	# arg header : True if the first row of the file is a header to skip
+	# raises ReferenceFileError for a row without five fields or a line that is not CSV
+	# returns a list of InvalidStockError for each stock rejected
+	def load (self, path, header = True):
+		types = { "Common" : Type.Common, "Preferred" : Type.Preferred }
+		stocks = []
+		with open (path, newline = "") as f:
+			rows = csv.reader (f)
+			try:
+				if header:
+					next (rows, None)
+				for row in rows:
+					if len (row) != 5:
+						raise ReferenceFileError (path, rows.line_num, "has %d fields, not 5" % len (row))
+					symbol, type, lastDividend, fixedDividend, parValue = row
+					values = []
+					for value in (lastDividend, fixedDividend, parValue):
+						try:
+							values.append (float (value) if value.strip () else None)
+						except ValueError:
+							values.append (value) # rejected as non-numeric
+					stocks.append (Stock (symbol, types.get (type, type), *values))
+			except csv.Error as e:
+				raise ReferenceFileError (path, rows.line_num, str (e))
+		rejected = []
+		for stock in stocks:
+			try:
+				self.register (stock)
+			except InvalidStockError as e:
+				rejected.append (e)
+		return rejected
+
+	# returns the id of the stock with a symbol, or None if no stock with the symbol is registered
+	def id (self, symbol):
+		return self._ids.get (symbol)
+
+	# returns the stock with an id
+	def stock (self, id):
+		return self._stocks [id]
+
+	# returns a dictionary mapping symbol to Stock for every stock registered
+	def stocks (self):
+		return dict ((stock.symbol (), stock) for stock in self._stocks)
+
+	# terms returns the dividend and earnings terms of a registered stock
+	# arg stock : the Stock
+	# returns a tuple of the dividend term and the earnings term, or None if the stock is not registered
+	def terms (self, stock):
+		return self._terms.get (stock)
+
+	# returns the dictionary mapping each registered Stock to a tuple of its dividend term and earnings term,
+	# which is kept up to date as stocks are registered
+	def termsByStock (self):
+		return self._terms
+
+	# returns the dividend term of every stock, indexed by id
+	def dividendTerms (self):
+		return self._dividendTerms
+
+	# returns the earnings term of every stock, indexed by id
+	def earningsTerms (self):
+		return self._earningsTerms
+
 # TradeRecord class to act as data object for an individual trade
+# slots are used so that a trade record does not carry a dictionary of members
 class TradeRecord:
+	__slots__ = ("_stock", "_timestamp", "_quantity", "_buyorsell", "_price")
+
 	# TradeRecord constructor, initializes class members
 	# arg stock : the stock traded
 	# arg timestamp : the date and time of the trade
@@ -93,22 +375,1987 @@ class TradeRecord:
 	def price (self):
 		return self._price
 
+	# returns BuyOrSell enum indicating whether trade was buy or sell
+	def buyOrSell (self):
+		return self._buyorsell
+
+# TradeBatch class to act as data object for a number of trades held as columns
+class TradeBatch:
+	# TradeBatch constructor, initializes class members
+	# arg stocks : a sequence of the stocks traded
+	# arg timestamps : a sequence of the dates and times of the trades as seconds since the epoch
+	# arg quantities : a sequence of the quantities of stock traded
+	# arg sides : a sequence of BuyOrSell enums indicating whether trades were buy or sell
+	# arg prices : a sequence of the prices of the trades
+	# arg datetimes : a sequence of the dates and times of the trades, or None. If given, timestamps may be None and
+	# are then only worked out from datetimes when asked for
+	def __init__ (self, stocks, timestamps, quantities, sides, prices, datetimes = None):
+		self._stocks = stocks
+		self._timestamps = timestamps
+		self._quantities = quantities
+		self._sides = sides
+		self._prices = prices
+		self._datetimes = datetimes
+
+	# returns the number of trades in the batch
+	def __len__ (self):
+		return len (self._stocks)
+
+	# returns the stocks traded
+	def stocks (self):
+		return self._stocks
+
+	# returns the timestamps of the trades as seconds since the epoch
+	def timestamps (self):
+		if self._timestamps is None:
+			self._timestamps = list (map (toEpoch, self._datetimes))
+		return self._timestamps
+
+	# returns the dates and times of the trades if the batch was made with them, otherwise None
+	def datetimes (self):
+		return self._datetimes
+
+	# returns the quantities of stock traded
+	def quantities (self):
+		return self._quantities
+
+	# returns the buy or sell indicators of the trades
+	def sides (self):
+		return self._sides
+
+	# returns the prices of the trades
+	def prices (self):
+		return self._prices
+
+	# slice returns a batch of the trades in a range of positions
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	def slice (self, lo, hi):
+		return TradeBatch (*[None if column is None else column [lo:hi] for column in
+			(self._stocks, self._timestamps, self._quantities, self._sides, self._prices, self._datetimes)])
+
+	# select returns a batch of the trades for which a flag is set
+	# arg flags : a sequence of flags, one per trade
+	def select (self, flags):
+		return TradeBatch (*[None if column is None else list (itertools.compress (column, flags)) for column in
+			(self._stocks, self._timestamps, self._quantities, self._sides, self._prices, self._datetimes)])
+
+# readCsvTrades reads a CSV trade file a chunk of rows at a time, without reading the whole file
+# each row holds symbol, timestamp as seconds since the epoch, quantity, buy or sell indicator and price,
+# blank lines are skipped
+# arg path : the path of the file
+# arg chunkSize : the number of trades in each chunk
+# arg header : True if the first row of the file is a header to skip
+# raises TradeFileError for a row without five fields, a field that is not a number or a line that is not CSV,
+# when the chunk holding it is read, so chunks before it will have been yielded
+# yields tuples of symbol, timestamp, quantity, buy or sell indicator and price columns
+def readCsvTrades (path, chunkSize = 65536, header = False):
+	with open (path, newline = "") as f:
+		rows = csv.reader (f)
+		try:
+			if header:
+				next (rows, None)
+			chunk = []
+			lines = [] # the line each row in the chunk ends on
+			for row in rows:
+				if not row:
+					continue
+				if len (row) != 5:
+					raise TradeFileError (path, rows.line_num, "has %d fields, not 5" % len (row))
+				chunk.append (row)
+				lines.append (rows.line_num)
+				if len (chunk) == chunkSize:
+					yield csvTradeColumns (path, chunk, lines)
+					chunk = []
+					lines = []
+		except csv.Error as e:
+			raise TradeFileError (path, rows.line_num, str (e))
+		if chunk:
+			yield csvTradeColumns (path, chunk, lines)
+
+# csvTradeColumns converts rows read from a CSV trade file to columns
+# arg path : the path of the file
+# arg chunk : a list of rows of five fields
+# arg lines : a list of the line each row ends on
+# raises TradeFileError for a field that is not a number
+# returns a tuple of symbol, timestamp, quantity, buy or sell indicator and price columns
+def csvTradeColumns (path, chunk, lines):
+	symbols, timestamps, quantities, sides, prices = zip (*chunk)
+	try:
+		return symbols, list (map (float, timestamps)), list (map (float, quantities)), list (map (int, sides)), list (map (float, prices))
+	except ValueError:
+		pass
+	# find the first row that cannot be converted
+	for row, line in zip (chunk, lines):
+		try:
+			float (row [1]), float (row [2]), int (row [3]), float (row [4])
+		except ValueError as e:
+			raise TradeFileError (path, line, str (e))
+
+# unpackTrades unpacks TRADE_RECORD trades into columns
+# arg data : a buffer holding whole TRADE_RECORD trades
+# arg names : a dictionary mapping padded symbol bytes to symbol, added to for new symbols
+# returns a tuple of symbol, timestamp, quantity, buy or sell indicator and price columns
+def unpackTrades (data, names):
+	symbols, timestamps, quantities, sides, prices = zip (*TRADE_RECORD.iter_unpack (data))
+	for symbol in dict.fromkeys (symbols):
+		if not symbol in names:
+			names [symbol] = symbol.rstrip (b"\0").decode ("ascii")
+	return list (map (names.__getitem__, symbols)), timestamps, quantities, sides, prices
+
+# unpackSnapshot reads a binary snapshot written by Trade.packSnapshot
+# arg data : the bytes of the snapshot
+# raises ValueError if the data is not a snapshot
+# returns a dictionary as returned by Trade.snapshot
+def unpackSnapshot (data):
+	try:
+		magic, time, allShareIndex, count = SNAPSHOT_HEADER.unpack_from (data, 0)
+		if magic != SNAPSHOT_MAGIC or len (data) != SNAPSHOT_HEADER.size + count * SNAPSHOT_STOCK.size:
+			raise ValueError ("not a trade snapshot")
+		stocks = { }
+		for symbol, price, buyPrice, buyVolume, sellPrice, sellVolume, trades, high, low in \
+				SNAPSHOT_STOCK.iter_unpack (data [SNAPSHOT_HEADER.size:]):
+			stocks [symbol.rstrip (b"\0").decode ("ascii")] = {
+				"volumeWeightedStockPrice" : price,
+				"buyVolumeWeightedStockPrice" : buyPrice,
+				"buyVolume" : buyVolume,
+				"sellVolumeWeightedStockPrice" : sellPrice,
+				"sellVolume" : sellVolume,
+				"trades" : trades,
+				"high" : None if math.isnan (high) else high,
+				"low" : None if math.isnan (low) else low }
+	except struct.error:
+		raise ValueError ("not a trade snapshot")
+	return { "time" : fromEpoch (time), "allShareIndex" : allShareIndex, "stocks" : stocks }
+
+# readBinaryTrades reads a fixed width binary trade file of TRADE_RECORD trades a chunk at a time,
+# without reading the whole file
+# arg path : the path of the file
+# arg chunkSize : the number of trades in each chunk
+# yields tuples of symbol, timestamp, quantity, buy or sell indicator and price columns
+def readBinaryTrades (path, chunkSize = 65536):
+	names = { } # maps padded symbol bytes to symbol
+	with open (path, "rb") as f:
+		while True:
+			data = f.read (chunkSize * TRADE_RECORD.size)
+			if not data:
+				return
+			yield unpackTrades (data, names)
+
+# resolveSymbols turns chunks of trade columns into trade batches, looking up the Stock for each symbol
+# arg chunks : an iterable of tuples of symbol, timestamp, quantity, buy or sell indicator and price columns
+# arg stocks : a dictionary mapping symbol to Stock
+# raises UnknownSymbolError for a symbol with no Stock
+# yields a TradeBatch per chunk
+def resolveSymbols (chunks, stocks):
+	for symbols, timestamps, quantities, sides, prices in chunks:
+		try:
+			resolved = list (map (stocks.__getitem__, symbols))
+		except KeyError as e:
+			raise UnknownSymbolError (e.args [0])
+		yield TradeBatch (resolved, timestamps, quantities, sides, prices)
+
+# TradeJournal class to keep an append-only journal of trades as TRADE_RECORD records in a memory mapped file,
+# so a Trade can be rebuilt after a restart. The file starts with a header holding the number of records
+# written, updated after each append, and the mapping is flushed to disk after every so many records, so
+# a system crash loses at most that many of the latest records.
+#
+# A checkpoint of the Trade using the journal can be written alongside it, holding the journal position it covers
+# and, for each stock, trades outside the window before the checkpoint totalled as compaction totals them and
+# trades inside the window as records. A Trade is then rebuilt from the checkpoint plus the journal records after it.
+class TradeJournal:
+	MAGIC = b"GBCEJRNL"
+	HEADER = struct.Struct ("<8sQ") # magic, number of records
+	CHECKPOINT_MAGIC = b"GBCECKPT"
+	CHECKPOINT_HEADER = struct.Struct ("<8sQQ") # magic, journal position, number of stocks
+	# symbol, amount paid, quantity, number of trades and number at a negative price for trades folded into one total,
+	# number of prices, number of trade records
+	CHECKPOINT_STOCK = struct.Struct ("<8sddQQQQ")
+	CHECKPOINT_PRICE = struct.Struct ("<ddQ") # price, total quantity, number of trades
+
+	# TradeJournal constructor, opens or creates the journal file and maps it
+	# arg path : the path of the journal file
+	# arg syncEvery : the number of records to append between flushes to disk
+	# arg capacity : the number of records to make room for in a new file, the file grows as needed
+	# raises JournalError if the file is not a trade journal
+	def __init__ (self, path, syncEvery = 1024, capacity = 65536):
+		self._checkpointPath = path + ".checkpoint"
+		self._syncEvery = syncEvery
+		self._unsynced = 0
+		self._symbols = { } # maps symbol to padded symbol bytes
+		if os.path.exists (path) and os.path.getsize (path) > 0:
+			self._file = open (path, "r+b")
+		else:
+			self._file = open (path, "w+b")
+			self._file.write (self.HEADER.pack (self.MAGIC, 0))
+			self._file.truncate (self.HEADER.size + capacity * TRADE_RECORD.size)
+		self._map = mmap.mmap (self._file.fileno (), 0)
+		magic, self._count = self.HEADER.unpack_from (self._map, 0)
+		if magic != self.MAGIC:
+			self.close ()
+			raise JournalError ("%s is not a trade journal" % path)
+		self._capacity = (len (self._map) - self.HEADER.size) // TRADE_RECORD.size
+		if self._count > self._capacity:
+			self.close ()
+			raise JournalError ("%s is truncated" % path)
+
+	# returns the number of records in the journal
+	def __len__ (self):
+		return self._count
+
+	# append adds a trade to the journal
+	# arg symbol : the symbol of the stock traded
+	# arg timestamp : the date and time of the trade as seconds since the epoch
+	# arg quantity : the quantity of stock traded
+	# arg buyorsell : BuyOrSell enum indicating whether trade was buy or sell
+	# arg price : the price of the trade
+	def append (self, symbol, timestamp, quantity, buyorsell, price):
+		self._reserve (1)
+		TRADE_RECORD.pack_into (self._map, self._offset (self._count), self._symbol (symbol), timestamp, quantity, buyorsell, price)
+		self._committed (1)
+
+	# appendMany adds a batch of trades to the journal
+	# arg batch : the TradeBatch to add
+	def appendMany (self, batch):
+		count = len (batch)
+		if count == 0:
+			return
+		symbols = { }
+		for stock in dict.fromkeys (batch.stocks ()):
+			symbols [stock] = self._symbol (stock.symbol ())
+		data = b"".join (map (TRADE_RECORD.pack, map (symbols.__getitem__, batch.stocks ()),
+			batch.timestamps (), batch.quantities (), batch.sides (), batch.prices ()))
+		self._reserve (count)
+		offset = self._offset (self._count)
+		self._map [offset:offset + len (data)] = data
+		self._committed (count)
+
+	# chunks reads the journal a chunk of records at a time
+	# arg chunkSize : the number of records in each chunk
+	# arg position : the number of the first record to read
+	# yields tuples of symbol, timestamp, quantity, buy or sell indicator and price columns
+	def chunks (self, chunkSize = 65536, position = 0):
+		names = { } # maps padded symbol bytes to symbol
+		for start in range (position, self._count, chunkSize):
+			end = min (start + chunkSize, self._count)
+			yield unpackTrades (self._map [self._offset (start):self._offset (end)], names)
+
+	# writeCheckpoint replaces the checkpoint alongside the journal
+	# arg position : the number of journal records covered by the checkpoint, which must have been synced
+	# arg stocks : a list of (symbol, folded, totals, columns) tuples, where folded is a tuple of the amount paid,
+	#              quantity, number of trades and number at a negative price for trades folded into one total,
+	#              totals is a list of (price, total quantity, number of trades) tuples for other trades and
+	#              columns is a tuple of timestamp, quantity, side and price columns
+	def writeCheckpoint (self, position, stocks):
+		parts = [self.CHECKPOINT_HEADER.pack (self.CHECKPOINT_MAGIC, position, len (stocks))]
+		for symbol, folded, totals, (timestamps, quantities, sides, prices) in stocks:
+			padded = self._symbol (symbol)
+			parts.append (self.CHECKPOINT_STOCK.pack (padded, *folded, len (totals), len (timestamps)))
+			parts.extend (itertools.starmap (self.CHECKPOINT_PRICE.pack, totals))
+			parts.extend (map (TRADE_RECORD.pack, itertools.repeat (padded), timestamps, quantities, sides, prices))
+		# write to a new file then rename it over the old, so a crash leaves one or the other
+		temporary = self._checkpointPath + ".tmp"
+		with open (temporary, "wb") as f:
+			f.write (b"".join (parts))
+			f.flush ()
+			os.fsync (f.fileno ())
+		os.replace (temporary, self._checkpointPath)
+
+	# readCheckpoint reads the checkpoint alongside the journal
+	# raises JournalError if the checkpoint is not valid for the journal
+	# returns the number of journal records covered and a list of (symbol, folded, totals, columns) tuples
+	# as passed to writeCheckpoint, or 0 and an empty list if there is no checkpoint
+	def readCheckpoint (self):
+		if not os.path.exists (self._checkpointPath):
+			return 0, []
+		with open (self._checkpointPath, "rb") as f:
+			data = f.read ()
+		try:
+			magic, position, count = self.CHECKPOINT_HEADER.unpack_from (data, 0)
+			offset = self.CHECKPOINT_HEADER.size
+			names = { } # maps padded symbol bytes to symbol
+			stocks = []
+			for i in range (count):
+				padded, amount, quantity, folded, negativePrices, prices, trades = self.CHECKPOINT_STOCK.unpack_from (data, offset)
+				offset += self.CHECKPOINT_STOCK.size
+				end = offset + prices * self.CHECKPOINT_PRICE.size
+				totals = list (self.CHECKPOINT_PRICE.iter_unpack (data [offset:end]))
+				offset, end = end, end + trades * TRADE_RECORD.size
+				if trades > 0:
+					columns = unpackTrades (data [offset:end], names) [1:]
+				else:
+					columns = ([], [], [], [])
+				offset = end
+				stocks.append ((padded.rstrip (b"\0").decode ("ascii"), (amount, quantity, folded, negativePrices), totals, columns))
+		except struct.error:
+			raise JournalError ("%s is truncated" % self._checkpointPath)
+		if magic != self.CHECKPOINT_MAGIC or position > self._count or offset != len (data):
+			raise JournalError ("%s is not a checkpoint of this journal" % self._checkpointPath)
+		return position, stocks
+
+	# sync flushes records appended to the journal to disk
+	def sync (self):
+		self._map.flush ()
+		self._unsynced = 0
+
+	# close flushes the journal to disk and closes it
+	def close (self):
+		if not self._map.closed:
+			self._map.flush ()
+			self._map.close ()
+		self._file.close ()
+
+	# _symbol returns a symbol padded to the width of the symbol field in a record
+	# arg symbol : the symbol
+	# raises JournalError if the symbol is too long for a record
+	def _symbol (self, symbol):
+		padded = self._symbols.get (symbol)
+		if padded is None:
+			padded = symbol.encode ("ascii")
+			if len (padded) > 8:
+				raise JournalError ("symbol %s longer than 8 characters" % symbol)
+			self._symbols [symbol] = padded
+		return padded
+
+	# _offset returns the offset in the file of a record
+	# arg record : the number of the record
+	def _offset (self, record):
+		return self.HEADER.size + record * TRADE_RECORD.size
+
+	# _reserve makes sure there is room in the file for more records, doubling its size if not
+	# arg count : the number of records to make room for
+	def _reserve (self, count):
+		if self._count + count <= self._capacity:
+			return
+		while self._count + count > self._capacity:
+			self._capacity = max (1, self._capacity * 2)
+		self._map.flush ()
+		self._map.close ()
+		self._file.truncate (self._offset (self._capacity))
+		self._map = mmap.mmap (self._file.fileno (), 0)
+
+	# _committed updates the number of records in the header after records are written,
+	# flushing to disk if enough records have been appended since the last flush
+	# arg count : the number of records written
+	def _committed (self, count):
+		self._count += count
+		self.HEADER.pack_into (self._map, 0, self.MAGIC, self._count)
+		self._unsynced += count
+		if self._unsynced >= self._syncEvery:
+			self.sync ()
+
+# SharedTradeRing class to keep the most recent trades in shared memory, so processes other than the one recording
+# trades can calculate prices from them without copying them or taking locks. The process that creates the ring
+# writes to it and any number of processes attach to it by name and read. Trades are kept in fixed width columns
+# used as a ring, overwriting the oldest once full, and each stock keeps running totals of every trade written for
+# the All Share Index. Each slot holds the number of the trade in it, which the writer clears while overwriting the
+# slot, so readers can tell a trade they read was not overwritten while they read it. This relies on the writer's
+# stores becoming visible to readers in the order they are made, as they do on x86.
+class SharedTradeRing:
+	MAGIC = b"GBCERING"
+	RETRIES = 1000 # the most times a stock's totals are read again while the writer is changing them
+	HEADER = struct.Struct ("<8sQQQQ") # magic, capacity, most stocks, number of stocks, number of trades written
+	# columns for each trade, as (name, type code) pairs, 8 byte types first so every column is aligned
+	TRADE_COLUMNS = [("sequences", "q"), # the number of the trade in the slot, or -1 while it is written
+		("timestamps", "d"), ("quantities", "d"), ("prices", "d"),
+		("latest", "d"), # the latest timestamp of this trade and every trade written before it
+		("previous", "q"), # the number of the stock's previous trade, or -1
+		("stocks", "I"), ("sides", "b")]
+	# columns for each stock
+	STOCK_COLUMNS = [("last", "q"), # the number of the stock's last trade, or -1
+		("amounts", "d"), ("totalQuantities", "d"),
+		("irregular", "Q"), # the number of trades with a negative price or quantity
+		("versions", "Q")] # odd while the writer is changing the stock's totals
+
+	# SharedTradeRing constructor, creates a ring in new shared memory or attaches to an existing one
+	# arg name : the name of the shared memory to attach to, or None to create a ring to write to
+	# arg capacity : the number of trades a new ring keeps
+	# arg stocks : the most stocks a new ring can hold
+	# raises SharedRingError if the shared memory is not a trade ring
+	def __init__ (self, name = None, capacity = 1048576, stocks = 4096):
+		self._writer = name is None
+		if self._writer:
+			self._memory = multiprocessing.shared_memory.SharedMemory (create = True, size = self._layout (capacity, stocks) [-1])
+			self.HEADER.pack_into (self._memory.buf, 0, self.MAGIC, capacity, stocks, 0, 0)
+		else:
+			self._memory = multiprocessing.shared_memory.SharedMemory (name)
+			magic, capacity, stocks, count, sequence = self.HEADER.unpack_from (self._memory.buf, 0)
+			if magic != self.MAGIC or self._memory.size < self._layout (capacity, stocks) [-1]:
+				self._memory.close ()
+				raise SharedRingError ("%s is not a trade ring" % name)
+		self._capacity = capacity
+		self._maxStocks = stocks
+		offsets = self._layout (capacity, stocks)
+		buffer = self._memory.buf
+		self._views = [buffer [24:40].cast ("Q")] # number of stocks and number of trades written
+		for (column, code), offset, end in zip (self.TRADE_COLUMNS + self.STOCK_COLUMNS, offsets, offsets [1:]):
+			view = buffer [offset:end].cast (code)
+			setattr (self, "_" + column, view)
+			self._views.append (view)
+		self._symbolBytes = buffer [offsets [-2]:offsets [-1]]
+		self._views.append (self._symbolBytes)
+		self._counts = self._views [0]
+		self._stockIds = { } # maps symbol to the stock's position in the stock columns
+		self._latestTime = None # the latest timestamp written, kept by the writer
+
+	# _layout works out where each column starts in the shared memory
+	# arg capacity : the number of trades the ring keeps
+	# arg stocks : the most stocks the ring can hold
+	# returns a list of offsets of the trade columns, the stock columns and the symbols, then the size of the memory
+	def _layout (self, capacity, stocks):
+		offsets = []
+		offset = self.HEADER.size
+		for columns, count in [(self.TRADE_COLUMNS, capacity), (self.STOCK_COLUMNS, stocks)]:
+			for column, code in columns:
+				offset = (offset + 7) // 8 * 8
+				offsets.append (offset)
+				offset += count * struct.calcsize (code)
+		offsets.append (offset)
+		offsets.append (offset + stocks * 8) # symbols padded with nulls to 8 bytes
+		return offsets
+
+	# returns the name to attach to the ring by from other processes
+	def name (self):
+		return self._memory.name
+
+	# returns True if this is the process writing to the ring
+	def writer (self):
+		return self._writer
+
+	# returns the number of trades the ring keeps
+	def capacity (self):
+		return self._capacity
+
+	# returns the number of trades written to the ring, including those since overwritten
+	def __len__ (self):
+		return self._counts [1]
+
+	# append writes a trade to the ring, overwriting the oldest trade if the ring is full
+	# arg symbol : the symbol of the stock traded
+	# arg timestamp : the date and time of the trade as seconds since the epoch
+	# arg quantity : the quantity of stock traded
+	# arg buyorsell : BuyOrSell enum indicating whether trade was buy or sell
+	# arg price : the price of the trade
+	# raises SharedRingError if this process did not create the ring, or the ring has no room for a new stock
+	# raises TypeError if the price or quantity is not a number, leaving the ring unchanged
+	def append (self, symbol, timestamp, quantity, buyorsell, price):
+		if not self._writer:
+			raise SharedRingError ("%s can only be written by the process that created it" % self.name ())
+		# convert every field before the ring is changed, so a bad one cannot overwrite the oldest trade
+		timestamp, quantity, price = array.array ("d", (timestamp, quantity, price))
+		buyorsell, = array.array ("b", (buyorsell,))
+		stock = self._stockIds.get (symbol)
+		if stock is None:
+			stock = self._addStock (symbol)
+		sequence = self._counts [1]
+		position = sequence % self._capacity
+		# clear the slot's trade number first, so readers of the trade it held see it has gone
+		self._sequences [position] = -1
+		self._quantities [position] = quantity
+		self._prices [position] = price
+		self._timestamps [position] = timestamp
+		if self._latestTime is None or timestamp > self._latestTime:
+			self._latestTime = timestamp
+		self._latest [position] = self._latestTime
+		self._sides [position] = buyorsell
+		self._stocks [position] = stock
+		self._previous [position] = self._last [stock]
+		self._sequences [position] = sequence
+		self._versions [stock] += 1
+		self._last [stock] = sequence
+		self._amounts [stock] += price * quantity
+		self._totalQuantities [stock] += quantity
+		if price < 0 or quantity < 0:
+			self._irregular [stock] += 1
+		self._versions [stock] += 1
+		self._counts [1] = sequence + 1
+
+	# appendMany writes a batch of trades to the ring
+	# arg batch : the TradeBatch to write
+	# raises SharedRingError if this process did not create the ring, or the ring has no room for a new stock
+	# raises TypeError if a price or quantity is not a number, the trades before it will have been written
+	def appendMany (self, batch):
+		if not self._writer:
+			raise SharedRingError ("%s can only be written by the process that created it" % self.name ())
+		for stock, timestamp, quantity, side, price in zip (batch.stocks (), batch.timestamps (), batch.quantities (),
+				batch.sides (), batch.prices ()):
+			self.append (stock.symbol (), timestamp, quantity, side, price)
+
+	# _addStock adds a stock to the stock columns
+	# arg symbol : the symbol of the stock
+	# raises SharedRingError if the symbol is too long or there is no room
+	# returns the stock's position in the stock columns
+	def _addStock (self, symbol):
+		padded = symbol.encode ("ascii")
+		if len (padded) > 8:
+			raise SharedRingError ("symbol %s longer than 8 characters" % symbol)
+		stock = self._counts [0]
+		if stock >= self._maxStocks:
+			raise SharedRingError ("no room for stock %s" % symbol)
+		self._symbolBytes [stock * 8:stock * 8 + len (padded)] = padded
+		self._last [stock] = -1
+		self._counts [0] = stock + 1
+		self._stockIds [symbol] = stock
+		return stock
+
+	# _stockId looks up the position of a stock in the stock columns, reading any stocks added by the writer
+	# arg symbol : the symbol of the stock
+	# returns the stock's position, or None if it has not been traded
+	def _stockId (self, symbol):
+		stock = self._stockIds.get (symbol)
+		if stock is None:
+			self._readStocks ()
+			stock = self._stockIds.get (symbol)
+		return stock
+
+	# _readStocks reads the symbols of stocks added by the writer since they were last read
+	def _readStocks (self):
+		for stock in range (len (self._stockIds), self._counts [0]):
+			self._stockIds [bytes (self._symbolBytes [stock * 8:stock * 8 + 8]).rstrip (b"\0").decode ("ascii")] = stock
+
+	# recentTrades totals the quantities by price of a stock's trades between two times, following the stock's
+	# trades back from its last. Only trades still in the ring are found, so the ring should be large enough to keep
+	# every trade in the longest window read. A trade overwritten before or while it is read has gone, and so have
+	# all the stock's trades before it, as the ring is overwritten oldest first, so reading never has to start again.
+	# arg symbol : the symbol of the stock
+	# arg start : the exclusive lower bound of the time range, as seconds since the epoch
+	# arg end : the exclusive upper bound of the time range, as seconds since the epoch
+	# returns a dictionary mapping price to total quantity
+	def recentTrades (self, symbol, start, end):
+		stock = self._stockId (symbol)
+		if stock is None:
+			return { }
+		capacity = self._capacity
+		sequences, timestamps, quantities, prices, latest, previous = (self._sequences, self._timestamps, self._quantities,
+			self._prices, self._latest, self._previous)
+		trades = { }
+		current = self._last [stock]
+		while current >= 0:
+			position = current % capacity
+			if sequences [position] != current:
+				break
+			timestamp, quantity, price = timestamps [position], quantities [position], prices [position]
+			before, earlier = latest [position], previous [position]
+			if sequences [position] != current:
+				# overwritten while it was read
+				break
+			if before <= start:
+				# this trade and every trade written before it are too old
+				break
+			if start < timestamp < end:
+				trades [price] = trades.get (price, 0.0) + quantity
+			current = earlier
+		return trades
+
+	# changedTotals reads the running totals of stocks traded since they were last read
+	# arg versions : a dictionary mapping symbol to the version of the stock's totals last read, updated with
+	#                the versions read
+	# returns a list of (symbol, total amount paid, total quantity, number of trades with a negative price or
+	# quantity) tuples. A stock whose totals were changing every time they were read is left for the next call
+	def changedTotals (self, versions):
+		self._readStocks ()
+		changed = []
+		for symbol, stock in self._stockIds.items ():
+			version = self._versions [stock]
+			if versions.get (symbol) == version:
+				continue
+			for retry in range (self.RETRIES):
+				if version % 2 == 0:
+					totals = (symbol, self._amounts [stock], self._totalQuantities [stock], self._irregular [stock])
+					if self._versions [stock] == version:
+						versions [symbol] = version
+						changed.append (totals)
+						break
+				# let the writer finish, it may be waiting for this process's CPU
+				time.sleep (0)
+				version = self._versions [stock]
+		return changed
+
+	# close detaches from the shared memory, the ring's views of it must not be used afterwards
+	def close (self):
+		for view in self._views:
+			view.release ()
+		self._views = []
+		self._memory.close ()
+
+	# unlink frees the shared memory once every process has closed it, called by the writer when finished
+	def unlink (self):
+		self._memory.unlink ()
+
+# Volume Weighted Stock Prices are calculated from the total amount paid and total quantity each correctly rounded
+# from their exact values, so the result is the same however the trades were added up, in whatever order and with
+# whatever trades added then taken away again. Running totals are kept exactly as integers counting units of
+# 2 ** -EXACT_BITS for quantities and 2 ** -(2 * EXACT_BITS) for amounts paid, small enough for any product of
+# two finite floats to be a whole number of units. Totals made in one go add up exact products with math.fsum.
+EXACT_BITS = 1074
+SPLIT = 134217729.0 # 2 ** 27 + 1, splits a float into two halves whose products with another's halves are exact
+
+# exactValue converts a number to an exact total
+# arg value : the number, which must be finite
+# raises TypeError if the value is not a number, OverflowError or ValueError if it is not finite
+# returns the number of units of 2 ** -EXACT_BITS in the value
+def exactValue (value):
+	numerator, denominator = (0.0 + value).as_integer_ratio ()
+	return numerator << (EXACT_BITS + 1 - denominator.bit_length ())
+
+# exactProduct converts the product of two numbers to an exact total, without rounding the product
+# arg value : a number, which must be finite
+# arg other : another number, which must be finite
+# raises TypeError if either value is not a number, OverflowError or ValueError if either is not finite
+# returns the number of units of 2 ** -(2 * EXACT_BITS) in the product
+def exactProduct (value, other):
+	numerator, denominator = (0.0 + value).as_integer_ratio ()
+	otherNumerator, otherDenominator = (0.0 + other).as_integer_ratio ()
+	return (numerator * otherNumerator) << (2 * EXACT_BITS + 2 - denominator.bit_length () - otherDenominator.bit_length ())
+
+# productParts splits the product of two floats into the rounded product and its rounding error, which add up to
+# the exact product as long as neither float is above 2 ** 995 and the product is not close to underflowing
+# arg value : a float
+# arg other : another float
+# returns a tuple of the rounded product and its rounding error
+def productParts (value, other):
+	product = value * other
+	scaled = SPLIT * value
+	high = scaled - (scaled - value)
+	low = value - high
+	scaled = SPLIT * other
+	otherHigh = scaled - (scaled - other)
+	otherLow = other - otherHigh
+	return product, ((high * otherHigh - product) + high * otherLow + low * otherHigh) + low * otherLow
+
+# exactQuotient divides an exact total amount paid by an exact total quantity, each first rounded to a float
+# arg amount : the total amount paid, as given by exactProduct
+# arg quantity : the total quantity, as given by exactValue
+# raises ZeroDivisionError if the quantity is zero, OverflowError if the amount is too large for a float
+# returns the quotient
+def exactQuotient (amount, quantity):
+	return (amount / (1 << (2 * EXACT_BITS))) / (quantity / (1 << EXACT_BITS))
+
+# VolumeWeightedTotals class to keep running totals for a Volume Weighted Stock Price calculation
+# calculateVolumeWeightedStockPrice fails when the total quantity at any one price is negative, which can only
+# happen at a price with a trade of negative quantity, so quantities are only totalled per price for those prices
+class VolumeWeightedTotals:
+	# VolumeWeightedTotals constructor
+	# initialize empty totals
+	# arg source : function returning (price, quantity) pairs for every trade totalled, used to
+	#              total quantities at a price when a trade of negative quantity is first added at it
+	# arg exact : if True, keep the totals exactly, so trades can be taken away again without the rounding errors
+	#             of the trades left in growing, and calculate gives the same result as calculateVolumeWeightedStockPrice.
+	#             Trades at a price or of a quantity that is not finite then count as non-numeric
+	def __init__ (self, source, exact = False):
+		self._source = source
+		self._exact = exact
+		self.reset ()
+
+	# reset clears all totals
+	def reset (self):
+		self._totalAmountPaid = 0 if self._exact else 0.0
+		self._totalQuantity = 0 if self._exact else 0.0
+		self._quantitiesByPrice = { } # maps price to [total quantity, number of trades], for prices with negative quantities
+		self._trades = 0
+		self._negativePrices = 0 # number of trades at a negative price
+		self._negativeQuantities = 0 # number of prices with a negative total quantity
+		self._invalidTrades = 0 # number of trades with a non-numeric price or quantity
+
+	# returns total amount paid
+	def totalAmountPaid (self):
+		if self._exact:
+			return self._totalAmountPaid / (1 << (2 * EXACT_BITS))
+		return self._totalAmountPaid
+
+	# returns total quantity
+	def totalQuantity (self):
+		if self._exact:
+			return self._totalQuantity / (1 << EXACT_BITS)
+		return self._totalQuantity
+
+	# returns number of trades totalled
+	def trades (self):
+		return self._trades
+
+	# add adds a trade to the totals, the trade must already be included by the source
+	# arg price : the price of the trade
+	# arg quantity : the quantity of stock traded
+	def add (self, price, quantity):
+		if self._update (price, quantity, 1):
+			self._totalByPrice ([price])
+
+	# addMany adds a number of trades to the totals, the trades must already be included by the source
+	# arg prices : a sequence of trade prices
+	# arg quantities : a sequence of trade quantities, the same length as prices
+	def addMany (self, prices, quantities):
+		if not prices:
+			return
+		try:
+			# quick check the trades are numeric and the only work needed is to add them up
+			if self._exact:
+				amount = sum (map (exactProduct, prices, quantities))
+				quantity = sum (map (exactValue, quantities))
+			else:
+				amount = sum (map (operator.mul, prices, quantities))
+				quantity = sum (quantities)
+			fast = min (quantities) >= 0 and not self._quantitiesByPrice
+		except Exception:
+			fast = False
+		if fast:
+			if min (prices) < 0:
+				self._negativePrices += sum (1 for price in prices if price < 0)
+			self._trades += len (prices)
+			self._totalAmountPaid += amount
+			self._totalQuantity += quantity
+			return
+		# otherwise add trades one by one, totalling any new prices with negative quantities at the end
+		newPrices = set ()
+		for price, quantity in zip (prices, quantities):
+			if self._update (price, quantity, 1):
+				newPrices.add (price)
+		if newPrices:
+			self._totalByPrice (newPrices)
+
+	# addAggregates adds trades already totalled by price to the totals, the trades must already be included by the source
+	# arg entries : an iterable of (price, total quantity, number of trades) tuples
+	def addAggregates (self, entries):
+		newPrices = []
+		for price, quantity, count in entries:
+			self._trades += count
+			if price < 0:
+				self._negativePrices += count
+			if self._exact:
+				self._totalAmountPaid += exactProduct (price, quantity)
+				self._totalQuantity += exactValue (quantity)
+			else:
+				self._totalAmountPaid += price * quantity
+				self._totalQuantity += quantity
+			if quantity < 0:
+				newPrices.append (price)
+		if newPrices:
+			self._totalByPrice (newPrices)
+
+	# addFolded adds trades already folded into one total to the totals, the trades must all have a numeric price
+	# and a quantity of zero or more, at prices whose quantities are not totalled
+	# arg amount : the total amount paid for the trades
+	# arg quantity : the total quantity of the trades
+	# arg count : the number of trades
+	# arg negativePrices : the number of the trades at a negative price
+	def addFolded (self, amount, quantity, count, negativePrices):
+		self._trades += count
+		self._negativePrices += negativePrices
+		self._totalAmountPaid += amount
+		self._totalQuantity += quantity
+
+	# returns True if quantities are totalled at a price, as they are once a trade of negative quantity is added at it
+	# arg price : the price to check
+	def totalsQuantitiesAt (self, price):
+		return price in self._quantitiesByPrice
+
+	# remove removes a trade previously added to the totals
+	# arg price : the price of the trade
+	# arg quantity : the quantity of stock traded
+	def remove (self, price, quantity):
+		self._update (price, quantity, -1)
+
+	# _update adds or removes a trade
+	# arg price : the price of the trade
+	# arg quantity : the quantity of stock traded
+	# arg sign : 1 to add the trade, -1 to remove it
+	# returns True if the trade has a negative quantity at a price whose quantities are not yet totalled
+	def _update (self, price, quantity, sign):
+		self._trades += sign
+		try:
+			negativePrice = price < 0
+			negativeQuantity = quantity < 0
+			if self._exact:
+				amount = exactProduct (price, quantity)
+				total = exactValue (quantity)
+			else:
+				total = 0.0 + quantity
+				amount = price * total
+			entry = self._quantitiesByPrice.get (price)
+		except Exception:
+			# remember the bad trade so the calculation fails while it is totalled
+			self._invalidTrades += sign
+			return False
+		if negativePrice:
+			self._negativePrices += sign
+		if self._trades == 0:
+			# no trades left, start again from zero so rounding errors do not accumulate
+			self._totalAmountPaid = 0 if self._exact else 0.0
+			self._totalQuantity = 0 if self._exact else 0.0
+		else:
+			self._totalAmountPaid += sign * amount
+			self._totalQuantity += sign * total
+		if entry is None:
+			return negativeQuantity
+		if entry [0] < 0:
+			self._negativeQuantities -= 1
+		entry [0] += sign * quantity
+		entry [1] += sign
+		if entry [1] == 0:
+			del self._quantitiesByPrice [price]
+		elif entry [0] < 0:
+			self._negativeQuantities += 1
+		return False
+
+	# _totalByPrice totals the quantities of the trades at the given prices from the source
+	# arg prices : the prices to total quantities for
+	def _totalByPrice (self, prices):
+		entries = { }
+		for price in prices:
+			entries [price] = [0.0, 0]
+		for price, quantity in self._source ():
+			entry = entries.get (price)
+			if entry is not None:
+				entry [0] += quantity
+				entry [1] += 1
+		for price in entries:
+			if entries [price][0] < 0:
+				self._negativeQuantities += 1
+		self._quantitiesByPrice.update (entries)
+
+	# calculate calculates the Volume Weighted Stock Price from the totals
+	# raises the same errors as the calculation in calculateVolumeWeightedStockPrice would
+	# returns the Volume Weighted Stock Price
+	def calculate (self):
+		if self._invalidTrades > 0:
+			raise TypeError ("non-numeric price or quantity")
+		if self._negativePrices > 0 or self._negativeQuantities > 0:
+			raise NegativeValueError ()
+		if self._exact:
+			return exactQuotient (self._totalAmountPaid, self._totalQuantity)
+		return self._totalAmountPaid / self._totalQuantity
+
+# SymbolTrades class to act as a per-symbol index of trade records kept sorted by timestamp
+class SymbolTrades:
+	# SymbolTrades constructor
+	# initialize empty timestamp list and matching trade record list
+	# arg stock : the stock whose trades are indexed
+	# arg lock : the lock held while the index is read or changed, defaults to no locking
+	def __init__ (self, stock, lock = NO_LOCK):
+		self._stock = stock
+		self._lock = lock
+		self._timestamps = []
+		self._trades = []
+		self._compacted = { } # maps price to [total quantity, number of trades] for trades only kept in totals whose
+		                       # quantities at their price are needed, see _compactInto
+		self._folded = [0.0, 0.0, 0, 0] # amount paid, quantity, number of trades and number at a negative price for
+		                                # all other trades only kept in totals
+		self._totals = VolumeWeightedTotals (self._totalledPricesAndQuantities)
+		self._window = None
+		self._buckets = None
+		self._traded = False # True if traded since the All Share Index last took the stock's price
+
+	# returns the number of trade records in the index
+	def __len__ (self):
+		return len (self._trades)
+
+	# returns the stock whose trades are indexed
+	def stock (self):
+		return self._stock
+
+	# returns the lock to hold while reading or changing the index
+	def lock (self):
+		return self._lock
+
+	# markTraded marks the stock as traded since the All Share Index last took its price, called with the lock held
+	# returns True if the stock was not already marked
+	def markTraded (self):
+		marked = self._traded
+		self._traded = True
+		return not marked
+
+	# clearTraded clears the mark set by markTraded, called with the lock held as the All Share Index takes the price
+	def clearTraded (self):
+		self._traded = False
+
+	# key converts a timestamp to the form timestamps are kept in by the index
+	# arg timestamp : the date and time to convert
+	def key (self, timestamp):
+		return timestamp
+
+	# returns the sorted sequence of trade timestamps, in the form given by key
+	def timestamps (self):
+		return self._timestamps
+
+	# returns the price of the trade at a position in the index
+	def price (self, position):
+		return self._trades [position].price ()
+
+	# returns the quantity of the trade at a position in the index
+	def quantity (self, position):
+		return self._trades [position].quantity ()
+
+	# returns the list of trade records, sorted by timestamp
+	def trades (self):
+		return self._trades
+
+	# returns the running totals for every trade in the index
+	def totals (self):
+		return self._totals
+
+	# returns the sliding window over this index, creating it on first use
+	def slidingWindow (self):
+		if self._window is None:
+			self._window = SlidingWindow (self)
+		return self._window
+
+	# returns the time buckets over this index, creating them on first use
+	def timeBuckets (self):
+		if self._buckets is None:
+			self._buckets = TimeBuckets (self)
+		return self._buckets
+
+	# insert adds a trade to the index, keeping trades sorted by timestamp
+	# trades with equal timestamps are kept in the order they were inserted
+	# arg timestamp : the date and time of the trade
+	# arg quantity : the quantity of stock traded
+	# arg buyorsell : BuyOrSell enum indicating whether trade was buy or sell
+	# arg price : the price of the trade
+	# returns the position the trade was inserted at
+	def insert (self, timestamp, quantity, buyorsell, price):
+		trade = TradeRecord (self._stock, timestamp, quantity, buyorsell, price)
+		if not self._timestamps or timestamp >= self._timestamps [-1]:
+			# usual case, trade is the latest for this stock so append
+			position = len (self._trades)
+			self._timestamps.append (timestamp)
+			self._trades.append (trade)
+		else:
+			# out of order trade, binary search for its position
+			position = bisect.bisect_right (self._timestamps, timestamp)
+			self._timestamps.insert (position, timestamp)
+			self._trades.insert (position, trade)
+		self._totals.add (price, quantity)
+		if self._window is not None:
+			self._window.inserted (timestamp, quantity, price)
+		if self._buckets is not None:
+			self._buckets.inserted (timestamp, quantity, price)
+		return position
+
+	# positions returns the range of positions of trades with a timestamp strictly between start and end
+	# arg start : the exclusive lower bound of the timestamp range
+	# arg end : the exclusive upper bound of the timestamp range
+	# returns the first position in the range and the position after the last
+	def positions (self, start, end):
+		lo = bisect.bisect_right (self._timestamps, self.key (start))
+		hi = bisect.bisect_left (self._timestamps, self.key (end), lo)
+		return lo, hi
+
+	# between returns the trade records with a timestamp strictly between start and end
+	# arg start : the exclusive lower bound of the timestamp range
+	# arg end : the exclusive upper bound of the timestamp range
+	# returns a list of trade records sorted by timestamp
+	def between (self, start, end):
+		lo, hi = self.positions (start, end)
+		return self._trades [lo:hi]
+
+	# returns (price, quantity) pairs for the trades in a range of positions
+	# arg lo : the first position in the range, defaults to the first trade
+	# arg hi : the position after the last in the range, defaults to after the last trade
+	def pricesAndQuantities (self, lo = 0, hi = None):
+		return [(trade.price (), trade.quantity ()) for trade in self._trades [lo:hi]]
+
+	# returns (price, quantity, buy or sell indicator) tuples for the trades in a range of positions
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	def pricesQuantitiesAndSides (self, lo, hi):
+		return [(trade.price (), trade.quantity (), trade.buyOrSell ()) for trade in self._trades [lo:hi]]
+
+	# compactMany adds a number of trades to the index's totals, without keeping the trades themselves
+	# the trades then count towards the All Share Index, but not towards any window over the index
+	# arg prices : a list of trade prices
+	# arg quantities : a list of the quantities of stock traded
+	def compactMany (self, prices, quantities):
+		self._compactInto (self._folded, self._compacted, zip (prices, quantities, itertools.repeat (1)))
+		self._totals.addMany (prices, quantities)
+
+	# compactAggregates adds trades already totalled to the index's totals, without keeping the trades
+	# arg folded : a tuple of the amount paid, quantity, number of trades and number at a negative price for
+	#              trades folded into one total, as given by checkpoint
+	# arg entries : a list of (price, total quantity, number of trades) tuples for other trades
+	def compactAggregates (self, folded, entries):
+		self._compactInto (self._folded, self._compacted, entries)
+		self._totals.addFolded (*folded)
+		for position in range (4):
+			self._folded [position] += folded [position]
+		self._totals.addAggregates (entries)
+
+	# returns the number of trades only kept in the index's totals
+	def compacted (self):
+		return self._folded [2] + sum (entry [1] for entry in self._compacted.values ())
+
+	# returns the number of prices trades only kept in the index's totals are totalled at
+	def compactedPrices (self):
+		return len (self._compacted)
+
+	# _compactInto adds trades to trades only kept in totals. Trades of zero or more quantity at prices the totals
+	# do not total quantities at are folded into one running total, so memory does not grow with the number of
+	# prices traded at. Trades of negative quantity, and any trades at a price with one, are totalled by price, as
+	# the negative quantity check needs. A later trade of negative quantity at a price is then checked against the
+	# trades at the price that are kept or totalled by price, not those folded, which are never negative.
+	# arg folded : the [amount paid, quantity, number of trades, number at a negative price] list to fold trades into
+	# arg byPrice : the dictionary mapping price to [total quantity, number of trades] to total other trades in
+	# arg entries : an iterable of (price, total quantity, number of trades) tuples
+	def _compactInto (self, folded, byPrice, entries):
+		entries = list (entries)
+		negative = set (price for price, quantity, count in entries if quantity < 0)
+		for price, quantity, count in entries:
+			if not price in negative and not self._totals.totalsQuantitiesAt (price):
+				try:
+					amount = 0.0 + price * quantity
+					negativePrice = price < 0
+				except Exception:
+					amount = None
+				if amount is not None:
+					folded [0] += amount
+					folded [1] += quantity
+					folded [2] += count
+					if negativePrice:
+						folded [3] += count
+					continue
+			entry = byPrice.get (price)
+			if entry is None:
+				entry = byPrice [price] = [0.0, 0]
+			entry [0] += quantity
+			entry [1] += count
+
+	# compactOldest moves the oldest trades in the index into its totals by price, releasing their records. The
+	# trades still count towards the All Share Index, but no longer towards any window over the index.
+	# arg count : the number of trades to compact
+	def compactOldest (self, count):
+		count = min (count, len (self))
+		if count <= 0:
+			return
+		self._compactInto (self._folded, self._compacted, ((price, quantity, 1) for price, quantity in self.pricesAndQuantities (0, count)))
+		self._release (count)
+		if self._window is not None:
+			self._window.released (count)
+		if self._buckets is not None:
+			timestamps = self.timestamps ()
+			self._buckets.released (self.epochFromKey (timestamps [0]) if timestamps else None)
+
+	# _release removes the oldest trade records from the index
+	# arg count : the number of trade records to remove
+	def _release (self, count):
+		del self._timestamps [:count]
+		del self._trades [:count]
+
+	# recalculatedTotals totals every trade in the index again from the start, including those only kept in totals
+	# returns new running totals, matching those kept as trades are recorded
+	def recalculatedTotals (self):
+		totals = VolumeWeightedTotals (self._totalledPricesAndQuantities)
+		totals.addFolded (*self._folded)
+		totals.addAggregates ([(price, entry [0], entry [1]) for price, entry in self._compacted.items ()])
+		totals.addMany (*self._priceAndQuantityColumns ())
+		return totals
+
+	# totalsSnapshot copies what recalculatedTotals totals, so it can be totalled without the index. Only the list
+	# of trade records is copied, not each record's price and quantity, so the lock need only be held for the copy.
+	# returns a tuple of the amount paid, quantity, number of trades and number at a negative price for trades
+	# only kept in totals folded into one total, a list of (price, total quantity, number of trades) tuples for
+	# other trades only kept in totals, and a function returning sequences of the prices and quantities of the
+	# trades in the index when it was copied, which may be called without the lock
+	def totalsSnapshot (self):
+		return tuple (self._folded), [(price, entry [0], entry [1]) for price, entry in self._compacted.items ()], self._columnsSnapshot ()
+
+	# _columnsSnapshot copies the list of trade records in the index
+	# returns a function returning the prices and quantities of the copied trades as two sequences
+	def _columnsSnapshot (self):
+		trades = self._trades [:]
+		return lambda: ([trade.price () for trade in trades], [trade.quantity () for trade in trades])
+
+	# returns the prices and quantities of the trades in the index as two sequences
+	def _priceAndQuantityColumns (self):
+		return [trade.price () for trade in self._trades], [trade.quantity () for trade in self._trades]
+
+	# epochColumns returns the trades in a range of positions as columns
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	# returns a tuple of lists of timestamps as seconds since the epoch, quantities, sides and prices
+	def epochColumns (self, lo, hi):
+		trades = self._trades [lo:hi]
+		return ([toEpoch (trade.timestamp ()) for trade in trades], [trade.quantity () for trade in trades],
+			[trade.buyOrSell () for trade in trades], [trade.price () for trade in trades])
+
+	# exportColumns appends the trades in a range of positions to typed columns
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	# arg columns : a tuple of timestamp, quantity, side and price arrays, as given by Trade.exportTrades
+	# raises TypeError if a trade's quantity or price is not a number
+	def exportColumns (self, lo, hi, columns):
+		for column, values in zip (columns, self.epochColumns (lo, hi)):
+			column.extend (values)
+
+	# checkpoint returns the trades in the index for a journal checkpoint, trades with a timestamp after start
+	# as columns and all other trades, including those only kept in totals, totalled as compaction totals them
+	# arg start : the date and time after which trades are kept as columns
+	# returns a tuple of the amount paid, quantity, number of trades and number at a negative price for trades
+	# folded into one total, a list of (price, total quantity, number of trades) tuples for other trades, and a
+	# tuple of columns as given by epochColumns
+	def checkpoint (self, start):
+		lo = bisect.bisect_right (self.timestamps (), self.key (start))
+		folded = list (self._folded)
+		entries = { }
+		for price, entry in self._compacted.items ():
+			entries [price] = list (entry)
+		self._compactInto (folded, entries, ((price, quantity, 1) for price, quantity in self.pricesAndQuantities (0, lo)))
+		return tuple (folded), [(price, entry [0], entry [1]) for price, entry in entries.items ()], self.epochColumns (lo, len (self))
+
+	# _totalledPricesAndQuantities returns (price, quantity) pairs covering every trade in the index's totals whose
+	# quantity at its price is needed, with a pair per price for trades only kept in totals by price
+	def _totalledPricesAndQuantities (self):
+		compacted = [(price, entry [0]) for price, entry in self._compacted.items ()]
+		return itertools.chain (compacted, self.pricesAndQuantities ())
+
+	# insertMany adds a number of trades to the index, keeping trades sorted by timestamp
+	# arg keys : a list of trade timestamps, in the form given by key
+	# arg quantities : a list of the quantities of stock traded
+	# arg sides : a list of BuyOrSell enums indicating whether trades were buy or sell
+	# arg prices : a list of trade prices
+	def insertMany (self, keys, quantities, sides, prices):
+		if not keys:
+			return
+		timestamps = self.timestamps ()
+		if (timestamps and keys [0] < timestamps [-1]) or keys != sorted (keys):
+			# out of order trades, insert one by one
+			for key, quantity, side, price in zip (keys, quantities, sides, prices):
+				self.insert (self._timestamp (key), quantity, side, price)
+			return
+		# usual case, trades are the latest for this stock so append in one go
+		self._append (keys, quantities, sides, prices)
+		self._totals.addMany (prices, quantities)
+		if self._window is not None:
+			for key, quantity, price in zip (keys, quantities, prices):
+				self._window.inserted (key, quantity, price)
+		if self._buckets is not None:
+			for key, quantity, price in zip (keys, quantities, prices):
+				self._buckets.inserted (key, quantity, price)
+
+	# _timestamp converts a timestamp in the form given by key back to a date and time
+	# arg key : the timestamp to convert
+	def _timestamp (self, key):
+		return key
+
+	# epochFromKey converts a timestamp in the form given by key to seconds since the epoch
+	# arg key : the timestamp to convert
+	def epochFromKey (self, key):
+		return toEpoch (key)
+
+	# keysFromEpoch converts timestamps given as seconds since the epoch to the form given by key
+	# arg seconds : a sequence of seconds since the epoch
+	# returns a list of timestamps
+	def keysFromEpoch (self, seconds):
+		# as fromEpoch, without a Python call for each timestamp
+		return list (map (EPOCH.__add__, map (datetime.timedelta, itertools.repeat (0), seconds)))
+
+	# keysFromDatetimes converts dates and times to the form given by key
+	# arg datetimes : a sequence of dates and times
+	# returns a list of timestamps
+	def keysFromDatetimes (self, datetimes):
+		return list (datetimes)
+
+	# _append appends trades which are the latest for this stock to the index
+	# arg keys : a list of trade timestamps, in the form given by key
+	# arg quantities : a list of the quantities of stock traded
+	# arg sides : a list of BuyOrSell enums indicating whether trades were buy or sell
+	# arg prices : a list of trade prices
+	def _append (self, keys, quantities, sides, prices):
+		self._timestamps.extend (keys)
+		with pausedCollection ():
+			self._trades.extend (map (TradeRecord, itertools.repeat (self._stock), keys, quantities, sides, prices))
+
+# ColumnarSymbolTrades class to act as a per-symbol index of trades kept sorted by timestamp, in typed columns
+# rather than as TradeRecord objects. Timestamps are kept as seconds since the epoch, and quantities and prices
+# as floats, so a trade takes 25 bytes and all data recorded must be numeric.
+class ColumnarSymbolTrades (SymbolTrades):
+	# ColumnarSymbolTrades constructor
+	# initialize empty columns
+	# arg stock : the stock whose trades are indexed
+	# arg lock : the lock held while the index is read or changed, defaults to no locking
+	def __init__ (self, stock, lock = NO_LOCK):
+		self._stock = stock
+		self._lock = lock
+		self._timestamps = array.array ("d")
+		self._quantities = array.array ("d")
+		self._sides = array.array ("b")
+		self._prices = array.array ("d")
+		self._compacted = { } # maps price to [total quantity, number of trades] for trades only kept in totals whose
+		                       # quantities at their price are needed, see _compactInto
+		self._folded = [0.0, 0.0, 0, 0] # amount paid, quantity, number of trades and number at a negative price for
+		                                # all other trades only kept in totals
+		self._totals = VolumeWeightedTotals (self._totalledPricesAndQuantities)
+		self._window = None
+		self._buckets = None
+		self._traded = False # True if traded since the All Share Index last took the stock's price
+
+	# returns the number of trades in the index
+	def __len__ (self):
+		return len (self._timestamps)
+
+	# key converts a timestamp to seconds since the epoch
+	# arg timestamp : the date and time to convert
+	def key (self, timestamp):
+		return toEpoch (timestamp)
+
+	# returns the price of the trade at a position in the index
+	def price (self, position):
+		return self._prices [position]
+
+	# returns the quantity of the trade at a position in the index
+	def quantity (self, position):
+		return self._quantities [position]
+
+	# returns the columns of the index as a tuple of timestamps, quantities, sides and prices
+	def columns (self):
+		return self._timestamps, self._quantities, self._sides, self._prices
+
+	# epochColumns returns the trades in a range of positions as columns
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	# returns a tuple of lists of timestamps as seconds since the epoch, quantities, sides and prices
+	def epochColumns (self, lo, hi):
+		return self._timestamps [lo:hi].tolist (), self._quantities [lo:hi].tolist (), self._sides [lo:hi].tolist (), self._prices [lo:hi].tolist ()
+
+	# exportColumns appends the trades in a range of positions to typed columns, copying from each column in one go
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	# arg columns : a tuple of timestamp, quantity, side and price arrays, as given by Trade.exportTrades
+	def exportColumns (self, lo, hi, columns):
+		for column, values in zip (columns, self.columns ()):
+			column += values [lo:hi]
+
+	# returns a list of trade records built from the columns, sorted by timestamp
+	def trades (self):
+		return self._records (0, len (self._timestamps))
+
+	# _records builds trade records from the columns
+	# arg lo : the first position to build a record for
+	# arg hi : the position after the last to build a record for
+	def _records (self, lo, hi):
+		return [TradeRecord (self._stock, fromEpoch (self._timestamps [i]), self._quantities [i], self._sides [i], self._prices [i]) for i in range (lo, hi)]
+
+	# insert adds a trade to the columns, keeping trades sorted by timestamp
+	# trades with equal timestamps are kept in the order they were inserted
+	# arg timestamp : the date and time of the trade
+	# arg quantity : the quantity of stock traded
+	# arg buyorsell : BuyOrSell enum indicating whether trade was buy or sell
+	# arg price : the price of the trade
+	# returns the position the trade was inserted at
+	# raises TypeError if a field cannot be kept in its column, leaving the columns unchanged
+	def insert (self, timestamp, quantity, buyorsell, price):
+		# convert every field before changing any column, so a bad field cannot leave the columns different lengths
+		key, quantity, price = array.array ("d", (toEpoch (timestamp), quantity, price))
+		buyorsell, = array.array ("b", (buyorsell,))
+		if not self._timestamps or key >= self._timestamps [-1]:
+			# usual case, trade is the latest for this stock so append
+			position = len (self._timestamps)
+			self._timestamps.append (key)
+			self._quantities.append (quantity)
+			self._sides.append (buyorsell)
+			self._prices.append (price)
+		else:
+			# out of order trade, binary search for its position
+			position = bisect.bisect_right (self._timestamps, key)
+			self._timestamps.insert (position, key)
+			self._quantities.insert (position, quantity)
+			self._sides.insert (position, buyorsell)
+			self._prices.insert (position, price)
+		self._totals.add (self._prices [position], self._quantities [position])
+		if self._window is not None:
+			self._window.inserted (key, self._quantities [position], self._prices [position])
+		if self._buckets is not None:
+			self._buckets.inserted (key, self._quantities [position], self._prices [position])
+		return position
+
+	# between returns trade records built for trades with a timestamp strictly between start and end
+	# arg start : the exclusive lower bound of the timestamp range
+	# arg end : the exclusive upper bound of the timestamp range
+	# returns a list of trade records sorted by timestamp
+	def between (self, start, end):
+		lo, hi = self.positions (start, end)
+		return self._records (lo, hi)
+
+	# returns (price, quantity) pairs for the trades in a range of positions
+	# arg lo : the first position in the range, defaults to the first trade
+	# arg hi : the position after the last in the range, defaults to after the last trade
+	def pricesAndQuantities (self, lo = 0, hi = None):
+		return zip (self._prices [lo:hi], self._quantities [lo:hi])
+
+	# returns (price, quantity, buy or sell indicator) tuples for the trades in a range of positions
+	# arg lo : the first position in the range
+	# arg hi : the position after the last in the range
+	def pricesQuantitiesAndSides (self, lo, hi):
+		return zip (self._prices [lo:hi], self._quantities [lo:hi], self._sides [lo:hi])
+
+	# returns the price and quantity columns
+	def _priceAndQuantityColumns (self):
+		return self._prices, self._quantities
+
+	# _columnsSnapshot copies the price and quantity columns
+	# returns a function returning the copied columns
+	def _columnsSnapshot (self):
+		prices = self._prices [:]
+		quantities = self._quantities [:]
+		return lambda: (prices, quantities)
+
+	# _release removes the oldest trades from the columns
+	# arg count : the number of trades to remove
+	def _release (self, count):
+		for column in (self._timestamps, self._quantities, self._sides, self._prices):
+			del column [:count]
+
+	# _timestamp converts seconds since the epoch back to a date and time
+	# arg key : the timestamp to convert
+	def _timestamp (self, key):
+		return fromEpoch (key)
+
+	# epochFromKey returns a timestamp as seconds since the epoch, as that is the form given by key
+	# arg key : the timestamp
+	def epochFromKey (self, key):
+		return key
+
+	# keysFromEpoch returns timestamps given as seconds since the epoch as a list, as that is the form given by key
+	# arg seconds : a sequence of seconds since the epoch
+	def keysFromEpoch (self, seconds):
+		return list (seconds)
+
+	# keysFromDatetimes converts dates and times to seconds since the epoch, as that is the form given by key
+	# arg datetimes : a sequence of dates and times
+	# returns a list of timestamps
+	def keysFromDatetimes (self, datetimes):
+		return list (map (toEpoch, datetimes))
+
+	# _append appends trades which are the latest for this stock to the columns
+	# arg keys : a list of trade timestamps as seconds since the epoch
+	# arg quantities : a list of the quantities of stock traded
+	# arg sides : a list of BuyOrSell enums indicating whether trades were buy or sell
+	# arg prices : a list of trade prices
+	# raises TypeError if a field cannot be kept in its column, leaving the columns unchanged
+	def _append (self, keys, quantities, sides, prices):
+		# convert every field before changing any column, so a bad field cannot leave the columns different lengths
+		values = (array.array ("d", keys), array.array ("d", quantities), array.array ("b", sides), array.array ("d", prices))
+		for column, added in zip (self.columns (), values):
+			column += added
+
+# SlidingWindow class to keep running Volume Weighted Stock Price totals for the trades in a SymbolTrades index
+# with a timestamp strictly between a start and end time. The totals are updated as trades are inserted into
+# the index and as the window moves forward, so each trade is added and removed once.
+class SlidingWindow:
+	# SlidingWindow constructor
+	# arg index : the SymbolTrades index the window is over
+	def __init__ (self, index):
+		self._index = index
+		self._totals = VolumeWeightedTotals (self.pricesAndQuantities, exact = True)
+		self._start = None
+		self._end = None
+		self._head = 0 # position of the first trade in the window
+		self._tail = 0 # position after the last trade in the window
+
+	# returns the running totals for the trades in the window
+	def totals (self):
+		return self._totals
+
+	# returns (price, quantity) pairs for the trades in the window
+	def pricesAndQuantities (self):
+		return self._index.pricesAndQuantities (self._head, self._tail)
+
+	# inserted updates the window for a trade just inserted into the index
+	# arg key : the timestamp of the trade, in the form given by the index key method
+	# arg quantity : the quantity of stock traded
+	# arg price : the price of the trade
+	def inserted (self, key, quantity, price):
+		if self._start is None:
+			# window not positioned yet
+			return
+		if key <= self._start:
+			# before the window, shifts the window along by one
+			self._head += 1
+			self._tail += 1
+		elif key < self._end:
+			# inside the window
+			self._tail += 1
+			self._totals.add (price, quantity)
+
+	# released updates the window for the oldest trades in the index being released
+	# arg count : the number of trades released
+	def released (self, count):
+		if self._head >= count:
+			self._head -= count
+			self._tail -= count
+		else:
+			# trades in the window released, start again on the next move
+			self._start = None
+
+	# move moves the window to cover the trades with a timestamp strictly between start and end
+	# arg start : the exclusive lower bound of the window
+	# arg end : the exclusive upper bound of the window
+	# returns the running totals for the trades in the window
+	def move (self, start, end):
+		index = self._index
+		timestamps = index.timestamps ()
+		start = index.key (start)
+		end = index.key (end)
+		if self._start is None or start < self._start or end < self._end:
+			# first use, or window moved backwards, so start again
+			self._totals.reset ()
+			self._head = self._tail = bisect.bisect_right (timestamps, start)
+		else:
+			# remove trades which have dropped out of the window
+			while self._head < self._tail and timestamps [self._head] <= start:
+				self._totals.remove (index.price (self._head), index.quantity (self._head))
+				self._head += 1
+			if self._head == self._tail:
+				# window is empty, skip straight to the first trade after the start
+				self._head = self._tail = bisect.bisect_right (timestamps, start, self._head)
+		# add trades which have entered the window
+		while self._tail < len (timestamps) and timestamps [self._tail] < end:
+			self._tail += 1
+			self._totals.add (index.price (self._tail - 1), index.quantity (self._tail - 1))
+		self._start = start
+		self._end = end
+		return self._totals
+
+# TimeBuckets class to keep trades in a SymbolTrades index totalled in one second and one minute buckets, so the
+# Volume Weighted Stock Price over any window is found by adding up whole buckets inside the window and only the
+# trades at its edges, and a long window costs about the same as a short one. Buckets are kept up to date as
+# trades are inserted into the index. A bucket holding a trade at a negative price or of negative or non-numeric
+# quantity cannot give the same result as totalling quantities by price, so windows covering one are marked, as
+# are windows covering a trade whose price or quantity is not finite. Amounts paid and quantities are totalled
+# exactly, as by exactProduct and exactValue, so a window gives the same price as totalling its trades by price.
+#
+# Buckets are only kept back as far as the longest window asked for reaches before the latest trade, so they
+# stay bounded even when the index keeps every trade record. Buckets are built from the records when a window
+# reaches further back than they cover, which only costs anything the first time a longer window is asked for.
+class TimeBuckets:
+	SECOND = 1
+	MINUTE = 60
+
+	# TimeBuckets constructor, with no buckets until a window is asked for
+	# arg index : the SymbolTrades index the buckets are over
+	def __init__ (self, index):
+		self._index = index
+		# map bucket start, in whole seconds since the epoch, to [exact total amount paid, exact total quantity, number
+		# of trades, highest price, lowest price, number of irregular trades]
+		self._seconds = { }
+		self._minutes = { }
+		self._starts = ([], []) # heaps of the starts of the second and minute buckets, oldest first
+		self._covered = math.inf # whole minute from which every trade in the index is in the buckets
+		self._horizon = 0 # longest window asked for, in whole seconds
+		self._latest = -math.inf # whole second of the latest trade
+
+	# bars returns the buckets of a width, covering trades back as far as the longest window asked for reaches
+	# arg width : SECOND or MINUTE
+	# returns a dictionary mapping bucket start to [total amount paid, total quantity, number of trades, highest
+	# price, lowest price, number of irregular trades]
+	def bars (self, width):
+		buckets = self._minutes if width == self.MINUTE else self._seconds
+		return { start : [bucket [0] / (1 << (2 * EXACT_BITS)), bucket [1] / (1 << EXACT_BITS)] + bucket [2:]
+			for start, bucket in buckets.items () }
+
+	# inserted adds a trade just inserted into the index to its buckets
+	# arg key : the timestamp of the trade, in the form given by the index key method
+	# arg quantity : the quantity of stock traded
+	# arg price : the price of the trade
+	def inserted (self, key, quantity, price):
+		second = math.floor (self._index.epochFromKey (key))
+		if second < self._covered:
+			# older than any window asked for reaches, totalled from the records if one ever does
+			return
+		self._addTrade (second, quantity, price)
+		if second > self._latest:
+			self._latest = second
+			# drop buckets no window asked for reaches, leaving a minute spare
+			cutoff = second - self._horizon
+			cutoff -= cutoff % 60 + 60
+			if cutoff > self._covered:
+				self._drop (cutoff)
+				self._covered = cutoff
+
+	# _addTrade adds a trade to its buckets
+	# arg second : the whole second of the trade, since the epoch
+	# arg quantity : the quantity of stock traded
+	# arg price : the price of the trade
+	def _addTrade (self, second, quantity, price):
+		try:
+			if price < 0 or quantity < 0:
+				raise NegativeValueError ()
+			amount = exactProduct (price, quantity)
+			total = exactValue (quantity)
+		except Exception:
+			amount = None # irregular
+		for buckets, starts, start in [(self._seconds, self._starts [0], second), (self._minutes, self._starts [1], second - second % 60)]:
+			bucket = buckets.get (start)
+			if bucket is None:
+				bucket = buckets [start] = [0, 0, 0, None, None, 0]
+				heapq.heappush (starts, start)
+			bucket [2] += 1
+			if amount is None:
+				bucket [5] += 1
+				continue
+			bucket [0] += amount
+			bucket [1] += total
+			if bucket [3] is None or price > bucket [3]:
+				bucket [3] = price
+			if bucket [4] is None or price < bucket [4]:
+				bucket [4] = price
+
+	# released drops buckets which only hold trades no longer kept as records in the index
+	# arg first : the timestamp of the oldest trade still kept, as seconds since the epoch, or None if none are kept
+	def released (self, first):
+		if first is None:
+			self._seconds.clear ()
+			self._minutes.clear ()
+			self._starts = ([], [])
+			return
+		self._drop (first)
+
+	# _drop drops buckets which end by a time, oldest first
+	# arg cutoff : the time, in seconds since the epoch
+	def _drop (self, cutoff):
+		for buckets, starts, width in [(self._seconds, self._starts [0], self.SECOND), (self._minutes, self._starts [1], self.MINUTE)]:
+			while starts and starts [0] + width <= cutoff:
+				del buckets [heapq.heappop (starts)]
+
+	# totals adds up the trades with a timestamp strictly between start and end
+	# arg start : the exclusive lower bound of the window
+	# arg end : the exclusive upper bound of the window
+	# returns a tuple of total amount paid and total quantity, as given by exactProduct and exactValue, and number of
+	# irregular trades
+	def totals (self, start, end):
+		index = self._index
+		timestamps = index.timestamps ()
+		lo = bisect.bisect_right (timestamps, index.key (start))
+		hi = bisect.bisect_left (timestamps, index.key (end), lo)
+		first = math.floor (toEpoch (start)) + 1 # start of the first whole second in the window
+		last = math.floor (toEpoch (end)) # end of the last whole second in the window
+		self._horizon = max (self._horizon, last - first + 1)
+		if first >= last or lo == hi:
+			# window too short for whole buckets
+			return self._add ([0, 0, 0], index.pricesAndQuantities (lo, hi))
+		if first < self._covered:
+			self._extend (first - first % 60)
+		firstKey, lastKey = index.keysFromEpoch ([first, last])
+		totals = [0, 0, 0]
+		# trades at the edges before the first and after the last whole second
+		self._add (totals, index.pricesAndQuantities (lo, bisect.bisect_left (timestamps, firstKey, lo, hi)))
+		self._add (totals, index.pricesAndQuantities (bisect.bisect_left (timestamps, lastKey, lo, hi), hi))
+		# whole minutes, and whole seconds either side of them
+		firstMinute = first + (-first) % 60
+		lastMinute = last - last % 60
+		if firstMinute >= lastMinute:
+			firstMinute = lastMinute = last
+		self._addBuckets (totals, self._seconds, range (first, firstMinute))
+		self._addBuckets (totals, self._minutes, range (firstMinute, lastMinute, 60))
+		self._addBuckets (totals, self._seconds, range (lastMinute, last))
+		return tuple (totals)
+
+	# _extend adds the trades in the index from a time up to where the buckets already cover to the buckets
+	# arg start : the time to cover from, a whole minute since the epoch
+	def _extend (self, start):
+		index = self._index
+		timestamps = index.timestamps ()
+		# a second either side, in case keys round, with the trades outside filtered out below
+		lo = bisect.bisect_left (timestamps, index.keysFromEpoch ([start - 1]) [0])
+		hi = len (timestamps)
+		if self._covered < math.inf:
+			hi = bisect.bisect_right (timestamps, index.keysFromEpoch ([self._covered + 1]) [0], lo)
+		for key, (price, quantity) in zip (timestamps [lo:hi], index.pricesAndQuantities (lo, hi)):
+			second = math.floor (index.epochFromKey (key))
+			if start <= second < self._covered:
+				self._addTrade (second, quantity, price)
+				self._latest = max (self._latest, second)
+		self._covered = start
+
+	# _add adds trades to totals
+	# arg totals : a list of exact total amount paid, exact total quantity and number of irregular trades
+	# arg trades : (price, quantity) pairs
+	# returns the totals as a tuple
+	def _add (self, totals, trades):
+		for price, quantity in trades:
+			try:
+				if price < 0 or quantity < 0:
+					raise NegativeValueError ()
+				amount = exactProduct (price, quantity)
+				totals [1] += exactValue (quantity)
+				totals [0] += amount
+			except Exception:
+				totals [2] += 1
+		return tuple (totals)
+
+	# _addBuckets adds buckets to totals
+	# arg totals : a list of exact total amount paid, exact total quantity and number of irregular trades
+	# arg buckets : a dictionary of buckets
+	# arg starts : the starts of the buckets to add
+	def _addBuckets (self, totals, buckets, starts):
+		for start in starts:
+			bucket = buckets.get (start)
+			if bucket is not None:
+				totals [0] += bucket [0]
+				totals [1] += bucket [1]
+				totals [2] += bucket [5]
+
+# AllShareIndex class to keep the GBCE All Share Index up to date as the Volume Weighted Stock Prices of
+# individual stocks change. The geometric mean is taken from a running sum of the logs of the prices, so
+# a change to one stock costs a constant amount of work and a large product of prices cannot overflow.
+class AllShareIndex:
+	# AllShareIndex constructor
+	# initialize with no stocks
+	# arg lock : the lock held while the set of stocks traded is changed, defaults to no locking
+	def __init__ (self, lock = NO_LOCK):
+		self._prices = { } # maps symbol to Volume Weighted Stock Price
+		self._changed = set () # symbols traded since their price was last updated
+		self._lock = lock
+		self._logSum = 0.0 # sum of logs of positive prices
+		self._zeros = 0 # number of stocks with a zero price
+		self._failures = 0 # number of stocks whose price calculation failed
+		self._updates = 0 # number of updates since the sum of logs was rebuilt
+
+	# returns the number of stocks in the index
+	def __len__ (self):
+		return len (self._prices)
+
+	# returns the number of stocks whose Volume Weighted Stock Price could not be calculated
+	def failures (self):
+		return self._failures
+
+	# stockTraded marks a stock as needing its Volume Weighted Stock Price updated. A Trade only calls this for the
+	# first trade of a stock since its price was last updated, marking later ones on the stock's own index.
+	# arg symbol : the symbol of the stock traded
+	def stockTraded (self, symbol):
+		with self._lock:
+			self._changed.add (symbol)
+
+	# changed returns the symbols of stocks traded since they were last updated, and clears them
+	def changed (self):
+		with self._lock:
+			changed = self._changed
+			self._changed = set ()
+		return changed
+
+	# update sets the Volume Weighted Stock Price of a stock
+	# arg symbol : the symbol of the stock
+	# arg price : the Volume Weighted Stock Price of the stock, or -1 if it could not be calculated
+	def update (self, symbol, price):
+		if symbol in self._prices:
+			self._add (self._prices [symbol], -1)
+		self._prices [symbol] = price
+		self._add (price, 1)
+		self._updates += 1
+		if self._updates > len (self._prices):
+			# rebuild the sum of logs now and again so rounding errors do not accumulate
+			self._logSum = math.fsum (math.log (p) for p in self._prices.values () if p > 0)
+			self._updates = 0
+
+	# _add adds a price to or removes a price from the running totals
+	# arg price : the Volume Weighted Stock Price
+	# arg sign : 1 to add the price, -1 to remove it
+	def _add (self, price, sign):
+		if price < 0:
+			self._failures += sign
+		elif price == 0:
+			self._zeros += sign
+		else:
+			self._logSum += sign * math.log (price)
+
+	# calculate calculates the geometric mean of the Volume Weighted Stock Prices
+	# raises ZeroDivisionError if there are no stocks
+	# returns the GBCE All Share Index
+	def calculate (self):
+		exponent = 1.0 / float (len (self._prices))
+		if self._zeros > 0:
+			return 0.0
+		if len (self._prices) == 1:
+			# geometric mean of a single price is the price itself
+			for price in self._prices.values ():
+				return price
+		return math.exp (self._logSum * exponent)
+
+# RetentionPolicy class to say which trade records a Trade keeps. Older trades are compacted into each stock's
+# totals by price, so they still count towards the All Share Index, and their records released.
+class RetentionPolicy:
+	# RetentionPolicy constructor
+	# arg horizon : how long before now to keep trade records, a timedelta, or None to keep them however old.
+	#               Windows used for Volume Weighted Stock Prices should be no longer than this
+	# arg maxRecords : the most trade records to keep for each stock, or None for no limit. The oldest are
+	#                  compacted first, even if they are inside the horizon
+	# arg every : the number of trades to record between compactions
+	def __init__ (self, horizon = None, maxRecords = None, every = 16384):
+		self._horizon = horizon
+		self._maxRecords = maxRecords
+		self._every = every
+
+	# returns how long before now to keep trade records, or None
+	def horizon (self):
+		return self._horizon
+
+	# returns the most trade records to keep for each stock, or None
+	def maxRecords (self):
+		return self._maxRecords
+
+	# returns the number of trades to record between compactions
+	def every (self):
+		return self._every
+
+	# expired returns the number of the oldest trades in an index to compact
+	# arg index : the SymbolTrades index
+	# arg now : the date and time now
+	def expired (self, index, now):
+		count = 0
+		if self._horizon is not None:
+			count = bisect.bisect_right (index.timestamps (), index.key (now - self._horizon))
+		if self._maxRecords is not None:
+			count = max (count, len (index) - self._maxRecords)
+		return count
+
+# WallClock class to give the time a Trade calculates windows up to and stamps trades with, as the current time
+class WallClock:
+	# returns the current date and time
+	def now (self):
+		return datetime.datetime.now ()
+
+	# advance does nothing, as the wall clock is not moved by trades
+	# arg timestamp : the date and time of a trade recorded
+	def advance (self, timestamp):
+		pass
+
+# SimulatedClock class to give the time a Trade calculates windows up to and stamps trades with, for replaying
+# trades recorded earlier. The time moves forward to the timestamp of each trade recorded, or when set.
+class SimulatedClock:
+	# SimulatedClock constructor
+	# arg start : the date and time to start at
+	def __init__ (self, start = EPOCH):
+		self._now = start
+
+	# returns the simulated date and time
+	def now (self):
+		return self._now
+
+	# advance moves the time forward to a timestamp, if it is later
+	# arg timestamp : the date and time to move to
+	def advance (self, timestamp):
+		if timestamp > self._now:
+			self._now = timestamp
+
+# Instrumentation class to count calls and errors and time calls of a Trade's methods, for a metrics agent
+# to collect with snapshot or exportText. Error messages are only formatted when they are looked at or logged.
+class Instrumentation:
+	# upper bounds of the latency histogram buckets in microseconds, with a last bucket for anything slower
+	LATENCY_BOUNDS = [2 ** i for i in range (21)]
+
+	# Instrumentation constructor
+	# arg logger : a logging.Logger to log error messages to as warnings, or None
+	# arg keepMessages : the number of the latest error messages to keep
+	# arg sampleEvery : run every so many calls of each method through the profiler, 0 for never
+	# arg profiler : a function called as profiler (method, function, *args) to run a sampled call, returning its
+	#                result, cProfile.Profile ().runcall with the method name dropped for example
+	def __init__ (self, logger = None, keepMessages = 100, sampleEvery = 0, profiler = None):
+		self._logger = logger
+		self._messages = collections.deque (maxlen = keepMessages) # (method, message, args) tuples
+		self._sampleEvery = sampleEvery if profiler is not None else 0
+		self._profiler = profiler
+		self._lock = threading.Lock ()
+		self._calls = { } # maps method to number of calls
+		self._errors = { } # maps method to a dictionary mapping cause to number of errors
+		self._latencies = { } # maps method to counts of calls in each latency bucket
+		self._seconds = { } # maps method to total seconds spent in calls
+
+	# wrap returns a function which calls a method, counting and timing each call
+	# arg method : the name of the method
+	# arg function : the bound method to call
+	def wrap (self, method, function):
+		clock = time.perf_counter
+		bounds = len (self.LATENCY_BOUNDS)
+		with self._lock:
+			self._calls [method] = 0
+			self._latencies [method] = [0] * (bounds + 1)
+			self._seconds [method] = 0.0
+		def instrumented (*args, **kwargs):
+			with self._lock:
+				calls = self._calls [method] = self._calls [method] + 1
+			start = clock ()
+			if self._sampleEvery and calls % self._sampleEvery == 0:
+				result = self._profiler (method, function, *args, **kwargs)
+			else:
+				result = function (*args, **kwargs)
+			seconds = clock () - start
+			micros = seconds * 1e6
+			bucket = min (bounds, math.frexp (micros) [1]) if micros > 1 else 0
+			with self._lock:
+				self._latencies [method][bucket] += 1
+				self._seconds [method] += seconds
+			return result
+		return instrumented
+
+	# error counts an error by the type of exception which caused it
+	# arg method : the name of the method the error happened in
+	# arg e : the exception, or None
+	# arg message : a message format
+	# arg args : a tuple of values for the message format
+	def error (self, method, e, message, args):
+		cause = type (e).__name__ if e is not None else "Error"
+		with self._lock:
+			errors = self._errors.setdefault (method, { })
+			errors [cause] = errors.get (cause, 0) + 1
+			self._messages.append ((method, message, args))
+		if self._logger is not None:
+			self._logger.warning (message, *args)
+
+	# snapshot returns a copy of the counters and histograms
+	# returns a dictionary of calls per method, errors per method by cause, latency histograms per method as
+	# bucket bounds in microseconds, counts per bucket and total seconds, and the latest error messages
+	def snapshot (self):
+		with self._lock:
+			calls = dict (self._calls)
+			errors = dict ((method, dict (causes)) for method, causes in self._errors.items ())
+			latencies = dict ((method, list (counts)) for method, counts in self._latencies.items ())
+			seconds = dict (self._seconds)
+			messages = list (self._messages)
+		return { "calls" : calls, "errors" : errors,
+			"latency" : dict ((method, { "boundsMicros" : list (self.LATENCY_BOUNDS), "counts" : latencies [method],
+				"seconds" : seconds [method] }) for method in latencies),
+			"messages" : [self._format (message, args) for method, message, args in messages] }
+
+	# exportText returns the counters and histograms in the Prometheus text format
+	# arg prefix : the prefix of each metric name
+	def exportText (self, prefix = "gbce"):
+		snapshot = self.snapshot ()
+		lines = ["# TYPE %s_calls_total counter" % prefix]
+		for method, count in sorted (snapshot ["calls"].items ()):
+			lines.append ('%s_calls_total{method="%s"} %d' % (prefix, method, count))
+		lines.append ("# TYPE %s_errors_total counter" % prefix)
+		for method, causes in sorted (snapshot ["errors"].items ()):
+			for cause, count in sorted (causes.items ()):
+				lines.append ('%s_errors_total{method="%s",cause="%s"} %d' % (prefix, method, cause, count))
+		lines.append ("# TYPE %s_latency_seconds histogram" % prefix)
+		for method, histogram in sorted (snapshot ["latency"].items ()):
+			total = 0
+			for bound, count in zip (histogram ["boundsMicros"] + ["+Inf"], histogram ["counts"]):
+				total += count
+				le = bound if bound == "+Inf" else repr (bound / 1e6)
+				lines.append ('%s_latency_seconds_bucket{method="%s",le="%s"} %d' % (prefix, method, le, total))
+			lines.append ('%s_latency_seconds_sum{method="%s"} %r' % (prefix, method, histogram ["seconds"]))
+			lines.append ('%s_latency_seconds_count{method="%s"} %d' % (prefix, method, total))
+		return "\n".join (lines) + "\n"
+
+	# _format formats an error message, falling back to showing the values if they do not fit the format
+	# arg message : the message format
+	# arg args : a tuple of values for the message format
+	def _format (self, message, args):
+		try:
+			return message % args
+		except Exception:
+			return "%s %r" % (message, args)
+
+# snapshots of every stock's trades that forked shard workers read, as given by SymbolTrades.totalsSnapshot,
+# only set while a sharded All Share Index calculation runs
+_shardSnapshots = None
+
+# shardLogSum calculates the Volume Weighted Stock Prices of a shard of stocks for a sharded All Share Index, in a
+# forked worker process. It only reads the snapshots taken before the worker was forked, so takes no lock that
+# another thread of the forking process might have held, and failures are counted rather than logged.
+# arg shard : the positions in _shardSnapshots of the stocks in the shard
+# returns a tuple of the sum of the logs of positive prices, the number of stocks, the number with a zero price,
+# the number whose price could not be calculated and the last price calculated
+def shardLogSum (shard):
+	logs = []
+	zeros = 0
+	failures = 0
+	price = -1
+	for position in shard:
+		folded, aggregates, columns = _shardSnapshots [position]
+		prices, quantities = columns ()
+		source = lambda: itertools.chain (((price, quantity) for price, quantity, count in aggregates), zip (prices, quantities))
+		totals = VolumeWeightedTotals (source)
+		try:
+			totals.addFolded (*folded)
+			totals.addAggregates (aggregates)
+			totals.addMany (prices, quantities)
+			price = totals.calculate ()
+		except Exception:
+			price = -1
+		if price < 0:
+			failures += 1
+		elif price == 0:
+			zeros += 1
+		else:
+			logs.append (math.log (price))
+	return math.fsum (logs), len (shard), zeros, failures, price
+
 # Trade class to perform trade actions
 class Trade:
+	# methods counted and timed when a Trade has instrumentation
+	INSTRUMENTED = ["dividendYield", "PERatio", "batchDividendYield", "batchPERatio", "recordTrade", "recordTrades",
+		"volumeWeightedStockPrice", "GBCEAllShareIndex", "shardedGBCEAllShareIndex"]
+
 	# Trade constructor
-	# initialize empty trade list
-	def __init__ (self):
-		self._trades = []
+	# initialize empty per-symbol trade index
+	# arg streaming : if True, keep running totals for each stock's five minute window as trades are
+	#                 recorded instead of recalculating from trade records on each volumeWeightedStockPrice call
+	# arg columnar : if True, keep trades in typed columns rather than as TradeRecord objects
+	# arg journal : a TradeJournal to append every trade recorded to, or None
+	# arg concurrent : if True, trades may be recorded and prices calculated from several threads at once. Each
+	#                  stock's index has its own lock, so threads recording trades for different stocks do not
+	#                  wait for each other
+	# arg clock : the clock giving the time now, defaults to a WallClock
+	# arg retention : a RetentionPolicy saying which trade records to keep, or None to keep them all
+	# arg instrumentation : an Instrumentation to count and time calls and count errors with, or None
+	# arg registry : a StockRegistry whose terms are used for the dividend yield and P/E Ratio of registered stocks, or None
+	# arg shared : a SharedTradeRing, or None. If this process created the ring every trade recorded is also written to
+	#              it. If the ring was attached from another process, trades are recorded by that process and
+	#              volumeWeightedStockPrice and GBCEAllShareIndex calculate from the ring's trades instead
+	def __init__ (self, streaming = False, columnar = False, journal = None, concurrent = False, clock = None, retention = None,
+			instrumentation = None, registry = None, shared = None):
+		self._tradesBySymbol = { }
+		self._symbols = [] # symbols in order of first trade, a symbol's position is its id
+		self._concurrent = concurrent
+		self._lock = self._newLock () # held while adding a stock's index or appending to the journal
+		self._indexLock = self._newLock () # held while calculating the All Share Index
+		self._allShareIndex = AllShareIndex (self._newLock ())
+		self._streaming = streaming
+		self._columnar = columnar
+		self._journal = journal
+		self._shared = shared
+		self._sharedReader = shared if shared is not None and not shared.writer () else None
+		self._sharedVersions = { } # maps symbol to the version of the stock's totals in the shared ring last read
+		self._clock = clock if clock is not None else WallClock ()
+		self._retention = retention
+		self._uncompacted = 0 # number of trades recorded since the last compaction
+		self._compactions = 0
+		self._terms = registry.termsByStock () if registry is not None else None
+		self._instrumentation = instrumentation
+		if instrumentation is not None:
+			# wrap methods on this object only, so an uninstrumented Trade pays nothing
+			for method in self.INSTRUMENTED:
+				setattr (self, method, instrumentation.wrap (method, getattr (self, method)))
+
+	# returns the Trade's instrumentation, or None
+	def instrumentation (self):
+		return self._instrumentation
 	
-	# log proxy method for doing something with error
-	def log (self, err):
-		pass
+	# log passes an error on to the instrumentation, if any
+	# arg method : the name of the method the error happened in
+	# arg e : the exception, or None
+	# arg message : a message format, formatted with args only if the message is used
+	# arg args : the values for the message format
+	def log (self, method, e, message, *args):
+		if self._instrumentation is not None:
+			self._instrumentation.error (method, e, message, args)
 		
 	# dividendYield calculates the dividend for a given stock and price dependent on whether Common or Preferred
 	# arg stock : the Stock object whose dividend is to be calculated
 	# arg price : the price to be used to calculate the dividend yield
 	# returns the dividend yield for the given stock or price, or -1 for failure
 	def dividendYield (self, stock, price):
+		if self._terms is not None:
+			terms = self._terms.get (stock)
+			if terms is not None:
+				# registered stock, already validated, so only the price can be bad
+				try:
+					result = terms [0] / float (price)
+					if result < 0:
+						raise NegativeValueError ()
+					return result
+				except Exception as e:
+					self.log ("dividendYield", e, "dividendYield(%s, %s) %s", stock.symbol (), price, e)
+				return -1 # indicates failure
 		result = -1 # assume failure
 		try:
 			if stock.type () == Type.Common:
@@ -125,20 +2372,20 @@ class Trade:
 				raise NegativeValueError () 
 		except ArithmeticError as e:
 			# handle arithmetic error
-			self.log ("dividendYield(%s, %d) ArithmeticError=%s" % (stock.symbol (), price, str(e)))
+			self.log ("dividendYield", e, "dividendYield(%s, %s) ArithmeticError=%s", stock.symbol (), price, e)
 		except TypeError as e:
 			# handle wrong type used in calculation
-			self.log ("dividendYield(%s, %d) TypeError=%s" % (stock.symbol (), price, str(e)))
+			self.log ("dividendYield", e, "dividendYield(%s, %s) TypeError=%s", stock.symbol (), price, e)
 		except UnknownStockTypeError as e:
 			# stock type was neither Common or Preferred
-			self.log ("dividendYield(%s, %d) %s" % (stock.symbol (), price, str(e)))
+			self.log ("dividendYield", e, "dividendYield(%s, %s) %s", stock.symbol (), price, e)
 		except NegativeValueError as e:
 			# handle negative result
 			result = -1 # indicate error
-			self.log ("dividendYield(%s, %d) %s" % (stock.symbol (), price, str(e)))
+			self.log ("dividendYield", e, "dividendYield(%s, %s) %s", stock.symbol (), price, e)
 		except Exception as e:
 			# catch any other error
-			self.log ("dividendYield(%s, %d) Error=%s" % (stock.symbol (), price, str(e)))
+			self.log ("dividendYield", e, "dividendYield(%s, %s) Error=%s", stock.symbol (), price, e)
 		return result
 	
 	# PERatio calculates the P/E Ratio for a given stock and price
@@ -146,6 +2393,18 @@ class Trade:
 	# arg price : the price to be used to calculate the P/E Ratio
 	# returns the P/E Ratio for the given stock or price, or -1 for failure
 	def PERatio (self, stock, price):
+		if self._terms is not None:
+			terms = self._terms.get (stock)
+			if terms is not None:
+				# registered stock, already validated, so only the price or a zero last dividend can be bad
+				try:
+					result = float (price) / terms [1]
+					if result < 0:
+						raise NegativeValueError ()
+					return result
+				except Exception as e:
+					self.log ("PERatio", e, "PERatio(%s, %s) %s", stock.symbol (), price, e)
+				return -1 # indicates failure
 		result = -1 # assume failure
 		try:
 			# calculate P/E Ratio, ensure price is float for calculation
@@ -155,116 +2414,1006 @@ class Trade:
 				raise NegativeValueError ()
 		except ArithmeticError as e:
 			# handle arithmetic error
-			self.log ("PERatio(%s, %d) ArithmeticError=%s" % (stock.symbol (), price, str(e)))
+			self.log ("PERatio", e, "PERatio(%s, %s) ArithmeticError=%s", stock.symbol (), price, e)
 		except TypeError as e:
 			# handle wrong type used in calculation
-			self.log ("PERatio(%s, %d) TypeError=%s" % (stock.symbol (), price, str(e)))
+			self.log ("PERatio", e, "PERatio(%s, %s) TypeError=%s", stock.symbol (), price, e)
 		except NegativeValueError as e:
 			# handle negative result
 			result = -1 # indicate error
-			self.log ("PERation(%s, %d) %s" % (stock.symbol (), price, str(e)))
+			self.log ("PERatio", e, "PERation(%s, %s) %s", stock.symbol (), price, e)
 		except Exception as e:
 			# catch any other error
-			self.log ("PERation(%s, %d) Error=%s" % (stock.symbol (), price, str(e)))
+			self.log ("PERatio", e, "PERation(%s, %s) Error=%s", stock.symbol (), price, e)
 		return result
 
+	# _dividendTerm returns the term divided by price to give the dividend yield for a stock, from the registry
+	# if the stock is registered or otherwise as calculated by dividendTerm
+	# arg stock : the Stock object whose dividend term is to be calculated
+	# returns the term as a float, or None for failure, and the ErrorCode of any failure
+	def _dividendTerm (self, stock):
+		terms = self._terms.get (stock) if self._terms is not None else None
+		if terms is not None:
+			return terms [0], ErrorCode.NoError
+		return dividendTerm (stock)
+
+	# _earningsTerm returns the term price is divided by to give the P/E Ratio for a stock, from the registry
+	# if the stock is registered or otherwise as calculated by earningsTerm
+	# arg stock : the Stock object whose earnings term is to be calculated
+	# returns the term as a float, or None for failure, and the ErrorCode of any failure
+	def _earningsTerm (self, stock):
+		terms = self._terms.get (stock) if self._terms is not None else None
+		if terms is not None:
+			return terms [1], ErrorCode.NoError
+		return earningsTerm (stock)
+
+	# batchDividendYield calculates the dividend yield for each of a sequence of stocks and prices
+	# the dividend term of each distinct stock is calculated once, leaving a division per price, done for every price
+	# in one array operation when NumPy is installed
+	# arg stocks : a sequence of Stock objects
+	# arg prices : a sequence of prices, the same length as stocks
+	# returns an array of dividend yields, -1 for failure, and an array of ErrorCode values
+	def batchDividendYield (self, stocks, prices):
+		if numpy is not None:
+			return self._batchDivide (stocks, prices, self._dividendTerm, True)
+		results = array.array ("d", [-1.0]) * len (prices)
+		errors = array.array ("b", [ErrorCode.NoError]) * len (prices)
+		terms = { }
+		for i in range (len (prices)):
+			stock = stocks [i]
+			if not stock in terms:
+				terms [stock] = self._dividendTerm (stock)
+			numerator, code = terms [stock]
+			if code == ErrorCode.NoError:
+				try:
+					result = numerator / float (prices [i])
+					if result < 0:
+						code = ErrorCode.NegativeValue
+					else:
+						results [i] = result
+				except Exception as e:
+					code = errorCode (e)
+			errors [i] = code
+		return results, errors
+
+	# batchPERatio calculates the P/E Ratio for each of a sequence of stocks and prices
+	# the earnings term of each distinct stock is calculated once, leaving a division per price, done for every price
+	# in one array operation when NumPy is installed
+	# arg stocks : a sequence of Stock objects
+	# arg prices : a sequence of prices, the same length as stocks
+	# returns an array of P/E Ratios, -1 for failure, and an array of ErrorCode values
+	def batchPERatio (self, stocks, prices):
+		if numpy is not None:
+			return self._batchDivide (stocks, prices, self._earningsTerm, False)
+		results = array.array ("d", [-1.0]) * len (prices)
+		errors = array.array ("b", [ErrorCode.NoError]) * len (prices)
+		terms = { }
+		for i in range (len (prices)):
+			stock = stocks [i]
+			if not stock in terms:
+				terms [stock] = self._earningsTerm (stock)
+			denominator, code = terms [stock]
+			if code == ErrorCode.NoError:
+				try:
+					result = float (prices [i]) / denominator
+					if result < 0:
+						code = ErrorCode.NegativeValue
+					else:
+						results [i] = result
+				except Exception as e:
+					code = errorCode (e)
+			errors [i] = code
+		return results, errors
+
+	# _batchDivide divides each stock's term by its price, or its price by its term, for every price at once with
+	# NumPy, failing prices as the division of one term and price would. Prices are converted with float, so a price
+	# that is not a number fails as it would for one price, then the failures are found by comparing arrays.
+	# arg stocks : a sequence of Stock objects
+	# arg prices : a sequence of prices, the same length as stocks
+	# arg term : a function returning a stock's term and the ErrorCode of any failure, as _dividendTerm does
+	# arg termOnTop : True to divide the terms by the prices, False to divide the prices by the terms
+	# returns an array of results, -1 for failure, and an array of ErrorCode values
+	def _batchDivide (self, stocks, prices, term, termOnTop):
+		count = len (prices)
+		positions = dict ((stock, position) for position, stock in enumerate (dict.fromkeys (stocks))) # maps stock to its position in the terms
+		ids = numpy.fromiter (map (positions.__getitem__, stocks), numpy.intp, count)
+		terms = numpy.empty (len (positions))
+		termErrors = numpy.empty (len (positions), numpy.int8)
+		for stock, position in positions.items ():
+			value, code = term (stock)
+			terms [position] = value if code == ErrorCode.NoError else math.nan
+			termErrors [position] = code
+		errors = termErrors [ids]
+		if isinstance (prices, (numpy.ndarray, array.array)) and numpy.asarray (prices).dtype == numpy.float64:
+			values = numpy.asarray (prices)
+		else:
+			try:
+				values = numpy.fromiter (map (float, prices), numpy.float64, count)
+			except Exception:
+				# a price that is not a number, convert one at a time to find which
+				values = numpy.empty (count)
+				for i, price in enumerate (prices):
+					try:
+						values [i] = float (price)
+					except Exception as e:
+						values [i] = math.nan
+						if errors [i] == ErrorCode.NoError:
+							errors [i] = errorCode (e)
+		terms = terms [ids]
+		with numpy.errstate (divide = "ignore", invalid = "ignore", over = "ignore"):
+			if termOnTop:
+				results = terms / values
+				divisors = values
+			else:
+				results = values / terms
+				divisors = terms
+		valid = errors == ErrorCode.NoError
+		errors [valid & (divisors == 0)] = ErrorCode.Arithmetic
+		valid = errors == ErrorCode.NoError
+		errors [valid & (results < 0)] = ErrorCode.NegativeValue
+		results [errors != ErrorCode.NoError] = -1.0
+		return array.array ("d", results.tobytes ()), array.array ("b", errors.tobytes ())
+
 	# recordTrade creates a TradeRecord object from trade data and adds to trade list
 	# arg stock : the stock being traded
 	# arg quantity : the quantity of stock traded
 	# arg buyorsell : indicates whether stock bought or sold
 	# arg price : the price of the trade
 	# arg timestamp : the date and time of the trade, defaults to now
-	def recordTrade (self, stock, quantity, buyorsell, price, timestamp = datetime.datetime.now ()):
-		tr = TradeRecord (stock, timestamp, quantity, buyorsell, price)
-		self._trades.append (tr)
+	# raises SharedRingError if trades are recorded by the process that created the Trade's shared ring
+	def recordTrade (self, stock, quantity, buyorsell, price, timestamp = None):
+		if self._sharedReader is not None:
+			raise SharedRingError ("%s is only read by this process" % self._sharedReader.name ())
+		if timestamp is None:
+			timestamp = self._clock.now ()
+		self._clock.advance (timestamp)
+		if self._journal is not None:
+			with self._lock:
+				self._journal.append (stock.symbol (), toEpoch (timestamp), quantity, buyorsell, price)
+		if self._shared is not None:
+			with self._lock:
+				self._shared.append (stock.symbol (), toEpoch (timestamp), quantity, buyorsell, price)
+		# add to time ordered index for the stock
+		index = self._index (stock)
+		with index.lock ():
+			index.insert (timestamp, quantity, buyorsell, price)
+			self._traded (index)
+		if self._retention is not None:
+			self._recorded (1)
+
+	# recordTrades records a number of trades in one go, much faster than calling recordTrade for each
+	# arg trades : a TradeBatch, or an iterable of (stock, quantity, buyorsell, price, timestamp) tuples
+	# arg chunkSize : the number of trades from an iterable of tuples to record at a time
+	# raises SharedRingError if trades are recorded by the process that created the Trade's shared ring
+	def recordTrades (self, trades, chunkSize = 65536):
+		if isinstance (trades, TradeBatch):
+			self._recordBatch (trades)
+			return
+		trades = iter (trades)
+		while True:
+			chunk = list (itertools.islice (trades, chunkSize))
+			if not chunk:
+				return
+			stocks, quantities, sides, prices, timestamps = zip (*chunk)
+			# keep the dates and times, seconds since the epoch are only worked out if a journal or shared ring needs them
+			self._recordBatch (TradeBatch (stocks, None, quantities, sides, prices, timestamps))
+
+	# loadTrades records every trade in a trade file, reading the file a chunk at a time
+	# arg path : the path of a CSV file as read by readCsvTrades, or a binary file as read by readBinaryTrades
+	# arg stocks : a dictionary mapping symbol to Stock
+	# arg binary : True if the file is a binary file
+	# arg chunkSize : the number of trades to read and record at a time
+	# arg header : True if the first row of a CSV file is a header to skip
+	# raises UnknownSymbolError for a symbol with no Stock, trades before it will have been recorded
+	# raises TradeFileError for a CSV row that cannot be read, trades in chunks before it will have been recorded
+	def loadTrades (self, path, stocks, binary = False, chunkSize = 65536, header = False):
+		if binary:
+			chunks = readBinaryTrades (path, chunkSize)
+		else:
+			chunks = readCsvTrades (path, chunkSize, header)
+		for batch in resolveSymbols (chunks, stocks):
+			self._recordBatch (batch)
+
+	# replay records every trade in a trade file of trades in timestamp order, as loadTrades does, reporting
+	# prices at each interval of the time the trades were recorded at. The Trade should have a SimulatedClock,
+	# so windows are taken up to the time of the trades being replayed rather than the current time.
+	# arg path : the path of a CSV file as read by readCsvTrades, or a binary file as read by readBinaryTrades
+	# arg stocks : a dictionary mapping symbol to Stock
+	# arg interval : the time between reports, a timedelta
+	# arg binary : True if the file is a binary file
+	# arg chunkSize : the number of trades to read and record at a time
+	# arg window : the window passed to volumeWeightedStockPrice
+	# arg header : True if the first row of a CSV file is a header to skip
+	# raises UnknownSymbolError for a symbol with no Stock
+	# raises TradeFileError for a CSV row that cannot be read
+	# yields a tuple for each report of the time, a dictionary mapping the symbol of each stock traded so far to its
+	# Volume Weighted Stock Price, and the GBCE All Share Index. Trades at the time of a report are not included,
+	# and a last report is made at the time of the last trade.
+	def replay (self, path, stocks, interval, binary = False, chunkSize = 65536, window = None, header = False):
+		if binary:
+			chunks = readBinaryTrades (path, chunkSize)
+		else:
+			chunks = readCsvTrades (path, chunkSize, header)
+		step = interval.total_seconds ()
+		report = None # time of the next report, as seconds since the epoch
+		for batch in resolveSymbols (chunks, stocks):
+			timestamps = batch.timestamps ()
+			if report is None and len (batch) > 0:
+				# first report at the first whole interval after the first trade
+				report = (math.floor (timestamps [0] / step) + 1) * step
+			lo = 0
+			while lo < len (batch):
+				hi = bisect.bisect_left (timestamps, report, lo)
+				if hi > lo:
+					self._recordBatch (batch.slice (lo, hi))
+					lo = hi
+				if lo < len (batch):
+					# next trade is at or after the report
+					self._clock.advance (fromEpoch (report))
+					yield self._report (window)
+					report += step
+		if report is not None:
+			yield self._report (window)
+
+	# _report calculates prices for a report from replay
+	# arg window : the window passed to volumeWeightedStockPrice
+	# returns a tuple of the time, a dictionary mapping symbol to Volume Weighted Stock Price, and the GBCE All Share Index
+	def _report (self, window = None):
+		prices = { }
+		for symbol in list (self._symbols):
+			prices [symbol] = self.volumeWeightedStockPrice (self._tradesBySymbol [symbol].stock (), window)
+		return self._clock.now (), prices, self.GBCEAllShareIndex ()
+
+	# checkpoint writes a checkpoint of the trades recorded alongside the journal, so recover only has to
+	# replay journal records after it
+	# arg now : the date and time the window is up to, defaults to now
+	# arg window : how far before now trades are kept as records, defaults to the five minutes volumeWeightedStockPrice uses
+	def checkpoint (self, now = None, window = datetime.timedelta (minutes=5)):
+		if now is None:
+			now = self._clock.now ()
+		with self._lock:
+			self._journal.sync ()
+			count = len (self._journal)
+			symbols = list (self._symbols)
+		stocks = []
+		for symbol in symbols:
+			index = self._tradesBySymbol [symbol]
+			with index.lock ():
+				folded, totals, columns = index.checkpoint (now - window)
+			stocks.append ((symbol, folded, totals, columns))
+		self._journal.writeCheckpoint (count, stocks)
+
+	# recover rebuilds the trades recorded in the journal, after a restart, from the journal's checkpoint and the
+	# journal records after it. Trades within the window before now are recorded as usual. Older trades are only
+	# added to each stock's totals for the All Share Index.
+	# arg stocks : a dictionary mapping symbol to Stock
+	# arg now : the date and time the window is up to, defaults to now
+	# arg window : how far before now trades are kept, defaults to the five minutes volumeWeightedStockPrice uses
+	# arg chunkSize : the number of journal records to replay at a time
+	# raises UnknownSymbolError for a symbol with no Stock, JournalError for a bad checkpoint
+	def recover (self, stocks, now = None, window = datetime.timedelta (minutes=5), chunkSize = 65536):
+		if now is None:
+			now = self._clock.now ()
+		position, checkpoint = self._journal.readCheckpoint ()
+		for symbol, folded, totals, columns in checkpoint:
+			if not symbol in stocks:
+				raise UnknownSymbolError (symbol)
+			index = self._index (stocks [symbol])
+			with index.lock ():
+				index.compactAggregates (folded, totals)
+				self._traded (index)
+			self._insertBatch (TradeBatch ([stocks [symbol]] * len (columns [0]), *columns))
+		start = toEpoch (now - window)
+		for batch in resolveSymbols (self._journal.chunks (chunkSize, position), stocks):
+			recent = list (map (start.__lt__, batch.timestamps ()))
+			if all (recent):
+				self._insertBatch (batch)
+				continue
+			self._insertBatch (batch.select (recent))
+			for stock, timestamps, quantities, sides, prices in self._groupBatch (batch.select ([not flag for flag in recent])):
+				index = self._index (stock)
+				with index.lock ():
+					index.compactMany (prices, quantities)
+					self._traded (index)
+
+	# compact applies the retention policy, compacting each stock's trades older than it keeps
+	# arg now : the date and time now, defaults to the clock's time
+	def compact (self, now = None):
+		if now is None:
+			now = self._clock.now ()
+		for symbol in list (self._symbols):
+			index = self._tradesBySymbol [symbol]
+			with index.lock ():
+				index.compactOldest (self._retention.expired (index, now))
+		with self._lock:
+			self._compactions += 1
+
+	# retentionMetrics returns how many trades are kept as records and how many have been compacted
+	# returns a dictionary of the number of trade records retained, the number of trades compacted, the number of
+	# prices trades are compacted at, and the number of compactions
+	def retentionMetrics (self):
+		metrics = { "retained" : 0, "compacted" : 0, "compactedPrices" : 0, "compactions" : self._compactions }
+		for symbol in list (self._symbols):
+			index = self._tradesBySymbol [symbol]
+			with index.lock ():
+				metrics ["retained"] += len (index)
+				metrics ["compacted"] += index.compacted ()
+				metrics ["compactedPrices"] += index.compactedPrices ()
+		return metrics
+
+	# _recorded counts trades recorded, compacting when the retention policy says to
+	# arg count : the number of trades recorded
+	def _recorded (self, count):
+		with self._lock:
+			self._uncompacted += count
+			due = self._uncompacted >= self._retention.every ()
+			if due:
+				self._uncompacted = 0
+		if due:
+			self.compact ()
+
+	# _recordBatch records a batch of trades, appending them to the journal
+	# arg batch : the TradeBatch to record
+	# raises SharedRingError if trades are recorded by the process that created the Trade's shared ring
+	def _recordBatch (self, batch):
+		if self._sharedReader is not None:
+			raise SharedRingError ("%s is only read by this process" % self._sharedReader.name ())
+		if self._journal is not None:
+			with self._lock:
+				self._journal.appendMany (batch)
+		if self._shared is not None:
+			with self._lock:
+				self._shared.appendMany (batch)
+		self._insertBatch (batch)
+		if self._retention is not None:
+			self._recorded (len (batch))
+
+	# _insertBatch adds a batch of trades to the index of each stock traded
+	# arg batch : the TradeBatch to add
+	def _insertBatch (self, batch):
+		datetimes = batch.datetimes ()
+		if len (batch) > 0:
+			self._clock.advance (fromEpoch (max (batch.timestamps ())) if datetimes is None else max (datetimes))
+		for stock, timestamps, quantities, sides, prices in self._groupBatch (batch):
+			index = self._index (stock)
+			if datetimes is not None:
+				keys = index.keysFromDatetimes (timestamps)
+			else:
+				keys = index.keysFromEpoch (timestamps)
+			with index.lock ():
+				index.insertMany (keys, quantities, sides, prices)
+				self._traded (index)
+
+	# _groupBatch sorts a batch of trades by stock
+	# arg batch : the TradeBatch to sort
+	# yields a tuple of stock and lists of timestamps, quantities, sides and prices for each stock in the batch, with
+	# timestamps as dates and times if the batch was made with them, otherwise as seconds since the epoch
+	def _groupBatch (self, batch):
+		count = len (batch)
+		if count == 0:
+			return
+		# number each stock in the batch, then stable sort trades by stock number so trades for
+		# each stock are together and still in the order they appear in the batch
+		numbers = { }
+		for stock in dict.fromkeys (batch.stocks ()):
+			numbers [stock] = len (numbers)
+		stockNumbers = list (map (numbers.__getitem__, batch.stocks ()))
+		order = sorted (range (count), key = stockNumbers.__getitem__)
+		if count == 1:
+			gather = lambda column: [column [0]]
+		else:
+			getter = operator.itemgetter (*order)
+			gather = lambda column: list (getter (column))
+		stockNumbers = gather (stockNumbers)
+		datetimes = batch.datetimes ()
+		timestamps = gather (batch.timestamps () if datetimes is None else datetimes)
+		quantities = gather (batch.quantities ())
+		sides = gather (batch.sides ())
+		prices = gather (batch.prices ())
+		lo = 0
+		for stock in numbers:
+			hi = bisect.bisect_right (stockNumbers, numbers [stock], lo)
+			yield stock, timestamps [lo:hi], quantities [lo:hi], sides [lo:hi], prices [lo:hi]
+			lo = hi
+
+	# _traded marks a stock as traded since the All Share Index last took its price, called with the stock's index
+	# locked. Only the first trade since then adds the stock to the All Share Index's changed stocks, so the All
+	# Share Index's lock is not taken for every trade.
+	# arg index : the SymbolTrades index of the stock traded
+	def _traded (self, index):
+		if index.markTraded ():
+			self._allShareIndex.stockTraded (index.stock ().symbol ())
+
+	# _index returns the time ordered trade index for a stock, creating it on the stock's first trade
+	# arg stock : the stock being traded
+	def _index (self, stock):
+		index = self._tradesBySymbol.get (stock.symbol ())
+		if index is None:
+			with self._lock:
+				# check again in case another thread added the index first
+				index = self._tradesBySymbol.get (stock.symbol ())
+				if index is None:
+					index = self._tradesBySymbol [stock.symbol ()] = self._newIndex (stock)
+					self._symbols.append (stock.symbol ())
+		return index
+
+	# _newLock creates a lock if trades may be recorded from several threads at once
+	# returns a new lock, or NO_LOCK
+	def _newLock (self):
+		if self._concurrent:
+			return threading.Lock ()
+		return NO_LOCK
+
+	# _newIndex creates the time ordered trade index for a stock on its first trade
+	# arg stock : the stock being traded
+	# returns the new index
+	def _newIndex (self, stock):
+		if self._columnar:
+			return ColumnarSymbolTrades (stock, self._newLock ())
+		return SymbolTrades (stock, self._newLock ())
+
+	# trades returns trade records for every trade recorded, sorted by timestamp within each stock
+	# returns a list of TradeRecord objects
+	def trades (self):
+		result = []
+		for symbol in list (self._symbols):
+			index = self._tradesBySymbol [symbol]
+			with index.lock ():
+				result.extend (index.trades ())
+		return result
 	
 	# calculateVolumeWeightedStockPrice calculates the Volume Weighted Stock Price for a list for trade records
+	# The totals are added up from exact products with math.fsum, so the result is the same as exact running totals
+	# give for the same trades whenever the quantities at each price add up exactly, as whole quantities always do
 	# arg trades : a dictionary of trade records
 	# returns the Volume Weighted Stock Price for the given trades or -1 for failure
 	def calculateVolumeWeightedStockPrice (self, trades):
 		totalAmountPaid = 0.0
 		totalQuantity = 0.0
 		try:
-			# iterate trade records to get total amount paid and total quantity
+			# iterate trade records to get the exact parts of the total amount paid, and the quantities
+			amounts = []
+			quantities = []
 			for price in trades:
 				quantity = trades [price]
 				# raise error if negative price or quantity
 				if price < 0 or quantity < 0:
 					raise NegativeValueError ()
-				totalAmountPaid += (price * quantity)
-				totalQuantity += quantity
+				amounts.extend (productParts (0.0 + price, 0.0 + quantity))
+				quantities.append (quantity)
+			totalAmountPaid = math.fsum (amounts)
+			totalQuantity = math.fsum (quantities)
+			if not math.isfinite (totalAmountPaid) or not math.isfinite (totalQuantity):
+				raise OverflowError ("total not finite")
 			
 			# perform calculation
 			return totalAmountPaid / totalQuantity
 		except ArithmeticError as e:
 			# handle arithmetic error
-			self.log ("calculateVolumeWeightedStockPrice %d %d %s" % (totalAmountPaid, totalQuantity, str (e)))
+			self.log ("calculateVolumeWeightedStockPrice", e, "calculateVolumeWeightedStockPrice %d %d %s", totalAmountPaid, totalQuantity, e)
+		except NegativeValueError as e:
+			# handle negative value
+			self.log ("calculateVolumeWeightedStockPrice", e, "calculateVolumeWeightedStockPrice %d %d %s", totalAmountPaid, totalQuantity, e)
+		except Exception as e:
+			# catch any other error
+			self.log ("calculateVolumeWeightedStockPrice", e, "calculateVolumeWeightedStockPrice %d %d %s", totalAmountPaid, totalQuantity, e)
+		return -1 # indicates failure
+
+	# calculateRunningVolumeWeightedStockPrice calculates the Volume Weighted Stock Price from running totals
+	# arg totals : a VolumeWeightedTotals object
+	# returns the Volume Weighted Stock Price for the given totals or -1 for failure
+	def calculateRunningVolumeWeightedStockPrice (self, totals):
+		try:
+			# perform calculation
+			return totals.calculate ()
+		except ArithmeticError as e:
+			# handle arithmetic error
+			self.log ("calculateRunningVolumeWeightedStockPrice", e, "calculateRunningVolumeWeightedStockPrice %d %d %s", totals.totalAmountPaid (), totals.totalQuantity (), e)
 		except NegativeValueError as e:
 			# handle negative value
-			self.log ("calculateVolumeWeightedStockPrice %d %d %s" % (totalAmountPaid, totalQuantity, str (e)))
+			self.log ("calculateRunningVolumeWeightedStockPrice", e, "calculateRunningVolumeWeightedStockPrice %d %d %s", totals.totalAmountPaid (), totals.totalQuantity (), e)
 		except Exception as e:
 			# catch any other error
-			self.log ("calculateVolumeWeightedStockPrice %d %d %s" % (totalAmountPaid, totalQuantity, str (e)))
+			self.log ("calculateRunningVolumeWeightedStockPrice", e, "calculateRunningVolumeWeightedStockPrice %d %d %s", totals.totalAmountPaid (), totals.totalQuantity (), e)
 		return -1 # indicates failure
 		
 	# volumeWeightedStockPrice calculates the Volume Weighted Stock Price for a list for trade records for a given stock in the past five minutes
 	# arg stock : the stock to calculate the Volume Weighted Stock Price from trade records in the last five minutes
+	# arg window : how far back to calculate the Volume Weighted Stock Price over instead of five minutes, or None.
+	#              A window is added up from the stock's time buckets, so a long window costs about the same as a short one
 	# return the Volume Weighted Stock Price of the given stock in the past five minutes, or -1 for failure
-	def volumeWeightedStockPrice (self, stock):
-		# create dictionary of trade records for specified stock in the past five minutes
-		now = datetime.datetime.now ()
+	def volumeWeightedStockPrice (self, stock, window = None):
+		now = self._clock.now ()
+		if self._sharedReader is not None:
+			# trades are recorded by another process, calculate from the shared ring
+			start = now - (window if window is not None else datetime.timedelta (minutes=5))
+			return self.calculateVolumeWeightedStockPrice (self._sharedReader.recentTrades (stock.symbol (), toEpoch (start), toEpoch (now)))
+		index = self._tradesBySymbol.get (stock.symbol ())
+		if window is not None and index is not None:
+			with index.lock ():
+				totalAmountPaid, totalQuantity, irregular = index.timeBuckets ().totals (now - window, now)
+				if irregular > 0:
+					# negative or non-numeric data, calculate from the trade records to fail or not as they would
+					return self.calculateVolumeWeightedStockPrice (self._recentTrades (index, now - window, now))
+			try:
+				return exactQuotient (totalAmountPaid, totalQuantity)
+			except ArithmeticError as e:
+				# handle arithmetic error
+				self.log ("volumeWeightedStockPrice", e, "volumeWeightedStockPrice(%s) %s", stock.symbol (), e)
+			return -1 # indicates failure
 		fiveMinutesAgo = now - datetime.timedelta (minutes=5)
 		recentTrades = {}
-		for trade in self._trades:
-			if trade.stock () == stock and trade.timestamp () > fiveMinutesAgo and trade.timestamp () < now:
-				if not trade.price () in recentTrades:
-					recentTrades [trade.price ()] = 0.0
-				recentTrades [trade.price ()] += trade.quantity ()
+		if self._streaming and index is not None:
+			# move the stock's window along and calculate from its running totals
+			with index.lock ():
+				return self.calculateRunningVolumeWeightedStockPrice (index.slidingWindow ().move (fiveMinutesAgo, now))
+		if index is not None:
+			with index.lock ():
+				recentTrades = self._recentTrades (index, fiveMinutesAgo, now)
 		
 		# perform calculation
 		return self.calculateVolumeWeightedStockPrice (recentTrades)
+
+	# snapshot calculates prices and volumes for every stock from one pass over the trades in each stock's window,
+	# along with the GBCE All Share Index, instead of a call per stock and per figure
+	# arg window : how far back to take trades from, defaults to the five minutes volumeWeightedStockPrice uses
+	# returns a dictionary of the time now, the GBCE All Share Index, and a dictionary mapping the symbol of each stock
+	# traded to a dictionary of its Volume Weighted Stock Price, the Volume Weighted Stock Price and volume of buys and
+	# of sells, the number of trades, and the highest and lowest price, in the window. Prices are -1 for failure, and
+	# the highest and lowest price None if there are no trades or they cannot be compared
+	def snapshot (self, window = datetime.timedelta (minutes=5)):
+		now = self._clock.now ()
+		start = now - window
+		stocks = { }
+		for symbol in list (self._symbols):
+			index = self._tradesBySymbol [symbol]
+			# trades by price, for all trades then for buys and sells
+			recentTrades = {}
+			sideTrades = { BuyOrSell.Buy : {}, BuyOrSell.Sell : {} }
+			with index.lock ():
+				lo, hi = index.positions (start, now)
+				for price, quantity, side in index.pricesQuantitiesAndSides (lo, hi):
+					recentTrades [price] = recentTrades.get (price, 0.0) + quantity
+					trades = sideTrades.get (side)
+					if trades is not None:
+						trades [price] = trades.get (price, 0.0) + quantity
+			try:
+				high, low = max (recentTrades), min (recentTrades)
+			except Exception:
+				high = low = None
+			buys = sideTrades [BuyOrSell.Buy]
+			sells = sideTrades [BuyOrSell.Sell]
+			stocks [symbol] = {
+				"volumeWeightedStockPrice" : self.calculateVolumeWeightedStockPrice (recentTrades),
+				"buyVolumeWeightedStockPrice" : self.calculateVolumeWeightedStockPrice (buys),
+				"buyVolume" : self._volume (buys),
+				"sellVolumeWeightedStockPrice" : self.calculateVolumeWeightedStockPrice (sells),
+				"sellVolume" : self._volume (sells),
+				"trades" : hi - lo,
+				"high" : high,
+				"low" : low }
+		return { "time" : now, "allShareIndex" : self.GBCEAllShareIndex (), "stocks" : stocks }
+
+	# _volume adds up the quantities of trades
+	# arg trades : a dictionary mapping price to total quantity
+	# returns the total quantity, or -1 for failure
+	def _volume (self, trades):
+		try:
+			return sum (trades.values (), 0.0)
+		except Exception as e:
+			self.log ("snapshot", e, "snapshot volume %s", e)
+		return -1 # indicates failure
+
+	# exportTrades copies the trades of every stock between two times into contiguous typed columns, so they can be
+	# read in bulk without a Python object per trade. Trades kept in columns are copied a column at a time.
+	# The columns are new, so trades recorded afterwards do not change them.
+	# arg start : the exclusive lower bound of the time range, defaults to five minutes ago
+	# arg end : the exclusive upper bound of the time range, defaults to now
+	# arg numpyArrays : if True, return the columns as NumPy arrays over the same memory instead of memoryviews
+	# raises TypeError if a trade kept as a TradeRecord has a non-numeric quantity or price
+	# raises ImportError if NumPy arrays are asked for and NumPy is not installed
+	# returns a dictionary with "symbols", a list of the symbols of the stocks traded where a symbol's position is
+	# its id, and columns "stocks" of stock ids, "timestamps" as seconds since the epoch, "quantities", "sides" and
+	# "prices", with the trades of each stock together in time order
+	def exportTrades (self, start = None, end = None, numpyArrays = False):
+		if numpyArrays and numpy is None:
+			raise ImportError ("NumPy is not installed")
+		if end is None:
+			end = self._clock.now ()
+		if start is None:
+			start = end - datetime.timedelta (minutes=5)
+		symbols = list (self._symbols)
+		stocks = array.array ("I")
+		columns = (array.array ("d"), array.array ("d"), array.array ("b"), array.array ("d"))
+		for id, symbol in enumerate (symbols):
+			index = self._tradesBySymbol [symbol]
+			with index.lock ():
+				lo, hi = index.positions (start, end)
+				if hi > lo:
+					index.exportColumns (lo, hi, columns)
+			stocks += array.array ("I", [id]) * (hi - lo)
+		export = { "symbols" : symbols }
+		for name, column in zip (["stocks", "timestamps", "quantities", "sides", "prices"], (stocks,) + columns):
+			export [name] = numpy.asarray (column) if numpyArrays else memoryview (column)
+		return export
+
+	# packSnapshot writes a snapshot of prices and volumes for every stock and the GBCE All Share Index in the
+	# binary layout given by SNAPSHOT_HEADER and SNAPSHOT_STOCK, to be read back with unpackSnapshot
+	# arg window : how far back to take trades from, defaults to five minutes
+	# raises ValueError if a symbol is longer than 8 characters
+	# returns the bytes of the snapshot
+	def packSnapshot (self, window = datetime.timedelta (minutes=5)):
+		snapshot = self.snapshot (window)
+		parts = [SNAPSHOT_HEADER.pack (SNAPSHOT_MAGIC, toEpoch (snapshot ["time"]), snapshot ["allShareIndex"], len (snapshot ["stocks"]))]
+		for symbol, figures in snapshot ["stocks"].items ():
+			padded = symbol.encode ("ascii")
+			if len (padded) > 8:
+				raise ValueError ("symbol %s longer than 8 characters" % symbol)
+			high, low = [value if isinstance (value, (int, float)) else math.nan for value in (figures ["high"], figures ["low"])]
+			parts.append (SNAPSHOT_STOCK.pack (padded, figures ["volumeWeightedStockPrice"], figures ["buyVolumeWeightedStockPrice"],
+				figures ["buyVolume"], figures ["sellVolumeWeightedStockPrice"], figures ["sellVolume"], figures ["trades"], high, low))
+		return b"".join (parts)
+
+	# _recentTrades creates a dictionary of trade records for a stock between two times, using binary search
+	# on the stock's time ordered index to find them
+	# arg index : the stock's index
+	# arg start : the exclusive lower bound of the time range
+	# arg end : the exclusive upper bound of the time range
+	# returns a dictionary mapping price to total quantity
+	def _recentTrades (self, index, start, end):
+		recentTrades = {}
+		lo, hi = index.positions (start, end)
+		for price, quantity in index.pricesAndQuantities (lo, hi):
+			if not price in recentTrades:
+				recentTrades [price] = 0.0
+			recentTrades [price] += quantity
+		return recentTrades
 		
-	# GBCEAllShareIndex calculates the GBCE All Share Index using the geometric mean of the Volume Weighted 
-	# Stock Price for all stocks by sorting trade records by stock, then per stock sorting the trade records
-	# by price and quantity, then calculating the Volume Weighted Stock Price for the stock. The geometric 
-	# mean is then calculated from the Volume Weighted Stock Prices for each stock.
+	# GBCEAllShareIndex calculates the GBCE All Share Index using the geometric mean of the Volume Weighted
+	# Stock Price for all stocks. Each stock keeps running totals of its trades by price and quantity as trades
+	# are recorded, so only the Volume Weighted Stock Prices of stocks traded since the last call are
+	# recalculated. The geometric mean is then taken from the running sum of logs of those prices.
 	# return the GBCE All Share Index
 	def GBCEAllShareIndex (self):
-		# sort trades by stock
-		stocks = { }
-		for trade in self._trades:
-			sym = trade.stock ().symbol ()
-			if not sym in stocks:
-				stocks [sym] = []
-			stocks [sym].append (trade)
-		
-		result = 1.0
-		for symbol in stocks:
-			trades = stocks [symbol]
-			tradeQuantitiesByPrice = { }
-			# sort trades by price and quantity
-			for trade in trades:
-				if not trade.price () in tradeQuantitiesByPrice:
-					tradeQuantitiesByPrice [trade.price ()] = 0.0
-				tradeQuantitiesByPrice [trade.price ()] += trade.quantity ()
-			# get volume weighted stock price for stock
-			volumeWeightedStockPrice = self.calculateVolumeWeightedStockPrice (tradeQuantitiesByPrice)
-			if (volumeWeightedStockPrice < 0):
-				# something has gone wrong, exit with error here
-				return volumeWeightedStockPrice
-			result *= volumeWeightedStockPrice
-		
+		with self._indexLock:
+			if self._sharedReader is not None:
+				# trades are recorded by another process, update from the totals in the shared ring
+				self._updateFromShared ()
+			# update volume weighted stock price for stocks traded since last call
+			for symbol in self._allShareIndex.changed ():
+				index = self._tradesBySymbol [symbol]
+				with index.lock ():
+					index.clearTraded ()
+					price = self.calculateRunningVolumeWeightedStockPrice (index.totals ())
+				self._allShareIndex.update (symbol, price)
+			if self._allShareIndex.failures () > 0:
+				# something has gone wrong with at least one stock, exit with error here
+				return -1
+			
+			try:
+				# perform calculation
+				return self._allShareIndex.calculate ()
+			except ArithmeticError as e:
+				# handle arithmetic error
+				self.log ("GBCEAllShareIndex", e, "GBCEAllShareIndex %s", e)
+			except Exception as e:
+				# catch any other error
+				self.log ("GBCEAllShareIndex", e, "GBCEAllShareIndex %s", e)
+			return -1 # indicates failure
+
+	# _updateFromShared updates the Volume Weighted Stock Prices in the All Share Index of stocks traded in the shared
+	# ring since they were last updated. A stock with any trade of negative price or quantity fails.
+	def _updateFromShared (self):
+		for symbol, totalAmountPaid, totalQuantity, irregular in self._sharedReader.changedTotals (self._sharedVersions):
+			price = -1 # indicates failure
+			try:
+				if irregular > 0:
+					raise NegativeValueError ()
+				price = totalAmountPaid / totalQuantity
+			except ArithmeticError as e:
+				# handle arithmetic error
+				self.log ("GBCEAllShareIndex", e, "GBCEAllShareIndex(%s) %d %d %s", symbol, totalAmountPaid, totalQuantity, e)
+			except NegativeValueError as e:
+				# handle negative value
+				self.log ("GBCEAllShareIndex", e, "GBCEAllShareIndex(%s) %d %d %s", symbol, totalAmountPaid, totalQuantity, e)
+			self._allShareIndex.update (symbol, price)
+
+	# shardedGBCEAllShareIndex calculates the GBCE All Share Index from every trade recorded, rather than from running
+	# totals, splitting the stocks into shards across a pool of worker processes. Each stock's trades are copied
+	# while every index is locked, then the locks are released before the workers are forked, so they read the
+	# copies without them being pickled and never wait on a lock. Each worker returns the sum of the logs of its
+	# stocks' Volume Weighted Stock Prices, which are merged into the geometric mean.
+	# Columnar storage copies its price and quantity columns as arrays. Default storage can only copy each stock's
+	# list of TradeRecord objects, leaving the workers to read every record's price and quantity, so it gains less
+	# from sharding, and with processes 0 that is done serially in this process.
+	# arg processes : the number of worker processes, defaults to the number of CPUs, 0 to calculate in this process
+	# arg shards : the number of shards to split the stocks into, defaults to four per process
+	# return the GBCE All Share Index
+	def shardedGBCEAllShareIndex (self, processes = None, shards = None):
+		global _shardSnapshots
+		if processes is None:
+			processes = os.cpu_count () or 1
+		if shards is None:
+			shards = processes * 4
+		symbols = list (self._symbols)
+		with contextlib.ExitStack () as stack:
+			# keep every index still while it is copied, so the copies are a consistent set of trades
+			for symbol in symbols:
+				stack.enter_context (self._tradesBySymbol [symbol].lock ())
+			snapshots = [self._tradesBySymbol [symbol].totalsSnapshot () for symbol in symbols]
+		positions = range (len (symbols))
+		_shardSnapshots = snapshots
 		try:
-			# perform calculation
-			return result ** (1.0 / float (len (stocks)))
-		except ArithmeticError as e:
-			# handle arithmetic error
-			self.log ("calculateVolumeWeightedStockPrice %s" % str (e))
+			if processes == 0:
+				partials = [shardLogSum (positions)]
+			else:
+				with multiprocessing.get_context ("fork").Pool (processes) as pool:
+					partials = pool.map (shardLogSum, [positions [i::shards] for i in range (shards)])
+		finally:
+			_shardSnapshots = None
+		logSum = math.fsum (partial [0] for partial in partials)
+		count = sum (partial [1] for partial in partials)
+		zeros = sum (partial [2] for partial in partials)
+		failures = sum (partial [3] for partial in partials)
+		if count == 0 or failures > 0:
+			# no stocks, or something has gone wrong with at least one stock
+			return -1
+		if zeros > 0:
+			return 0.0
+		if count == 1:
+			# geometric mean of a single price is the price itself
+			for partial in partials:
+				if partial [1] == 1:
+					return partial [4]
+		return math.exp (logSum * (1.0 / float (count)))
+
+# TradeFeedServer class to record trades sent over a TCP or Unix socket into a Trade, and answer Volume Weighted
+# Stock Price and All Share Index queries, on an asyncio event loop. Each message starts with a HEADER of kind,
+# symbol padded with nulls to 8 bytes and count. A TRADES message is followed by count TRADE_RECORD trades and
+# has no reply. A PRICE message asks for the Volume Weighted Stock Price of the symbol, and an INDEX message for
+# the GBCE All Share Index, each answered with a REPLY holding the price, or -1 for failure.
+#
+# Messages from every connection go on one bounded queue. Trades waiting on the queue are recorded together
+# in batches, and queries are answered in turn, so a query sees every trade sent before it on its connection.
+# When the queue is full connections stop being read until it has room, so a client sending trades faster
+# than they can be recorded is held back by the socket rather than the server's memory growing.
+class TradeFeedServer:
+	HEADER = struct.Struct ("<c8sI") # kind, symbol, number of trades
+	REPLY = struct.Struct ("<d") # price
+	TRADES = b"T"
+	PRICE = b"V"
+	INDEX = b"I"
+
+	# TradeFeedServer constructor
+	# arg trade : the Trade to record trades into
+	# arg stocks : a dictionary mapping symbol to Stock
+	# arg batchSize : the most trades to record in one batch, a connection sending a message of more trades is closed
+	# arg maxPending : the most messages to queue before connections stop being read
+	def __init__ (self, trade, stocks, batchSize = 65536, maxPending = 64):
+		self._trade = trade
+		self._stocks = stocks
+		self._batchSize = batchSize
+		self._maxPending = maxPending
+		self._names = { } # maps padded symbol bytes to symbol
+		self._queue = None
+		self._server = None
+		self._consumer = None
+		self._connections = { } # maps the task serving each open connection to its StreamWriter
+		self._recorded = 0
+
+	# log passes an error on to the Trade's instrumentation
+	# arg method : the name of the method the error happened in
+	# arg e : the exception, or None
+	# arg message : a message format, formatted with args only if the message is used
+	# arg args : the values for the message format
+	def log (self, method, e, message, *args):
+		self._trade.log (method, e, message, *args)
+
+	# returns the number of trades recorded
+	def recorded (self):
+		return self._recorded
+
+	# returns the number of messages queued
+	def pending (self):
+		return self._queue.qsize ()
+
+	# start starts listening for connections, on a Unix socket if a path is given or otherwise on a TCP port
+	# arg path : the path of the Unix socket, or None
+	# arg host : the host to listen on for TCP
+	# arg port : the TCP port to listen on, 0 picks a free port
+	# returns the path of the Unix socket, or the host and port listened on
+	async def start (self, path = None, host = "127.0.0.1", port = 0):
+		self._queue = asyncio.Queue (self._maxPending)
+		self._consumer = asyncio.ensure_future (self._consume ())
+		if path is not None:
+			self._server = await asyncio.start_unix_server (self._serve, path)
+			return path
+		self._server = await asyncio.start_server (self._serve, host, port)
+		return self._server.sockets [0].getsockname () [:2]
+
+	# close stops listening for connections and closes those open, once trades already queued have been recorded
+	async def close (self):
+		self._server.close ()
+		await self._server.wait_closed ()
+		for writer in self._connections.values ():
+			writer.close ()
+		await asyncio.gather (*self._connections)
+		await self._queue.join ()
+		self._consumer.cancel ()
+
+	# _serve reads messages from a connection until it closes
+	# arg reader : the StreamReader of the connection
+	# arg writer : the StreamWriter of the connection
+	async def _serve (self, reader, writer):
+		loop = asyncio.get_running_loop ()
+		self._connections [asyncio.current_task ()] = writer
+		try:
+			while True:
+				try:
+					header = await reader.readexactly (self.HEADER.size)
+				except asyncio.IncompleteReadError:
+					break
+				kind, symbol, count = self.HEADER.unpack (header)
+				if kind == self.TRADES:
+					if count > self._batchSize:
+						# reading the message would buffer it whole, however big, so refuse it
+						self.log ("TradeFeedServer", None, "TradeFeedServer message of %d trades larger than batch size %d", count, self._batchSize)
+						break
+					data = await reader.readexactly (count * TRADE_RECORD.size)
+					await self._queue.put ((kind, data, None))
+				elif kind == self.PRICE or kind == self.INDEX:
+					reply = loop.create_future ()
+					await self._queue.put ((kind, symbol, reply))
+					writer.write (self.REPLY.pack (await reply))
+					await writer.drain ()
+				else:
+					self.log ("TradeFeedServer", None, "TradeFeedServer unknown message kind %r", kind)
+					break
+		except (asyncio.IncompleteReadError, ConnectionError) as e:
+			# connection closed part way through a message
+			self.log ("TradeFeedServer", e, "TradeFeedServer %s", e)
+		finally:
+			del self._connections [asyncio.current_task ()]
+			writer.close ()
+
+	# _consume takes messages off the queue, recording trades in batches and answering queries, until cancelled
+	async def _consume (self):
+		while True:
+			messages = [await self._queue.get ()]
+			trades = 0
+			while not self._queue.empty () and trades < self._batchSize:
+				message = self._queue.get_nowait ()
+				if message [0] == self.TRADES:
+					trades += len (message [1]) // TRADE_RECORD.size
+				messages.append (message)
+			data = []
+			try:
+				for kind, payload, reply in messages:
+					if kind == self.TRADES:
+						data.append (payload)
+						continue
+					# record trades sent before the query first
+					self._record (data)
+					data = []
+					if not reply.done ():
+						# not cancelled by its connection closing
+						reply.set_result (self._answer (kind, payload))
+				self._record (data)
+			except Exception as e:
+				# keep consuming, answering any query not yet answered with failure
+				self.log ("TradeFeedServer", e, "TradeFeedServer %s", e)
+				for kind, payload, reply in messages:
+					if reply is not None and not reply.done ():
+						reply.set_result (-1)
+			finally:
+				for message in messages:
+					self._queue.task_done ()
+
+	# _record records buffers of TRADE_RECORD trades in one batch, leaving out trades of unknown stocks and
+	# buffers that cannot be read
+	# arg payloads : a list of buffers each holding whole TRADE_RECORD trades
+	def _record (self, payloads):
+		payloads = [payload for payload in payloads if payload]
+		if not payloads:
+			return
+		try:
+			columns = unpackTrades (b"".join (payloads), self._names)
+		except Exception:
+			# read each buffer on its own, so only those that cannot be read are lost
+			columns = ([], [], [], [], [])
+			for payload in payloads:
+				try:
+					for column, values in zip (columns, unpackTrades (payload, self._names)):
+						column.extend (values)
+				except Exception as e:
+					self.log ("TradeFeedServer", e, "TradeFeedServer unreadable trades %s", e)
+		symbols, timestamps, quantities, sides, prices = columns
+		batch = TradeBatch (list (map (self._stocks.get, symbols)), timestamps, quantities, sides, prices)
+		if None in batch.stocks ():
+			known = [stock is not None for stock in batch.stocks ()]
+			for symbol in itertools.compress (symbols, [not flag for flag in known]):
+				self.log ("TradeFeedServer", UnknownSymbolError (symbol), "TradeFeedServer unknown symbol %s", symbol)
+			batch = batch.select (known)
+		self._trade.recordTrades (batch)
+		self._recorded += len (batch)
+
+	# _answer answers a query
+	# arg kind : PRICE or INDEX
+	# arg symbol : the padded symbol bytes of the stock for a PRICE query
+	# returns the price asked for, or -1 for failure
+	def _answer (self, kind, symbol):
+		try:
+			if kind == self.INDEX:
+				return self._trade.GBCEAllShareIndex ()
+			stock = self._stocks.get (symbol.rstrip (b"\0").decode ("ascii", "replace"))
+			if stock is None:
+				self.log ("TradeFeedServer", UnknownSymbolError (symbol), "TradeFeedServer unknown symbol %r", symbol)
+				return -1
+			return self._trade.volumeWeightedStockPrice (stock)
 		except Exception as e:
-			# catch any other error
-			self.log ("calculateVolumeWeightedStockPrice %s" % str (e))
+			self.log ("TradeFeedServer", e, "TradeFeedServer %s", e)
 		return -1 # indicates failure
 
+# TradeFeedClient class to send trades and queries to a TradeFeedServer
+class TradeFeedClient:
+	# TradeFeedClient constructor
+	# initialize unconnected
+	def __init__ (self):
+		self._reader = None
+		self._writer = None
+
+	# connect connects to a server, on a Unix socket if a path is given or otherwise on a TCP port
+	# arg path : the path of the Unix socket, or None
+	# arg host : the host of the server for TCP
+	# arg port : the TCP port of the server
+	async def connect (self, path = None, host = "127.0.0.1", port = None):
+		if path is not None:
+			self._reader, self._writer = await asyncio.open_unix_connection (path)
+		else:
+			self._reader, self._writer = await asyncio.open_connection (host, port)
+
+	# close closes the connection
+	async def close (self):
+		self._writer.close ()
+		await self._writer.wait_closed ()
+
+	# sendTrades sends trades to the server, a message of up to frameSize trades at a time
+	# arg trades : an iterable of (stock, quantity, buyorsell, price, timestamp) tuples
+	# arg frameSize : the most trades to send in one message
+	async def sendTrades (self, trades, frameSize = 4096):
+		trades = iter (trades)
+		while True:
+			chunk = list (itertools.islice (trades, frameSize))
+			if not chunk:
+				return
+			data = [TradeFeedServer.HEADER.pack (TradeFeedServer.TRADES, b"", len (chunk))]
+			for stock, quantity, buyorsell, price, timestamp in chunk:
+				data.append (TRADE_RECORD.pack (stock.symbol ().encode ("ascii"), toEpoch (timestamp), quantity, buyorsell, price))
+			self._writer.write (b"".join (data))
+			# wait while the server holds back
+			await self._writer.drain ()
+
+	# volumeWeightedStockPrice asks the server for the Volume Weighted Stock Price of a stock
+	# arg stock : the stock to ask for
+	# returns the Volume Weighted Stock Price of the stock, or -1 for failure
+	async def volumeWeightedStockPrice (self, stock):
+		return await self._query (TradeFeedServer.PRICE, stock.symbol ().encode ("ascii"))
+
+	# GBCEAllShareIndex asks the server for the GBCE All Share Index
+	# returns the GBCE All Share Index, or -1 for failure
+	async def GBCEAllShareIndex (self):
+		return await self._query (TradeFeedServer.INDEX, b"")
+
+	# _query sends a query to the server and waits for the reply
+	# arg kind : PRICE or INDEX
+	# arg symbol : the symbol bytes of the stock for a PRICE query
+	# returns the price in the reply
+	async def _query (self, kind, symbol):
+		self._writer.write (TradeFeedServer.HEADER.pack (kind, symbol, 0))
+		await self._writer.drain ()
+		price, = TradeFeedServer.REPLY.unpack (await self._reader.readexactly (TradeFeedServer.REPLY.size))
+		return price
+
 # TestRig class for testing Trade class methods
 class TestRig:
 	# TestRig constructor
@@ -385,6 +3534,53 @@ class TestRig:
 		assert (t.PERatio (self.stocks ["CCC"], 20.0) == -1)
 		assert (t.PERatio (self.stocks ["DDD"], 20)   == -1)
 		
+	# Tests the Trade.batchDividendYield and Trade.batchPERatio methods give the same results as
+	# Trade.dividendYield and Trade.PERatio for every test stock over a range of prices
+	def testBatchDividendAndPERatio (self):
+		t = Trade ()
+		prices = [2.0, 20, 69, 2000, sys.maxsize, sys.maxsize + 1, sys.float_info.max, 0, 0.0, -2, -20.0]
+		stocks = []
+		for symbol in sorted (self.stocks):
+			stocks.extend ([self.stocks [symbol]] * len (prices))
+		prices = prices * len (self.stocks)
+		dividendYields, dividendErrors = t.batchDividendYield (stocks, prices)
+		ratios, ratioErrors = t.batchPERatio (stocks, prices)
+		for i in range (len (prices)):
+			assert (dividendYields [i] == t.dividendYield (stocks [i], prices [i]))
+			assert (ratios [i] == t.PERatio (stocks [i], prices [i]))
+			assert ((dividendErrors [i] == ErrorCode.NoError) == (dividendYields [i] != -1))
+			assert ((ratioErrors [i] == ErrorCode.NoError) == (ratios [i] != -1))
+
+		# prices that are not numbers or not finite, and prices in an array, with NumPy if installed and without
+		global numpy
+		installed = numpy
+		odd = [2.0, 0, -2, None, "err", "50", math.nan, -0.0, math.inf, 10 ** 400]
+		stocks = []
+		for symbol in sorted (self.stocks):
+			stocks.extend ([self.stocks [symbol]] * len (odd))
+		same = lambda result, expected: result == expected or (math.isnan (result) and math.isnan (expected))
+		try:
+			for numpy in ([installed, None] if installed is not None else [None]):
+				for prices in [odd * len (self.stocks), array.array ("d", [2.0, 0, -2, 50, math.nan, -0.0, math.inf] * len (self.stocks))]:
+					dividendYields, dividendErrors = t.batchDividendYield (stocks [:len (prices)], prices)
+					ratios, ratioErrors = t.batchPERatio (stocks [:len (prices)], prices)
+					for i in range (len (prices)):
+						assert (same (dividendYields [i], t.dividendYield (stocks [i], prices [i])))
+						assert (same (ratios [i], t.PERatio (stocks [i], prices [i])))
+						assert ((dividendErrors [i] == ErrorCode.NoError) == (dividendYields [i] != -1))
+						assert ((ratioErrors [i] == ErrorCode.NoError) == (ratios [i] != -1))
+				assert (list (t.batchDividendYield ([self.stocks ["POP"]] * 5, odd [3:8]) [1]) == [ErrorCode.Type, ErrorCode.Other,
+					ErrorCode.NoError, ErrorCode.NoError, ErrorCode.Arithmetic])
+		finally:
+			numpy = installed
+
+		# causes of failure
+		stocks = [self.stocks [symbol] for symbol in ["TEA", "POP", "AAA", "BBB", "DDD", "III"]]
+		assert (list (t.batchDividendYield (stocks, [0, -20, 20, 20, 20, 20]) [1]) == [ErrorCode.Arithmetic, ErrorCode.NegativeValue,
+			ErrorCode.UnknownStockType, ErrorCode.Type, ErrorCode.NegativeValue, ErrorCode.Type])
+		assert (list (t.batchPERatio (stocks, [20, -20, 20, 20, 20, 20]) [1]) == [ErrorCode.Arithmetic, ErrorCode.NegativeValue,
+			ErrorCode.Arithmetic, ErrorCode.Type, ErrorCode.NegativeValue, ErrorCode.NoError])
+
 	# Tests the Trade.recordTrade method by adding trades
 	def testRecordTrade (self):
 		t = Trade ()
@@ -395,6 +3591,144 @@ class TestRig:
 		t.recordTrade (self.stocks ["GIN"], 250, BuyOrSell.Buy, 95)
 		t.recordTrade (self.stocks ["JOE"], 300, BuyOrSell.Buy, 110)
 		
+	# Tests the Trade.recordTrades and Trade.loadTrades methods record the same trades as Trade.recordTrade,
+	# with trades out of timestamp order, negative data, and CSV and binary trade files
+	def testRecordTrades (self):
+		now = datetime.datetime.now ()
+		symbols = ["TEA", "POP", "ALE", "GIN", "JOE"]
+		trades = []
+		for i in range (500):
+			timestamp = now - datetime.timedelta (seconds=(i * 37) % 600)
+			trades.append ((self.stocks [symbols [i % 5]], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp))
+		trades.append ((self.stocks ["TEA"], -5, BuyOrSell.Buy, 20, now - datetime.timedelta (minutes=1)))
+		expected = Trade ()
+		for stock, quantity, buyorsell, price, timestamp in trades:
+			expected.recordTrade (stock, quantity, buyorsell, price, timestamp)
+		actual = [ Trade (), Trade (columnar = True), Trade (streaming = True, columnar = True) ]
+		for t in actual:
+			t.volumeWeightedStockPrice (self.stocks ["POP"])
+			t.recordTrades (trades [:100])
+			t.recordTrades (trades [100:], chunkSize = 64)
+
+		# write trades to CSV and binary files and load them
+		directory = tempfile.mkdtemp ()
+		csvPath = os.path.join (directory, "trades.csv")
+		binaryPath = os.path.join (directory, "trades.bin")
+		with open (csvPath, "w") as f:
+			for stock, quantity, buyorsell, price, timestamp in trades:
+				f.write ("%s,%r,%d,%d,%r\n" % (stock.symbol (), toEpoch (timestamp), quantity, buyorsell, price))
+		with open (binaryPath, "wb") as f:
+			for stock, quantity, buyorsell, price, timestamp in trades:
+				f.write (TRADE_RECORD.pack (stock.symbol ().encode ("ascii"), toEpoch (timestamp), quantity, buyorsell, price))
+		for binary, path in [(False, csvPath), (True, binaryPath)]:
+			t = Trade (columnar = True)
+			t.loadTrades (path, self.stocks, binary, chunkSize = 50)
+			actual.append (t)
+		for t in actual:
+			for symbol in symbols:
+				assert (t.volumeWeightedStockPrice (self.stocks [symbol]) == expected.volumeWeightedStockPrice (self.stocks [symbol]))
+			assert (t.GBCEAllShareIndex () == expected.GBCEAllShareIndex ())
+			assert (len (t.trades ()) == len (trades))
+		# trades recorded as tuples keep their dates and times
+		assert ([trade.timestamp () for trade in actual [0].trades ()] == [trade.timestamp () for trade in expected.trades ()])
+
+		# header and blank lines
+		with open (csvPath) as f:
+			lines = f.readlines ()
+		with open (csvPath, "w") as f:
+			f.write ("symbol,timestamp,quantity,side,price\n")
+			for i, line in enumerate (lines):
+				f.write (line if i % 100 else "\n" + line)
+		t = Trade ()
+		t.loadTrades (csvPath, self.stocks, chunkSize = 50, header = True)
+		assert (t.GBCEAllShareIndex () == expected.GBCEAllShareIndex ())
+		assert (len (t.trades ()) == len (trades))
+		assert (len (list (Trade (clock = SimulatedClock ()).replay (csvPath, self.stocks, datetime.timedelta (minutes=1), header = True))) > 0)
+
+		# rows that cannot be read name the file and line
+		for row in ["POP,%r,10,0" % toEpoch (now), "POP,%r,10,0,20.0,1" % toEpoch (now), "POP,%r,ten,0,20.0" % toEpoch (now)]:
+			with open (csvPath, "w") as f:
+				f.writelines (lines [:120])
+				f.write ("\n" + row + "\n")
+			try:
+				Trade ().loadTrades (csvPath, self.stocks, chunkSize = 50)
+				assert (False)
+			except TradeFileError as e:
+				assert (e.path == csvPath and e.line == 122)
+		with open (csvPath, "w") as f:
+			f.writelines (lines)
+
+		# unknown symbol
+		with open (csvPath, "a") as f:
+			f.write ("XXX,%r,10,0,20.0\n" % toEpoch (now))
+		try:
+			Trade ().loadTrades (csvPath, self.stocks)
+			assert (False)
+		except UnknownSymbolError:
+			pass
+		os.remove (csvPath)
+		os.remove (binaryPath)
+		os.rmdir (directory)
+
+	# Tests a Trade rebuilt from its TradeJournal gives the same results as the Trade that wrote it,
+	# keeping only trades in the past five minutes
+	def testTradeJournal (self):
+		now = datetime.datetime.now ()
+		directory = tempfile.mkdtemp ()
+		path = os.path.join (directory, "trades.journal")
+		journal = TradeJournal (path, syncEvery = 7, capacity = 4)
+		t = Trade (journal = journal)
+		trades = []
+		for i in range (300):
+			timestamp = now - datetime.timedelta (seconds=(i * 37) % 900)
+			trades.append ((self.stocks [["TEA", "POP", "ALE", "GIN", "JOE"] [i % 5]], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp))
+		trades.append ((self.stocks ["GIN"], -5, BuyOrSell.Sell, 59, now - datetime.timedelta (minutes=10)))
+		for stock, quantity, buyorsell, price, timestamp in trades [:100]:
+			t.recordTrade (stock, quantity, buyorsell, price, timestamp)
+		t.recordTrades (trades [100:])
+		assert (len (journal) == 301)
+		journal.close ()
+
+		# rebuild from the journal, then from a checkpoint and the journal records after it
+		for checkpoint in [False, True]:
+			for columnar in [False, True]:
+				expected = Trade ()
+				expected.recordTrades (trades)
+				journal = TradeJournal (path)
+				r = Trade (columnar = columnar, journal = journal)
+				r.recover (self.stocks, now)
+				for symbol in ["TEA", "POP", "ALE", "GIN", "JOE"]:
+					assert (r.volumeWeightedStockPrice (self.stocks [symbol]) == expected.volumeWeightedStockPrice (self.stocks [symbol]))
+				assert (r.GBCEAllShareIndex () == expected.GBCEAllShareIndex ())
+				# only trades in the past five minutes are kept
+				assert (len (r.trades ()) == len ([trade for trade in trades if trade [4] > now - datetime.timedelta (minutes=5)]))
+				journal.close ()
+			if not checkpoint:
+				# checkpoint, then carry on recording
+				journal = TradeJournal (path)
+				r = Trade (journal = journal)
+				r.recover (self.stocks, now)
+				r.checkpoint (now)
+				for trade in [(self.stocks ["JOE"], 10, BuyOrSell.Buy, 10, now - datetime.timedelta (minutes=1)),
+						(self.stocks ["TEA"], -3, BuyOrSell.Buy, 20, now - datetime.timedelta (minutes=20))]:
+					r.recordTrade (*trade)
+					trades.append (trade)
+				assert (len (journal) == 303)
+				journal.close ()
+		os.remove (path)
+		os.remove (path + ".checkpoint")
+
+		# not a journal
+		with open (path, "wb") as f:
+			f.write (b"not a journal at all")
+		try:
+			TradeJournal (path)
+			assert (False)
+		except JournalError:
+			pass
+		os.remove (path)
+		os.rmdir (directory)
+
 	# Tests the Trade.volumeWeightedStockPrice method with good stock data and prices, negative data and no data
 	def testVolumeWeightedStockPrice (self):
 		# define time stamps for now and a few minutes ago
@@ -431,7 +3765,596 @@ class TestRig:
 		# no trades in the past five minutes
 		t.recordTrade (self.stocks ["JOE"], 95, BuyOrSell.Buy, 18, sevenMinutesAgo)
 		assert (t.volumeWeightedStockPrice (self.stocks ["JOE"]) == -1)
-		
+
+		# trades recorded out of timestamp order
+		t = Trade ()
+		t.recordTrade (self.stocks ["POP"], 200, BuyOrSell.Buy, 65, threeMinutesAgo)
+		t.recordTrade (self.stocks ["POP"], 200, BuyOrSell.Buy, 65, eightMinutesAgo)
+		t.recordTrade (self.stocks ["POP"], 100, BuyOrSell.Buy, 50, twoMinutesAgo)
+		t.recordTrade (self.stocks ["POP"], 200, BuyOrSell.Buy, 65, sevenMinutesAgo)
+		assert (t.volumeWeightedStockPrice (self.stocks ["POP"]) == 60)
+
+	# Tests the streaming Trade.volumeWeightedStockPrice gives the same results as recalculating from trade records,
+	# with trades recorded in and out of timestamp order, negative data, and the window moving forward
+	def testStreamingVolumeWeightedStockPrice (self):
+		now = datetime.datetime.now ()
+		t = Trade ()
+		s = Trade (streaming = True)
+		# stock, quantity, price, minutes ago
+		trades = [
+			("POP", 100, 50, 2), ("POP", 200, 65, 3), ("POP", 200, 65, 7), ("POP", 200, 65, 8),
+			("GIN", 30, 5, 2), ("GIN", 95, 18, 7), ("GIN", 45, 8, 3), ("GIN", 75, 12, 1),
+			("TEA", -95, 18, 2), ("TEA", 100, 18, 3), # negative quantity offset at the same price
+			("ALE", 95, -18, 2), ("ALE", 95, 18, 3), # negative price
+			("JOE", 95, 18, 7) ] # no trades in the past five minutes
+		for symbol, quantity, price, minutesAgo in trades:
+			timestamp = now - datetime.timedelta (minutes=minutesAgo)
+			t.recordTrade (self.stocks [symbol], quantity, BuyOrSell.Buy, price, timestamp)
+			s.recordTrade (self.stocks [symbol], quantity, BuyOrSell.Buy, price, timestamp)
+			for symbol in ["POP", "GIN", "TEA", "ALE", "JOE"]:
+				assert (s.volumeWeightedStockPrice (self.stocks [symbol]) == t.volumeWeightedStockPrice (self.stocks [symbol]))
+		assert (s.volumeWeightedStockPrice (self.stocks ["POP"]) == 60)
+		assert (s.volumeWeightedStockPrice (self.stocks ["GIN"]) == 9.4)
+		assert (s.volumeWeightedStockPrice (self.stocks ["TEA"]) == 18)
+		assert (s.volumeWeightedStockPrice (self.stocks ["ALE"]) == -1)
+		assert (s.volumeWeightedStockPrice (self.stocks ["JOE"]) == -1)
+
+		# fractional prices, and a trade so large the others would be lost to rounding when it leaves the window
+		opening = datetime.datetime (2020, 1, 2, 8)
+		t = Trade (clock = SimulatedClock (opening))
+		s = Trade (streaming = True, clock = SimulatedClock (opening))
+		trades = [("POP", 1000000, 1e12, 0), ("POP", 10, 50.25, 1), ("POP", 30, 49.75, 2), ("TEA", 1, 1, 300)]
+		trades += [("POP", i % 9 + 1, 20 + ((i * 7919) % 10000) / 100, 302 + i * 3) for i in range (400)]
+		for symbol, quantity, price, seconds in trades:
+			for r in [t, s]:
+				r.recordTrade (self.stocks [symbol], quantity, BuyOrSell.Buy, price, opening + datetime.timedelta (seconds=seconds))
+			assert (s.volumeWeightedStockPrice (self.stocks ["POP"]) == t.volumeWeightedStockPrice (self.stocks ["POP"]))
+			if seconds == 300:
+				assert (s.volumeWeightedStockPrice (self.stocks ["POP"]) == 49.875)
+
+		# move a window along an index with trades inserted out of order as it moves
+		index = SymbolTrades (self.stocks ["POP"])
+		window = index.slidingWindow ()
+		for minute in range (60):
+			start = now + datetime.timedelta (minutes=minute)
+			end = start + datetime.timedelta (minutes=5)
+			for offset in [3, -2, 7, 0, 5, -9]:
+				quantity = (minute * 7 + offset) % 13 - 2
+				price = (minute * 5 + offset) % 11 + 1
+				index.insert (end + datetime.timedelta (seconds=offset * 20), quantity, BuyOrSell.Buy, price)
+			recentTrades = { }
+			for trade in index.between (start, end):
+				recentTrades [trade.price ()] = recentTrades.get (trade.price (), 0.0) + trade.quantity ()
+			assert (s.calculateRunningVolumeWeightedStockPrice (window.move (start, end)) == s.calculateVolumeWeightedStockPrice (recentTrades))
+
+	# Tests the Trade.volumeWeightedStockPrice method over windows other than five minutes, added up from time buckets,
+	# gives the same results as adding up the trades in the window
+	def testWindowedVolumeWeightedStockPrice (self):
+		now = datetime.datetime.now ()
+		trades = []
+		for i in range (3000):
+			# half a second off whole seconds ago, so trades do not cross window edges while the test runs
+			secondsAgo = (i * 7919) % 7200 + 0.5
+			trades.append ((self.stocks ["POP"], i % 17 + 1, i % 2, 20 + (i * 13) % 50, now - datetime.timedelta (seconds=secondsAgo)))
+		windows = [1, 2, 59, 60, 61, 119, 300, 900, 3600, 3661, 7200, 10000]
+		for t in [ Trade (), Trade (columnar = True) ]:
+			# buckets made from trades already recorded and kept up to date as more are recorded
+			t.recordTrades (trades [:1000])
+			t.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (seconds=1))
+			for stock, quantity, buyorsell, price, timestamp in trades [1000:2000]:
+				t.recordTrade (stock, quantity, buyorsell, price, timestamp)
+			t.recordTrades (trades [2000:])
+			for seconds in windows:
+				recent = [trade for trade in trades if trade [4] > now - datetime.timedelta (seconds=seconds)]
+				expected = sum (trade [3] * trade [1] for trade in recent) / sum (trade [1] for trade in recent)
+				assert (t.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (seconds=seconds)) == expected)
+			bars = t._index (self.stocks ["POP"]).timeBuckets ().bars (TimeBuckets.MINUTE)
+			assert (sum (bar [2] for bar in bars.values ()) == len (trades))
+			assert (max (bar [3] for bar in bars.values ()) == 69 and min (bar [4] for bar in bars.values ()) == 20)
+			# no trades in the window, no trades at all
+			assert (t.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (microseconds=1)) == -1)
+			assert (t.volumeWeightedStockPrice (self.stocks ["GIN"], datetime.timedelta (hours=1)) == -1)
+			# negative data
+			t.recordTrade (self.stocks ["TEA"], -95, BuyOrSell.Buy, 18, now - datetime.timedelta (minutes=20))
+			t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 18, now - datetime.timedelta (minutes=30))
+			t.recordTrade (self.stocks ["ALE"], 95, BuyOrSell.Buy, -18, now - datetime.timedelta (minutes=20))
+			t.recordTrade (self.stocks ["ALE"], 95, BuyOrSell.Buy, 18, now - datetime.timedelta (minutes=30))
+			assert (t.volumeWeightedStockPrice (self.stocks ["TEA"], datetime.timedelta (hours=1)) == 18)
+			assert (t.volumeWeightedStockPrice (self.stocks ["TEA"], datetime.timedelta (minutes=25)) == -1)
+			assert (t.volumeWeightedStockPrice (self.stocks ["ALE"], datetime.timedelta (hours=1)) == -1)
+			assert (t.volumeWeightedStockPrice (self.stocks ["ALE"], datetime.timedelta (minutes=10)) == -1)
+		# buckets only reach back as far as the longest window asked for, though every trade record is kept
+		opening = datetime.datetime (2020, 1, 2, 8)
+		trades = [(self.stocks ["POP"], i % 17 + 1, BuyOrSell.Buy, 20 + (i * 13) % 50, opening + datetime.timedelta (seconds=i)) for i in range (3 * 3600)]
+		for columnar in [False, True]:
+			t = Trade (columnar = columnar, clock = SimulatedClock (opening))
+			for i, trade in enumerate (trades):
+				t.recordTrade (*trade)
+				if i % 600 == 0:
+					t.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (minutes=5))
+			buckets = t._index (self.stocks ["POP"]).timeBuckets ()
+			assert (len (buckets.bars (TimeBuckets.SECOND)) <= 300 + 120 and len (buckets.bars (TimeBuckets.MINUTE)) <= 5 + 2)
+			# a longer window is totalled from the records first, then kept up to date
+			for seconds in [3600, 3600, 20000]:
+				now = trades [-1][4]
+				recent = [trade for trade in trades if now - datetime.timedelta (seconds=seconds) < trade [4] < now]
+				expected = sum (trade [3] * trade [1] for trade in recent) / sum (trade [1] for trade in recent)
+				assert (t.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (seconds=seconds)) == expected)
+				trades.append ((self.stocks ["POP"], 5, BuyOrSell.Buy, 30, now + datetime.timedelta (seconds=1)))
+				t.recordTrade (*trades [-1])
+			assert (sum (bar [2] for bar in buckets.bars (TimeBuckets.MINUTE).values ()) == len (trades))
+			del trades [3 * 3600:]
+
+		# fractional prices give the same price over five minutes as the default calculation, to the last bit
+		for columnar in [False, True]:
+			t = Trade (columnar = columnar, clock = SimulatedClock (opening))
+			for i in range (2000):
+				t.recordTrade (self.stocks ["POP"], i % 97 + 1, BuyOrSell.Buy, (1000 + (i * 7919) % 9000) / 100, opening + datetime.timedelta (seconds=i * 0.37))
+				if i % 50 == 0:
+					assert (t.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (minutes=5)) == t.volumeWeightedStockPrice (self.stocks ["POP"]))
+
+	# Tests trades are stamped with the time from the Trade's clock, and Trade.replay reports the same prices at each
+	# interval of a trade file as recording the trades up to then would
+	def testReplay (self):
+		before = datetime.datetime.now ()
+		t = Trade ()
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 50)
+		assert (t.trades () [0].timestamp () >= before)
+		opening = datetime.datetime (2020, 1, 2, 8)
+		t = Trade (clock = SimulatedClock (opening))
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 50)
+		assert (t.trades () [0].timestamp () == opening)
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 50, opening + datetime.timedelta (minutes=3))
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 50, opening + datetime.timedelta (minutes=1))
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 70)
+		assert (t.trades () [-1].timestamp () == opening + datetime.timedelta (minutes=3))
+
+		symbols = ["TEA", "POP", "ALE", "GIN", "JOE"]
+		trades = []
+		for i in range (2000):
+			timestamp = opening + datetime.timedelta (seconds=i * 1.7)
+			trades.append ((self.stocks [symbols [(i * 7) % 5]], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp))
+		directory = tempfile.mkdtemp ()
+		path = os.path.join (directory, "trades.bin")
+		with open (path, "wb") as f:
+			for stock, quantity, buyorsell, price, timestamp in trades:
+				f.write (TRADE_RECORD.pack (stock.symbol ().encode ("ascii"), toEpoch (timestamp), quantity, buyorsell, price))
+		for streaming, window in [(False, None), (True, None), (False, datetime.timedelta (minutes=15))]:
+			clock = SimulatedClock ()
+			expected = Trade (clock = clock)
+			recorded = 0
+			reports = list (Trade (streaming = streaming, columnar = True, clock = SimulatedClock ()).replay (path, self.stocks,
+				datetime.timedelta (minutes=10), binary = True, chunkSize = 300, window = window))
+			assert ([report [0] for report in reports] == [opening + datetime.timedelta (minutes=m) for m in [10, 20, 30, 40, 50]] + [trades [-1][4]])
+			for time, prices, index in reports:
+				# last report is made after the last trade
+				while recorded < len (trades) and (trades [recorded][4] < time or time == reports [-1][0]):
+					expected.recordTrade (*trades [recorded])
+					recorded += 1
+				clock.advance (time)
+				assert (sorted (prices) == sorted (symbols))
+				for symbol in symbols:
+					assert (prices [symbol] == expected.volumeWeightedStockPrice (self.stocks [symbol], window))
+				assert (abs (index / expected.GBCEAllShareIndex () - 1) < 1e-12)
+			assert (recorded == len (trades))
+		os.remove (path)
+		os.rmdir (directory)
+
+	# Tests a Trade with a retention policy keeps a bounded number of trade records, and gives the same prices for
+	# windows inside its horizon and the same All Share Index as a Trade keeping every trade record
+	def testRetention (self):
+		opening = datetime.datetime (2020, 1, 2, 8)
+		symbols = ["TEA", "POP", "ALE", "GIN", "JOE"]
+		policies = [RetentionPolicy (horizon = datetime.timedelta (minutes=10), every = 500),
+			RetentionPolicy (maxRecords = 300, every = 700)]
+		for streaming, columnar, policy in [(False, False, policies [0]), (True, True, policies [0]), (True, False, policies [1])]:
+			expected = Trade (clock = SimulatedClock ())
+			t = Trade (streaming = streaming, columnar = columnar, clock = SimulatedClock (), retention = policy)
+			for day in range (3):
+				trades = []
+				for i in range (3000):
+					timestamp = opening + datetime.timedelta (days=day, seconds=i * 1.3)
+					trades.append ((self.stocks [symbols [(i * 7) % 5]], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp))
+				# a negative quantity at a price already compacted
+				trades.append ((self.stocks ["TEA"], -4, BuyOrSell.Buy, 21, trades [-1][4]))
+				expected.recordTrades (trades [:1000])
+				t.recordTrades (trades [:1000])
+				for trade in trades [1000:]:
+					expected.recordTrade (*trade)
+					t.recordTrade (*trade)
+					if policy.maxRecords () is None:
+						t.volumeWeightedStockPrice (self.stocks ["POP"])
+				for symbol in symbols:
+					if policy.maxRecords () is None:
+						assert (t.volumeWeightedStockPrice (self.stocks [symbol]) == expected.volumeWeightedStockPrice (self.stocks [symbol]))
+						window = datetime.timedelta (minutes=7)
+						assert (t.volumeWeightedStockPrice (self.stocks [symbol], window) == expected.volumeWeightedStockPrice (self.stocks [symbol], window))
+				assert (t.GBCEAllShareIndex () == expected.GBCEAllShareIndex ())
+			metrics = t.retentionMetrics ()
+			assert (metrics ["retained"] + metrics ["compacted"] == len (expected.trades ()))
+			assert (metrics ["retained"] == len (t.trades ()) and metrics ["compactions"] > 0)
+			# records kept stay within the horizon or limit, plus trades recorded since the last compaction
+			assert (metrics ["retained"] <= 5 * 300 + policy.every ())
+			# compacted trades are folded into one total, except at the one price with a negative quantity
+			assert (metrics ["compactedPrices"] <= 1)
+
+	# Tests a Trade with instrumentation counts and times calls and counts errors by cause, and a Trade without
+	# instrumentation has none
+	def testInstrumentation (self):
+		assert (not "dividendYield" in vars (Trade ()))
+		sampled = []
+		def profiler (method, function, *args):
+			sampled.append (method)
+			return function (*args)
+		t = Trade (instrumentation = Instrumentation (keepMessages = 3, sampleEvery = 2, profiler = profiler))
+		assert (t.dividendYield (self.stocks ["POP"], 100) == 0.08)
+		assert (t.dividendYield (self.stocks ["TEA"], 0) == -1)
+		assert (t.dividendYield (self.stocks ["AAA"], 100) == -1)
+		assert (t.dividendYield (self.stocks ["DDD"], 100) == -1)
+		assert (t.PERatio (self.stocks ["BBB"], 100) == -1)
+		assert (t.PERatio (self.stocks ["POP"], "err") == -1)
+		t.recordTrade (self.stocks ["POP"], -100, BuyOrSell.Buy, 50)
+		assert (t.volumeWeightedStockPrice (self.stocks ["POP"]) == -1)
+		assert (t.GBCEAllShareIndex () == -1)
+		snapshot = t.instrumentation ().snapshot ()
+		assert (snapshot ["calls"] ["dividendYield"] == 4 and snapshot ["calls"] ["PERatio"] == 2)
+		assert (snapshot ["calls"] ["recordTrade"] == 1 and snapshot ["calls"] ["recordTrades"] == 0)
+		assert (snapshot ["errors"] ["dividendYield"] == { "ZeroDivisionError" : 1, "UnknownStockTypeError" : 1, "NegativeValueError" : 1 })
+		assert (snapshot ["errors"] ["PERatio"] == { "TypeError" : 1, "ValueError" : 1 })
+		assert (snapshot ["errors"] ["calculateVolumeWeightedStockPrice"] == { "NegativeValueError" : 1 })
+		assert (snapshot ["errors"] ["calculateRunningVolumeWeightedStockPrice"] == { "NegativeValueError" : 1 })
+		for method, histogram in snapshot ["latency"].items ():
+			assert (sum (histogram ["counts"]) == snapshot ["calls"] [method])
+		assert (sampled == ["dividendYield", "dividendYield", "PERatio"])
+		# only the latest messages are kept, formatted when looked at
+		assert (len (snapshot ["messages"]) == 3 and snapshot ["messages"] [0] == "PERation(POP, err) Error=could not convert string to float: 'err'")
+		text = t.instrumentation ().exportText ()
+		assert ('gbce_calls_total{method="dividendYield"} 4' in text)
+		assert ('gbce_errors_total{method="PERatio",cause="TypeError"} 1' in text)
+		assert ('gbce_latency_seconds_count{method="dividendYield"} 4' in text)
+
+	# Tests a StockRegistry rejects bad stock data up front, and a Trade using it gives the same dividend yields
+	# and P/E Ratios as one calculating them from the stocks on each call
+	def testStockRegistry (self):
+		registry = StockRegistry ()
+		good = ["TEA", "POP", "ALE", "GIN", "JOE"]
+		for i in range (len (good)):
+			assert (registry.register (self.stocks [good [i]]) == i)
+		assert (registry.register (self.stocks ["POP"]) == 1)
+		assert (registry.id ("GIN") == 3 and registry.stock (3) is self.stocks ["GIN"] and registry.id ("XXX") is None)
+		assert (list (registry.dividendTerms ()) == [0, 8, 23, 200, 13] and list (registry.earningsTerms ()) == [0, 8, 23, 8, 13])
+		expected = { "AAA" : ErrorCode.UnknownStockType, "BBB" : ErrorCode.Type, "CCC" : ErrorCode.Type, "DDD" : ErrorCode.NegativeValue,
+			"EEE" : ErrorCode.Type, "FFF" : ErrorCode.Type, "GGG" : ErrorCode.NegativeValue, "HHH" : ErrorCode.NegativeValue,
+			"III" : ErrorCode.Type, "JJJ" : ErrorCode.Type }
+		for symbol, code in expected.items ():
+			try:
+				registry.register (self.stocks [symbol])
+				assert (False)
+			except InvalidStockError as e:
+				assert (e.symbol == symbol and e.code == code)
+		try:
+			registry.register (Stock ("POP", Type.Common, 9, None, 100))
+			assert (False)
+		except InvalidStockError:
+			pass
+		assert (len (registry) == 5)
+
+		t = Trade (registry = registry)
+		plain = Trade ()
+		for symbol in self.stocks:
+			for price in [100, 0.5, 1e300, 0, -50, math.nan, "err", None]:
+				for method in ["dividendYield", "PERatio"]:
+					result = getattr (t, method) (self.stocks [symbol], price)
+					expected = getattr (plain, method) (self.stocks [symbol], price)
+					assert (result == expected or (math.isnan (result) and math.isnan (expected)))
+		stocks = [self.stocks [symbol] for symbol in self.stocks] * 3
+		prices = [100, 0, -50] * 5 + [7, 8, 9] * 5
+		assert (t.batchDividendYield (stocks, prices) == plain.batchDividendYield (stocks, prices))
+		assert (t.batchPERatio (stocks, prices) == plain.batchPERatio (stocks, prices))
+
+		# reference file with good and bad stocks
+		directory = tempfile.mkdtemp ()
+		path = os.path.join (directory, "stocks.csv")
+		with open (path, "w") as f:
+			f.write ("symbol,type,lastDividend,fixedDividend,parValue\n")
+			f.write ("TEA,Common,0,,100\nGIN,Preferred,8,2,100\nBAD,Common,err,,100\nNEG,Preferred,8,-2,100\nODD,Other,8,,100\n")
+			for i in range (2000):
+				f.write ("S%d,Common,%d,,100\n" % (i, i % 30))
+		registry = StockRegistry ()
+		rejected = registry.load (path)
+		assert ([(e.symbol, e.code) for e in rejected] == [("BAD", ErrorCode.Type), ("NEG", ErrorCode.NegativeValue), ("ODD", ErrorCode.UnknownStockType)])
+		assert (len (registry) == 2002 and registry.id ("S1999") == 2001)
+		t = Trade (registry = registry)
+		stocks = registry.stocks ()
+		assert (t.dividendYield (stocks ["GIN"], 50) == 4 and t.PERatio (stocks ["S5"], 50) == 10 and t.PERatio (stocks ["TEA"], 50) == -1)
+		# a malformed row fails the whole file, naming its line, and registers nothing
+		for row, fields in [("RUM,Common,8,,100,extra", 6), ("RUM,Common", 2)]:
+			with open (path, "w") as f:
+				f.write ("symbol,type,lastDividend,fixedDividend,parValue\nWIN,Common,8,,100\n%s\nCOG,Common,8,,100\n" % row)
+			registry = StockRegistry ()
+			try:
+				registry.load (path)
+				assert (False)
+			except ReferenceFileError as e:
+				assert (e.path == path and e.line == 3 and ("has %d fields" % fields) in str (e))
+			assert (len (registry) == 0)
+		os.remove (path)
+		os.rmdir (directory)
+
+	# Tests Trades reading a shared trade ring in other processes give the same prices as the Trade writing it
+	def testSharedTradeRing (self):
+		now = datetime.datetime.now ()
+		symbols = ["TEA", "POP", "ALE", "GIN"]
+		context = multiprocessing.get_context ("fork")
+		ring = SharedTradeRing (capacity = 4096, stocks = 8)
+		readers = []
+		try:
+			t = Trade (shared = ring, clock = SimulatedClock (now))
+			assert (ring.writer () and len (ring) == 0)
+			trades = []
+			for i in range (3000):
+				timestamp = now - datetime.timedelta (seconds=(i * 37) % 600)
+				trades.append ((self.stocks [symbols [i % 4]], i % 17 + 1, (i // 4) % 2, 20 + (i * 13) % 50, timestamp))
+			t.recordTrades (trades [:2000])
+			for trade in trades [2000:]:
+				t.recordTrade (*trade)
+			assert (len (ring) == 3000)
+			results = context.Queue ()
+			def read ():
+				shared = SharedTradeRing (ring.name ())
+				reader = Trade (shared = shared, clock = SimulatedClock (now))
+				results.put ([reader.volumeWeightedStockPrice (self.stocks [symbol]) for symbol in symbols + ["JOE"]] +
+					[reader.volumeWeightedStockPrice (self.stocks ["TEA"], datetime.timedelta (minutes=1)), reader.GBCEAllShareIndex ()])
+				shared.close ()
+			readers = [context.Process (target = read) for i in range (3)]
+			for process in readers:
+				process.start ()
+			expected = [t.volumeWeightedStockPrice (self.stocks [symbol]) for symbol in symbols + ["JOE"]] + \
+				[t.volumeWeightedStockPrice (self.stocks ["TEA"], datetime.timedelta (minutes=1)), t.GBCEAllShareIndex ()]
+			for process in readers:
+				prices = results.get (timeout = 30)
+				assert (prices [4] == expected [4] == -1)
+				assert (all (abs (price / value - 1) < 1e-12 for price, value in zip (prices, expected) if value != -1))
+				process.join ()
+			# a reader in this process, which cannot record trades
+			shared = SharedTradeRing (ring.name ())
+			reader = Trade (shared = shared, clock = SimulatedClock (now))
+			try:
+				reader.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 50, now)
+				assert (False)
+			except SharedRingError:
+				pass
+			# negative and non-numeric data
+			t.recordTrade (self.stocks ["ALE"], -100000, BuyOrSell.Sell, 50, now - datetime.timedelta (seconds=1))
+			assert (reader.volumeWeightedStockPrice (self.stocks ["ALE"]) == t.volumeWeightedStockPrice (self.stocks ["ALE"]) == -1)
+			assert (reader.GBCEAllShareIndex () == t.GBCEAllShareIndex () == -1)
+			try:
+				t.recordTrade (self.stocks ["POP"], 100, BuyOrSell.Buy, "50", now)
+				assert (False)
+			except TypeError:
+				pass
+			# nor once it has read stocks the ring already holds, in one go or through the ring itself
+			price = reader.volumeWeightedStockPrice (self.stocks ["POP"])
+			for write in [lambda: reader.recordTrade (self.stocks ["POP"], 100, BuyOrSell.Buy, 70, now),
+					lambda: reader.recordTrades ([(self.stocks ["POP"], 100, BuyOrSell.Buy, 70, now)]),
+					lambda: shared.append ("POP", toEpoch (now), 100, BuyOrSell.Buy, 70),
+					lambda: shared.appendMany (TradeBatch ([self.stocks ["POP"]], [toEpoch (now)], [100], [BuyOrSell.Buy], [70]))]:
+				try:
+					write ()
+					assert (False)
+				except SharedRingError:
+					pass
+			assert (len (ring) == 3001 and reader.volumeWeightedStockPrice (self.stocks ["POP"]) == price)
+			assert (reader.trades () == [] and reader.GBCEAllShareIndex () == -1)
+			shared.close ()
+		finally:
+			self._stopProcesses (readers)
+			ring.close ()
+			ring.unlink ()
+		# a trade that cannot be written leaves the oldest trade in a full ring in place
+		ring = SharedTradeRing (capacity = 4, stocks = 8)
+		try:
+			t = Trade (shared = ring, clock = SimulatedClock (now))
+			for i in range (4):
+				t.recordTrade (self.stocks ["TEA"], 10, BuyOrSell.Buy, 20 + i, now - datetime.timedelta (seconds=i + 1))
+			for quantity, price in [(10, "50"), (10, None), ("10", 50)]:
+				try:
+					ring.append ("TEA", toEpoch (now), quantity, BuyOrSell.Buy, price)
+					assert (False)
+				except TypeError:
+					pass
+			assert (len (ring) == 4 and ring.recentTrades ("TEA", toEpoch (now) - 60, toEpoch (now)) == {20 : 10, 21 : 10, 22 : 10, 23 : 10})
+		finally:
+			ring.close ()
+			ring.unlink ()
+		# a ring written while it is read, much smaller than the trades written so it wraps many times. Each stock
+		# always trades at the same price, so any trade read torn or overwritten gives a wrong price
+		ring = SharedTradeRing (capacity = 64, stocks = 8)
+		readers = []
+		try:
+			t = Trade (shared = ring, clock = SimulatedClock (now))
+			t.recordTrade (self.stocks ["TEA"], 1, BuyOrSell.Buy, 10, now)
+			t.recordTrade (self.stocks ["POP"], 1, BuyOrSell.Buy, 1000, now)
+			finished = context.Event ()
+			results = context.Queue ()
+			def read ():
+				shared = SharedTradeRing (ring.name ())
+				reader = Trade (shared = shared, clock = SimulatedClock (now))
+				reads = wrong = 0
+				while not finished.is_set () or reads == 0:
+					reads += 1
+					if reader.volumeWeightedStockPrice (self.stocks ["TEA"], datetime.timedelta (hours=1)) not in (10, -1):
+						wrong += 1
+					if reader.volumeWeightedStockPrice (self.stocks ["POP"], datetime.timedelta (hours=1)) not in (1000, -1):
+						wrong += 1
+					if abs (reader.GBCEAllShareIndex () / 100 - 1) > 1e-12:
+						wrong += 1
+				results.put ((reads, wrong))
+				shared.close ()
+			readers = [context.Process (target = read) for i in range (2)]
+			for process in readers:
+				process.start ()
+			for i in range (20000):
+				t.recordTrade (self.stocks [["TEA", "POP"] [i % 2]], i % 7 + 1, BuyOrSell.Buy, [10, 1000] [i % 2],
+					now - datetime.timedelta (seconds=i % 50))
+			finished.set ()
+			for process in readers:
+				reads, wrong = results.get (timeout = 30)
+				assert (reads > 0 and wrong == 0)
+				process.join ()
+		finally:
+			self._stopProcesses (readers)
+			ring.close ()
+			ring.unlink ()
+		# shared memory that is not a ring
+		memory = multiprocessing.shared_memory.SharedMemory (create = True, size = 4096)
+		try:
+			SharedTradeRing (memory.name)
+			assert (False)
+		except SharedRingError:
+			pass
+		finally:
+			memory.close ()
+			memory.unlink ()
+
+	# Tests Trade.exportTrades gives every trade in a time range as typed columns, and Trade.packSnapshot a snapshot
+	# that unpacks to the same figures as Trade.snapshot
+	def testExport (self):
+		now = datetime.datetime.now ()
+		symbols = ["TEA", "POP", "ALE", "GIN"]
+		trades = []
+		for i in range (1000):
+			timestamp = now - datetime.timedelta (seconds=(i * 37) % 600)
+			trades.append ((self.stocks [symbols [i % 4]], i % 17 + 1, (i // 4) % 2, 20 + (i * 13) % 50, timestamp))
+		for t in [ Trade (clock = SimulatedClock (now)), Trade (columnar = True, clock = SimulatedClock (now)) ]:
+			export = t.exportTrades ()
+			assert (export ["symbols"] == [] and len (export ["prices"]) == 0)
+			t.recordTrades (trades)
+			for start, end in [(None, None), (now - datetime.timedelta (minutes=8), now - datetime.timedelta (minutes=2))]:
+				export = t.exportTrades (start, end)
+				assert (export ["symbols"] == symbols)
+				assert ([export [name].format for name in ["stocks", "timestamps", "quantities", "sides", "prices"]] == ["I", "d", "d", "b", "d"])
+				lower = start if start is not None else now - datetime.timedelta (minutes=5)
+				upper = end if end is not None else now
+				expected = sorted ((symbols.index (trade [0].symbol ()), toEpoch (trade [4]), trade [1], trade [2], trade [3])
+					for trade in trades if lower < trade [4] < upper)
+				exported = sorted (zip (export ["stocks"], export ["timestamps"], export ["quantities"], export ["sides"], export ["prices"]))
+				assert (exported == expected)
+				# trades of each stock together in time order
+				assert (list (export ["stocks"]) == sorted (export ["stocks"]))
+			if numpy is not None:
+				arrays = t.exportTrades (numpyArrays = True)
+				assert (arrays ["prices"].tolist () == t.exportTrades () ["prices"].tolist ())
+			# exported columns are copies, so recording more trades is not blocked and does not change them
+			export = t.exportTrades ()
+			count = len (export ["prices"])
+			t.recordTrade (self.stocks ["TEA"], 10, BuyOrSell.Buy, 30, now - datetime.timedelta (seconds=1))
+			assert (len (export ["prices"]) == count and len (t.exportTrades () ["prices"]) == count + 1)
+			# binary snapshot
+			t.recordTrade (self.stocks ["JOE"], 100, BuyOrSell.Buy, 50, now - datetime.timedelta (minutes=7))
+			data = t.packSnapshot ()
+			assert (len (data) == SNAPSHOT_HEADER.size + 5 * SNAPSHOT_STOCK.size)
+			snapshot = t.snapshot ()
+			unpacked = unpackSnapshot (data)
+			assert (unpacked ["time"] == snapshot ["time"] and unpacked ["allShareIndex"] == snapshot ["allShareIndex"])
+			assert (unpacked ["stocks"] == snapshot ["stocks"] and unpacked ["stocks"] ["JOE"] ["high"] is None)
+			for bad in [data [:-1], b"GBCEJRNL" + data [8:], b""]:
+				try:
+					unpackSnapshot (bad)
+					assert (False)
+				except ValueError:
+					pass
+			t.recordTrade (Stock ("TOOLONGSYM", Type.Common, 8, None, 100), 10, BuyOrSell.Buy, 30, now)
+			try:
+				t.packSnapshot ()
+				assert (False)
+			except ValueError:
+				pass
+
+	# _stopProcesses ends processes started by a test, so a failed test leaves none running
+	# arg processes : the processes
+	def _stopProcesses (self, processes):
+		for process in processes:
+			if process.is_alive ():
+				process.terminate ()
+			process.join ()
+
+	# Tests the Trade.snapshot method gives the same figures for every stock as calculating each one on its own
+	def testSnapshot (self):
+		now = datetime.datetime.now ()
+		symbols = ["TEA", "POP", "ALE", "GIN"]
+		trades = []
+		for i in range (1000):
+			timestamp = now - datetime.timedelta (seconds=(i * 37) % 600)
+			trades.append ((self.stocks [symbols [i % 4]], i % 17 + 1, (i // 4) % 2, 20 + (i * 13) % 50, timestamp))
+		trades.append ((self.stocks ["ALE"], -500, BuyOrSell.Sell, 21, now - datetime.timedelta (minutes=1)))
+		trades.append ((self.stocks ["JOE"], 100, BuyOrSell.Buy, 50, now - datetime.timedelta (minutes=7)))
+		for t in [ Trade (), Trade (columnar = True) ]:
+			t.recordTrades (trades)
+			snapshot = t.snapshot ()
+			assert (snapshot ["allShareIndex"] == t.GBCEAllShareIndex () and sorted (snapshot ["stocks"]) == sorted (symbols + ["JOE"]))
+			for symbol, figures in snapshot ["stocks"].items ():
+				assert (figures ["volumeWeightedStockPrice"] == t.volumeWeightedStockPrice (self.stocks [symbol]))
+				recent = [trade for trade in trades if trade [0].symbol () == symbol and trade [4] > now - datetime.timedelta (minutes=5)]
+				assert (figures ["trades"] == len (recent))
+				assert (figures ["high"] == max ([trade [3] for trade in recent], default = None))
+				assert (figures ["low"] == min ([trade [3] for trade in recent], default = None))
+				for side, name in [(BuyOrSell.Buy, "buy"), (BuyOrSell.Sell, "sell")]:
+					sideTrades = { }
+					for trade in recent:
+						if trade [2] == side:
+							sideTrades [trade [3]] = sideTrades.get (trade [3], 0.0) + trade [1]
+					assert (figures [name + "VolumeWeightedStockPrice"] == t.calculateVolumeWeightedStockPrice (sideTrades))
+					assert (figures [name + "Volume"] == sum (sideTrades.values ()))
+			assert (snapshot ["stocks"] ["ALE"] ["buyVolumeWeightedStockPrice"] > 0 and snapshot ["stocks"] ["ALE"] ["sellVolumeWeightedStockPrice"] == -1)
+			assert (snapshot ["stocks"] ["JOE"] ["volumeWeightedStockPrice"] == -1 and snapshot ["stocks"] ["JOE"] ["high"] is None)
+			# longer window
+			assert (t.snapshot (datetime.timedelta (minutes=10)) ["stocks"] ["JOE"] ["volumeWeightedStockPrice"] == 50)
+
+	# Tests Trade with trades kept in columns gives the same results as with trades kept as TradeRecord objects
+	def testColumnarTrade (self):
+		now = datetime.datetime.now ()
+		trades = [ Trade (), Trade (columnar = True), Trade (streaming = True, columnar = True) ]
+		for i in range (200):
+			symbol = ["TEA", "POP", "ALE", "GIN", "JOE"] [i % 5]
+			timestamp = now - datetime.timedelta (seconds=(i * 37) % 600)
+			for t in trades:
+				t.recordTrade (self.stocks [symbol], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp)
+		for t in trades [1:]:
+			for symbol in ["TEA", "POP", "ALE", "GIN", "JOE"]:
+				assert (t.volumeWeightedStockPrice (self.stocks [symbol]) == trades [0].volumeWeightedStockPrice (self.stocks [symbol]))
+			assert (t.GBCEAllShareIndex () == trades [0].GBCEAllShareIndex ())
+			# trade records built from columns match those recorded
+			for expected, actual in zip (trades [0].trades (), t.trades ()):
+				assert (expected.stock () == actual.stock () and expected.timestamp () == actual.timestamp ())
+				assert (expected.quantity () == actual.quantity () and expected.price () == actual.price ())
+
+		# negative data
+		t = Trade (columnar = True)
+		t.recordTrade (self.stocks ["TEA"], -95, BuyOrSell.Buy, 18, now - datetime.timedelta (minutes=2))
+		t.recordTrade (self.stocks ["ALE"], 95, BuyOrSell.Buy, -18, now - datetime.timedelta (minutes=2))
+		assert (t.volumeWeightedStockPrice (self.stocks ["TEA"]) == -1)
+		assert (t.volumeWeightedStockPrice (self.stocks ["ALE"]) == -1)
+		assert (t.GBCEAllShareIndex () == -1)
+
+		# non-numeric data cannot be kept in columns, and is rejected without changing them
+		t = Trade (columnar = True)
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 50, now - datetime.timedelta (minutes=2))
+		for quantity, price, timestamp in [("err", 50, now), (100, None, now), (100, "err", now - datetime.timedelta (minutes=3))]:
+			try:
+				t.recordTrade (self.stocks ["TEA"], quantity, BuyOrSell.Buy, price, timestamp)
+				assert (False)
+			except TypeError:
+				pass
+		try:
+			t.recordTrades ([(self.stocks ["TEA"], 100, BuyOrSell.Buy, 50, now), (self.stocks ["TEA"], "err", BuyOrSell.Buy, 50, now)])
+			assert (False)
+		except TypeError:
+			pass
+		assert ([len (column) for column in t._index (self.stocks ["TEA"]).columns ()] == [1, 1, 1, 1])
+		t.recordTrade (self.stocks ["TEA"], 300, BuyOrSell.Buy, 70, now - datetime.timedelta (minutes=1))
+		assert (t.volumeWeightedStockPrice (self.stocks ["TEA"]) == 65)
+
 	# Tests the Trade.GBCEAllShareIndex method with good data, negative data and no data
 	def testGBCEAllShareIndex (self):
 		t = Trade ()
@@ -473,7 +4396,191 @@ class TestRig:
 		t.recordTrade (self.stocks ["POP"], 180, BuyOrSell.Buy, 90)
 		t.recordTrade (self.stocks ["ALE"], 200, BuyOrSell.Buy, 65)
 		assert (t.GBCEAllShareIndex () == -1)
+
+		t = Trade ()
+		# index kept up to date as trades are recorded between calls
+		t.recordTrade (self.stocks ["TEA"], 50, BuyOrSell.Buy, 40)
+		t.recordTrade (self.stocks ["POP"], 100, BuyOrSell.Buy, 50)
+		assert (abs (t.GBCEAllShareIndex () - (40 * 50) ** 0.5) < 1e-9)
+		t.recordTrade (self.stocks ["POP"], -300, BuyOrSell.Buy, 90)
+		assert (t.GBCEAllShareIndex () == -1)
+		t.recordTrade (self.stocks ["POP"], 400, BuyOrSell.Buy, 90)
+		t.recordTrade (self.stocks ["ALE"], 200, BuyOrSell.Buy, 0)
+		assert (t.GBCEAllShareIndex () == 0)
+		t.recordTrade (self.stocks ["ALE"], 200, BuyOrSell.Buy, 130)
+		assert (abs (t.GBCEAllShareIndex () - (40 * 70 * 65) ** (1.0 / 3)) < 1e-9)
 		
+		t = Trade ()
+		# many high priced stocks, whose product would overflow
+		for i in range (10000):
+			t.recordTrade (Stock ("S%d" % i, Type.Common, 8, None, 100), 100, BuyOrSell.Buy, 1e100 * (1 + i % 2))
+		assert (abs (t.GBCEAllShareIndex () / (1e100 * 2 ** 0.5) - 1) < 1e-9)
+
+		# the All Share Index is only told of the first trade of a stock since its price was last taken
+		t = Trade (concurrent = True)
+		told = []
+		stockTraded = t._allShareIndex.stockTraded
+		t._allShareIndex.stockTraded = lambda symbol: told.append (symbol) or stockTraded (symbol)
+		for price in [40, 60, 80]:
+			t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, price)
+		t.recordTrades ([(self.stocks ["POP"], 100, BuyOrSell.Buy, 50, datetime.datetime.now ())] * 2)
+		assert (told == ["TEA", "POP"] and abs (t.GBCEAllShareIndex () - (60 * 50) ** 0.5) < 1e-9)
+		t.recordTrade (self.stocks ["TEA"], 200, BuyOrSell.Buy, 90)
+		t.recordTrade (self.stocks ["TEA"], 100, BuyOrSell.Buy, 90)
+		assert (told == ["TEA", "POP", "TEA"] and abs (t.GBCEAllShareIndex () - (75 * 50) ** 0.5) < 1e-9)
+		
+
+	# Tests Trade with trades recorded from several threads at once, with other threads calculating prices as
+	# they are recorded, gives the same results as with the trades recorded from one thread
+	def testConcurrentTrade (self):
+		now = datetime.datetime.now ()
+		symbols = ["TEA", "POP", "ALE", "GIN", "JOE"]
+		trades = []
+		for i in range (20000):
+			timestamp = now - datetime.timedelta (seconds=60 + (i * 37) % 180)
+			trades.append ((self.stocks [symbols [i % 5]], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp))
+		expected = Trade ()
+		expected.recordTrades (trades)
+		interval = sys.getswitchinterval ()
+		# switch threads often so they interleave within each method
+		sys.setswitchinterval (1e-6)
+		try:
+			for t in [ Trade (concurrent = True), Trade (streaming = True, columnar = True, concurrent = True) ]:
+				errors = []
+				done = threading.Event ()
+				def write (part):
+					try:
+						if part % 2 == 0:
+							for stock, quantity, buyorsell, price, timestamp in trades [part::4]:
+								t.recordTrade (stock, quantity, buyorsell, price, timestamp)
+						else:
+							t.recordTrades (trades [part::4], chunkSize = 100)
+					except Exception as e:
+						errors.append (e)
+				def read ():
+					try:
+						while not done.is_set ():
+							# prices are always from a consistent set of trades, so between the lowest and highest price
+							for symbol in symbols:
+								price = t.volumeWeightedStockPrice (self.stocks [symbol])
+								assert (price == -1 or 20 <= price <= 69)
+							price = t.GBCEAllShareIndex ()
+							assert (price == -1 or 20 <= price <= 69)
+					except Exception as e:
+						errors.append (e)
+				writers = [threading.Thread (target = write, args = (part,)) for part in range (4)]
+				readers = [threading.Thread (target = read) for i in range (2)]
+				for thread in writers + readers:
+					thread.start ()
+				for thread in writers:
+					thread.join ()
+				done.set ()
+				for thread in readers:
+					thread.join ()
+				assert (errors == [])
+				for symbol in symbols:
+					assert (t.volumeWeightedStockPrice (self.stocks [symbol]) == expected.volumeWeightedStockPrice (self.stocks [symbol]))
+				# running sum of logs depends on the order reader threads updated stocks in
+				assert (abs (t.GBCEAllShareIndex () / expected.GBCEAllShareIndex () - 1) < 1e-12)
+				assert (len (t.trades ()) == len (trades))
+		finally:
+			sys.setswitchinterval (interval)
+
+	# Tests trades sent to a TradeFeedServer over TCP and Unix sockets are recorded as by Trade.recordTrades,
+	# with queries answered after the trades sent before them and the queue bounded while trades are held back
+	def testTradeFeedServer (self):
+		now = datetime.datetime.now ()
+		symbols = ["TEA", "POP", "ALE", "GIN", "JOE"]
+		trades = []
+		for i in range (5000):
+			timestamp = now - datetime.timedelta (seconds=(i * 37) % 600)
+			trades.append ((self.stocks [symbols [i % 5]], i % 17 + 1, i % 2, 20 + (i * 13) % 50, timestamp))
+		expected = Trade ()
+		expected.recordTrades (trades)
+		directory = tempfile.mkdtemp ()
+		path = os.path.join (directory, "feed.sock")
+
+		async def run (unix):
+			t = Trade (columnar = True)
+			server = TradeFeedServer (t, self.stocks, batchSize = 1000, maxPending = 4)
+			address = await server.start (path) if unix else await server.start ()
+			clients = [TradeFeedClient () for i in range (3)]
+			for client in clients:
+				if unix:
+					await client.connect (path)
+				else:
+					await client.connect (host = address [0], port = address [1])
+			assert (await clients [0].GBCEAllShareIndex () == -1)
+			# trades sent before a query on the same connection are recorded before it is answered
+			await clients [0].sendTrades (trades [:1], frameSize = 1)
+			assert (await clients [0].volumeWeightedStockPrice (self.stocks ["TEA"]) == trades [0] [3])
+			# queue stays bounded while several clients send at once
+			highest = 0
+			async def watch ():
+				nonlocal highest
+				while True:
+					highest = max (highest, server.pending ())
+					await asyncio.sleep (0)
+			watcher = asyncio.ensure_future (watch ())
+			await asyncio.gather (clients [1].sendTrades (trades [1:2000], frameSize = 7), clients [2].sendTrades (trades [2000:], frameSize = 500))
+			watcher.cancel ()
+			assert (highest <= 4)
+			# unknown stocks are left out
+			await clients [1].sendTrades ([(Stock ("XXX", Type.Common, 8, None, 100), 10, BuyOrSell.Buy, 20, now)])
+			assert (await clients [1].volumeWeightedStockPrice (Stock ("XXX", Type.Common, 8, None, 100)) == -1)
+			# unreadable and empty messages are left out without stopping trades being recorded
+			clients [1]._writer.write (TradeFeedServer.HEADER.pack (TradeFeedServer.TRADES, b"", 1) +
+				TRADE_RECORD.pack (b"\xff\xfe", toEpoch (now), 10, BuyOrSell.Buy, 20) + TradeFeedServer.HEADER.pack (TradeFeedServer.TRADES, b"", 0))
+			assert (await clients [1].volumeWeightedStockPrice (self.stocks ["TEA"]) == expected.volumeWeightedStockPrice (self.stocks ["TEA"]))
+			# a message of more trades than a batch closes its connection before it is read
+			large = TradeFeedClient ()
+			if unix:
+				await large.connect (path)
+			else:
+				await large.connect (host = address [0], port = address [1])
+			large._writer.write (TradeFeedServer.HEADER.pack (TradeFeedServer.TRADES, b"", 1001))
+			assert (await large._reader.read () == b"")
+			await large.close ()
+			for client in clients [1:]:
+				await client.close ()
+			for symbol in symbols:
+				assert (await clients [0].volumeWeightedStockPrice (self.stocks [symbol]) == expected.volumeWeightedStockPrice (self.stocks [symbol]))
+			assert (await clients [0].GBCEAllShareIndex () == expected.GBCEAllShareIndex ())
+			await clients [0].close ()
+			await server.close ()
+			assert (server.recorded () == len (trades))
+			assert (len (t.trades ()) == len (trades))
+
+		asyncio.run (run (False))
+		asyncio.run (run (True))
+		if os.path.exists (path):
+			os.remove (path)
+		os.rmdir (directory)
+
+	# Tests the Trade.shardedGBCEAllShareIndex method gives the same results as Trade.GBCEAllShareIndex
+	def testShardedGBCEAllShareIndex (self):
+		now = datetime.datetime.now ()
+		for t in [ Trade (), Trade (columnar = True, concurrent = True) ]:
+			assert (t.shardedGBCEAllShareIndex (processes = 2) == -1)
+			t.recordTrade (self.stocks ["JOE"], 100, BuyOrSell.Buy, 50, now)
+			assert (t.shardedGBCEAllShareIndex (processes = 2) == 50)
+			for i in range (1000):
+				stock = Stock ("S%d" % (i % 300), Type.Common, 8, None, 100)
+				t.recordTrade (stock, i % 17 + 1, i % 2, 1e100 * (1 + (i * 13) % 50), now - datetime.timedelta (minutes=i % 10))
+			# trades only kept in totals
+			t._index (self.stocks ["TEA"]).compactMany ([40, 60], [10, 30])
+			t._allShareIndex.stockTraded ("TEA")
+			for processes, shards in [(0, None), (1, None), (2, None), (3, 7)]:
+				assert (abs (t.shardedGBCEAllShareIndex (processes, shards) / t.GBCEAllShareIndex () - 1) < 1e-12)
+			# a snapshot keeps the trades recorded when it was taken
+			folded, aggregates, columns = t._index (self.stocks ["JOE"]).totalsSnapshot ()
+			t.recordTrade (self.stocks ["JOE"], 10, BuyOrSell.Buy, 70, now)
+			assert ([list (column) for column in columns ()] == [[50.0], [100.0]])
+			# negative and zero prices
+			t.recordTrade (self.stocks ["ALE"], 200, BuyOrSell.Buy, 0, now)
+			assert (t.shardedGBCEAllShareIndex (processes = 2) == t.GBCEAllShareIndex () == 0)
+			t.recordTrade (self.stocks ["POP"], -100, BuyOrSell.Buy, 50, now)
+			assert (t.shardedGBCEAllShareIndex (processes = 2) == t.GBCEAllShareIndex () == -1)
 
 # main method
 # run tests
@@ -481,9 +4588,25 @@ if __name__ == '__main__':
 	t = TestRig ()
 	t.testDividend ()
 	t.testPERatio ()
+	t.testBatchDividendAndPERatio ()
+	t.testStockRegistry ()
 	t.testRecordTrade ()
+	t.testRecordTrades ()
+	t.testTradeJournal ()
 	t.testVolumeWeightedStockPrice ()
+	t.testStreamingVolumeWeightedStockPrice ()
+	t.testWindowedVolumeWeightedStockPrice ()
+	t.testReplay ()
+	t.testRetention ()
+	t.testInstrumentation ()
+	t.testSnapshot ()
+	t.testSharedTradeRing ()
+	t.testExport ()
+	t.testColumnarTrade ()
+	t.testConcurrentTrade ()
+	t.testTradeFeedServer ()
 	t.testGBCEAllShareIndex ()
-	print "ALL PASSED"
+	t.testShardedGBCEAllShareIndex ()
+	print ("ALL PASSED")
 	
 	